@@ -4,6 +4,7 @@ os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"  # noqa: E402
 import pygame
 import moderngl
 import sys
+import argparse
 from OpenGL.GL import glGetString, GL_SHADING_LANGUAGE_VERSION
 
 
@@ -13,6 +14,7 @@ class Engine:
     free_move = True
     vertical_sync = 0
     target_display = 0
+    headless = False  # Query a standalone context, no window
     # Variables
     fps = 0
     time = 0
@@ -22,8 +24,13 @@ class Engine:
     paused = True
     full_screen = False
 
-    def __init__(self, windowed_win_size=(1600, 900), full_screen_win_size=(1920, 1080)):
+    def __init__(self, windowed_win_size=(1600, 900), full_screen_win_size=(1920, 1080), headless=headless):
+        self.headless = headless
         # Initialize pygame modules
+        if self.headless:
+            # No display or audio device on render and CI machines
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
         pygame.mixer.pre_init(44100, 16, 2, 4096)
         pygame.init()
         # Window size
@@ -33,26 +40,35 @@ class Engine:
             self.win_size = self.full_screen_win_size
         else:
             self.win_size = self.windowed_win_size
-        # Set OpenGL attributes (no version specification to use default)
-        pygame.display.gl_set_attribute(pygame.GL_CONTEXT_PROFILE_MASK, pygame.GL_CONTEXT_PROFILE_CORE)
-        pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, self.vertical_sync)
-        # Create OpenGL context for 3D rendering
-        self.game_screen = pygame.display.set_mode(
-            self.win_size,
-            flags=pygame.OPENGL | pygame.DOUBLEBUF,
-            display=self.target_display,
-            vsync=self.vertical_sync
-        )
-        # Mouse settings
-        pygame.event.set_grab(True)
-        pygame.mouse.set_visible(False)
-        # Detect and use existing OpenGL context
-        try:
-            self.ctx = moderngl.create_context()
-        except Exception as e:
-            print(f"error: failed to create opengl context: {e}")
-            pygame.quit()
-            sys.exit(1)
+        if self.headless:
+            # Standalone OpenGL context (EGL, e.g. llvmpipe)
+            try:
+                self.ctx = moderngl.create_standalone_context(backend='egl')
+            except Exception as e:
+                print(f"error: failed to create standalone opengl context: {e}")
+                pygame.quit()
+                sys.exit(1)
+        else:
+            # Set OpenGL attributes (no version specification to use default)
+            pygame.display.gl_set_attribute(pygame.GL_CONTEXT_PROFILE_MASK, pygame.GL_CONTEXT_PROFILE_CORE)
+            pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, self.vertical_sync)
+            # Create OpenGL context for 3D rendering
+            self.game_screen = pygame.display.set_mode(
+                self.win_size,
+                flags=pygame.OPENGL | pygame.DOUBLEBUF,
+                display=self.target_display,
+                vsync=self.vertical_sync
+            )
+            # Mouse settings
+            pygame.event.set_grab(True)
+            pygame.mouse.set_visible(False)
+            # Detect and use existing OpenGL context
+            try:
+                self.ctx = moderngl.create_context()
+            except Exception as e:
+                print(f"error: failed to create opengl context: {e}")
+                pygame.quit()
+                sys.exit(1)
         self.ctx.enable(flags=moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
         self.ctx.gc_mode = 'auto'
         # Create an object to help track time
@@ -143,5 +159,8 @@ class Engine:
 
 
 if __name__ == '__main__':
-    app = Engine()
+    parser = argparse.ArgumentParser(description="Query GPU and OpenGL information.")
+    parser.add_argument("--headless", action="store_true", help="Use a standalone (EGL) context instead of a window.")
+    args = parser.parse_args()
+    app = Engine(headless=args.headless)
     app.run()
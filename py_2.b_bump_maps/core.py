@@ -2,6 +2,10 @@ import numpy
 import moderngl
 import glm
 import pygame
+import json
+import time
+import math
+from collections import deque
 
 mat_4 = glm.mat4(1)
 
@@ -11,6 +15,17 @@ def generate_vertex_data(vertices, indices):
     return numpy.array(data, dtype='f4')
 
 
+def generate_indexed_vertex_data(vertex_data):
+    # Weld identical interleaved vertices, returns the unique vertices in first use order and the indices
+    vertex_data = numpy.asarray(vertex_data, dtype='f4')
+    _, first, inverse = numpy.unique(vertex_data.reshape(len(vertex_data), -1), axis=0,
+                                     return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    remap = numpy.empty(len(order), dtype='u4')
+    remap[order] = numpy.arange(len(order), dtype='u4')
+    return vertex_data[first[order]], remap[inverse.reshape(-1)]
+
+
 def compute_tangents(vertices, indices, texture_coords, texture_indices):
     """
     Compute tangent vectors for a mesh using MikkTSpace-like algorithm.
@@ -65,6 +80,33 @@ def compute_tangents(vertices, indices, texture_coords, texture_indices):
     return tangents
 
 
+def get_bounds(positions):
+    # Axis aligned bounding box as (centre, half extents)
+    positions = numpy.asarray(positions, dtype='f4').reshape(-1, 3)
+    b_min, b_max = positions.min(axis=0), positions.max(axis=0)
+    return (b_min + b_max) * 0.5, (b_max - b_min) * 0.5
+
+
+def transform_bounds(m_model, bounds):
+    # Box enclosing the transformed box, the extents are projected onto the world axes
+    m = numpy.array(m_model, dtype='f4')
+    center, extents = bounds
+    return m[:3, :3] @ center + m[:3, 3], numpy.abs(m[:3, :3]) @ extents
+
+
+def get_frustum_planes(m_proj_view):
+    # Left, right, bottom, top, near and far planes (a, b, c, d) taken from the rows of the matrix
+    m = numpy.array(m_proj_view, dtype='f4')
+    planes = numpy.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes / numpy.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def frustum_cull(planes, centers, extents):
+    # A box is visible unless it lies entirely behind one of the planes
+    distances = centers @ planes[:, :3].T + planes[:, 3] + extents @ numpy.abs(planes[:, :3]).T
+    return (distances >= 0.0).all(axis=1)
+
+
 class Camera:
     yaw = -90
     pitch = 0
@@ -89,9 +131,11 @@ class Camera:
         self.near = near
         self.far = far
         self.sensitivity = sensitivity
-        # View matrix
-        self.m_view = self.get_view_matrix()
-        # Aspect ratio and Projection matrix
+        # Matrices are only rebuilt when their inputs change, version counts the rebuilds
+        self.view_state = None
+        self.proj_state = None
+        self.version = 0
+        # Aspect ratio, View and Projection matrices
         self.set_aspect_and_projection()
         # Key bindings
         self.key_bindings = {
@@ -105,16 +149,13 @@ class Camera:
 
     def set_aspect_and_projection(self):
         self.aspect_ratio = self.app.win_size[0] / self.app.win_size[1]
-        self.m_proj = self.get_projection_matrix()
+        self.update_matrices()
 
     def rotate(self):
-        old_yaw, old_pitch = self.yaw, self.pitch
         rel_x, rel_y = pygame.mouse.get_rel()
         self.yaw += rel_x * self.sensitivity
         self.pitch -= rel_y * self.sensitivity
         self.pitch = max(-89, min(89, self.pitch))
-        if old_yaw != self.yaw or old_pitch != self.pitch:
-            self.app.scene.moved = True
 
     def update_camera_vectors(self):
         yaw, pitch = glm.radians(self.yaw), glm.radians(self.pitch)
@@ -125,14 +166,32 @@ class Camera:
         self.right = glm.normalize(glm.cross(self.forward, glm.vec3(0, 1, 0)))
         self.up = glm.normalize(glm.cross(self.right, self.forward))
 
-    def update(self):
-        self.move()
-        self.rotate()
-        self.update_camera_vectors()
-        self.m_view = self.get_view_matrix()
+    def update(self, user_input=True):
+        if user_input:
+            self.move()
+            self.rotate()
+        else:
+            # Drop the mouse motion, so it does not turn the camera once input is used again
+            pygame.mouse.get_rel()
+        self.update_matrices()
+
+    def update_matrices(self):
+        view_state = (self.position.x, self.position.y, self.position.z, self.yaw, self.pitch)
+        proj_state = (self.fov, self.aspect_ratio, self.near, self.far)
+        if view_state == self.view_state and proj_state == self.proj_state:
+            return
+        if view_state != self.view_state:
+            self.view_state = view_state
+            self.update_camera_vectors()
+            self.m_view = self.get_view_matrix()
+        if proj_state != self.proj_state:
+            self.proj_state = proj_state
+            self.m_proj = self.get_projection_matrix()
+        self.m_proj_view = self.m_proj * self.m_view
+        self.frustum_planes = get_frustum_planes(self.m_proj_view)
+        self.version += 1
 
     def move(self):
-        old_x, old_y, old_z = self.position.xyz
         self.velocity = self.speed * self.app.raw_delta_time
         keys = pygame.key.get_pressed()
         if keys[self.key_bindings["forward"]]:
@@ -147,8 +206,6 @@ class Camera:
             self.position += self.up * self.velocity
         if keys[self.key_bindings["down"]]:
             self.position -= self.up * self.velocity
-        if self.position.x != old_x or self.position.y != old_y or self.position.z != old_z:
-            self.app.scene.moved = True
 
     def get_view_matrix(self):
         return glm.lookAt(self.position, self.position + self.forward, self.up)
@@ -311,7 +368,10 @@ class Texture:
     def get_color_texture(self, size, name='color_texture', samples=None, disable_repeat=False):
         if name in self.texture_map:
             return self.texture_map[name]
-        color_texture = self.ctx.texture(size=size, components=4, samples=samples)
+        if samples == None:
+            color_texture = self.ctx.texture(size=size, components=4)
+        else:
+            color_texture = self.ctx.texture(size=size, components=4, samples=samples)
         # Remove repetition
         if disable_repeat:
             color_texture.repeat_x = False
@@ -321,6 +381,7 @@ class Texture:
         self.texture_map[name] = self.texture_count
         self.textures.append(color_texture)
         print(f"loaded color texture: {name} at index: {self.texture_count}")
+        return self.texture_count
 
     def destroy(self):
         for texture in self.textures:
@@ -362,6 +423,7 @@ class Prototype:
         self.objects = []
         self.object_count = -1
         self.object_map = {}
+        self.camera_version = -1
 
     def get_object(self, name):
         if name in self.object_map:
@@ -387,15 +449,20 @@ class Prototype:
         return base_object
 
     def common_render_update(self):
+        # Camera uniforms are only sent when the camera has rebuilt its matrices
+        camera_changed = self.camera_version != self.app.camera.version
+        self.camera_version = self.app.camera.version
+
         shader_program = self.app.shader.get_shader('default')
         # Resolution
         # shader_program['u_resolution'].write(glm.vec2(self.app.win_size))
 
         # Position
         shader_program['num_lights'].value = len(self.app.lights)
-        shader_program['cam_pos'].write(self.app.camera.position)
-        shader_program['m_proj'].write(self.app.camera.m_proj)
-        shader_program['m_view'].write(self.app.camera.m_view)
+        if camera_changed:
+            shader_program['cam_pos'].write(self.app.camera.position)
+            shader_program['m_proj'].write(self.app.camera.m_proj)
+            shader_program['m_proj_view'].write(self.app.camera.m_proj_view)
 
         # Send lights into uniform array of Light struct
         for i, light in enumerate(self.app.lights):
@@ -420,7 +487,8 @@ class Prototype:
 
         # Shadow
         shadow_program = self.app.shader.get_shader('shadow')
-        shadow_program['m_proj'].write(self.app.camera.m_proj)
+        if camera_changed:
+            shadow_program['m_proj'].write(self.app.camera.m_proj)
         shadow_program['m_view_light'].write(self.app.global_light.m_view_light)
 
         # Debug
@@ -429,8 +497,8 @@ class Prototype:
 
         # Debug Light
         light_program = self.app.shader.get_shader('light')
-        light_program['m_proj'].write(self.app.camera.m_proj)
-        light_program['m_view'].write(self.app.camera.m_view)
+        if camera_changed:
+            light_program['m_proj_view'].write(self.app.camera.m_proj_view)
 
     def destroy(self):
         for obj in self.objects:
@@ -454,17 +522,20 @@ class PrototypeCube:
         self.vao.release()
         self.shadow_vao.release()
         self.vbo.release()
+        self.ibo.release()
+        self.shadow_vbo.release()
+        self.shadow_ibo.release()
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '2f 3f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal', 'in_tangent'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_shadow_vao(self, vbo, shadow_program):
         vao = self.ctx.vertex_array(shadow_program, [
             (vbo, '3f',  'in_position'),
-        ])
+        ], index_buffer=self.shadow_ibo, index_element_size=4)
         return vao
 
     def get_vertex_data(self, all_data: bool = True):
@@ -523,10 +594,16 @@ class PrototypeCube:
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        # Identical vertices are welded, the faces share them through the index buffer
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.bounds = get_bounds(vertex_data[:, 2:5])
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
     def get_shadow_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data(all_data=False))
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data(all_data=False))
+        self.shadow_ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 class PrototypeLightSource():
@@ -541,11 +618,12 @@ class PrototypeLightSource():
     def destroy(self):
         self.vao.release()
         self.vbo.release()
+        self.ibo.release()
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '3f', 'in_position'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_vertex_data(self):
@@ -571,7 +649,9 @@ class PrototypeLightSource():
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 def generate_vertex_data(vertices, indices):
@@ -592,6 +672,7 @@ class Cube:
         self.position = glm.scale(self.position, glm.vec3(scale))
         self.can_update = can_update
         self.can_render = True
+        self.can_render_shadow = True
 
         self.albedo = glm.vec3(albedo)
         self.roughness = roughness
@@ -599,6 +680,7 @@ class Cube:
 
         this_object = self.app.prototype.get_object(name)
         self.vao = this_object.vao
+        self.bounds = this_object.bounds
         self.shadow_vao = this_object.shadow_vao
         self.shader_program = this_object.shader_program
         self.shadow_program = this_object.shadow_program
@@ -673,7 +755,8 @@ class LightSource:
 class Scene():
     objects = []
     update_list = []
-    moved = True
+    camera_version = -1
+    draw_calls = 0
 
     def __init__(self, app):
         self.app = app
@@ -738,27 +821,38 @@ class Scene():
             if obj.can_update:
                 self.update_list.append(obj)
 
+        # World space bounds of every object, kept in arrays so they can be culled together
+        self.bounds_center = numpy.zeros((len(self.objects), 3), dtype='f4')
+        self.bounds_extents = numpy.zeros((len(self.objects), 3), dtype='f4')
+        for i, obj in enumerate(self.objects):
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+        self.all_indices = numpy.arange(len(self.objects))
+        self.update_indices = numpy.array([i for i, obj in enumerate(self.objects) if obj.can_update], dtype=int)
+
     def update(self):
-        if self.moved == False:
-            for obj in self.update_list:
-                obj.update()
-            return
-        camera_pos = self.app.camera.position
-        for obj in self.objects:
-            if obj.can_update:
-                obj.update()
-            angle_from_camera = glm.degrees(glm.acos(glm.dot(glm.normalize(obj.pos - camera_pos), self.app.camera.forward)))
-            if angle_from_camera <= 120.0:  # View frustum
-                obj.can_render = True
-                continue
-            distance = glm.distance(camera_pos, obj.pos)
-            if distance <= 10.0:
-                obj.can_render = True
-                continue
-            obj.can_render = False
-        self.moved = False
+        for i, obj in zip(self.update_indices, self.update_list):
+            obj.update()
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+
+        # Re-cull everything when the camera changed, otherwise only the objects that may have moved
+        if self.camera_version != self.app.camera.version:
+            self.camera_version = self.app.camera.version
+            indices = self.all_indices
+        else:
+            indices = self.update_indices
+        visible = frustum_cull(self.app.camera.frustum_planes,
+                               self.bounds_center[indices], self.bounds_extents[indices])
+        for i, can_render in zip(indices.tolist(), visible.tolist()):
+            self.objects[i].can_render = can_render
+
+        # Shadow casters are culled against the global light, which rotates every frame
+        shadow_planes = get_frustum_planes(self.app.camera.m_proj * self.app.global_light.m_view_light)
+        visible = frustum_cull(shadow_planes, self.bounds_center, self.bounds_extents)
+        for obj, can_render_shadow in zip(self.objects, visible.tolist()):
+            obj.can_render_shadow = can_render_shadow
 
     def render(self):
+        self.draw_calls = 0
         self.app.prototype.common_render_update()
 
         # Clear buffers
@@ -767,30 +861,289 @@ class Scene():
 
         # Pass 1 - Render the depth map for the global light shadows
         if self.app.show_global_light:
-            # Enable front face culling in ctx to remove peter-panning flying shadows
-            self.ctx.cull_face = "front"
-            self.app.shadow.depth_fbo.use()
-            for obj in self.objects:
-                if obj.can_render:
-                    obj.render_shadow()
-            self.ctx.cull_face = "back"
+            with self.app.gpu_timer.query('shadow'):
+                # Enable front face culling in ctx to remove peter-panning flying shadows
+                self.ctx.cull_face = "front"
+                self.app.shadow.depth_fbo.use()
+                for obj in self.objects:
+                    if obj.can_render_shadow:
+                        obj.render_shadow()
+                        self.draw_calls += 1
+                self.ctx.cull_face = "back"
 
         # Pass 2 - Render the scene
-        self.app.ctx.screen.use()  # Switch back to the screen
-        for obj in self.objects:
-            if obj.can_render:
-                obj.render()
+        self.app.screen.use()  # Switch back to the screen
+        with self.app.gpu_timer.query('main'):
+            for obj in self.objects:
+                if obj.can_render:
+                    obj.render()
+                    self.draw_calls += 1
 
         # Render debug lights
         if self.app.show_light_sources:
-            if self.app.show_global_light:
-                self.light_source_global.render()
-            if self.app.local_light == 1.0:
-                for light_source in self.light_source_local:
-                    light_source.render()
+            with self.app.gpu_timer.query('lights'):
+                if self.app.show_global_light:
+                    self.light_source_global.render()
+                    self.draw_calls += 1
+                if self.app.local_light == 1.0:
+                    for light_source in self.light_source_local:
+                        light_source.render()
+                        self.draw_calls += 1
+
+        # Performance overlay
+        if self.app.show_hud:
+            self.app.hud.render()
+            self.draw_calls += 1
 
         # Swap buffers
-        pygame.display.flip()
+        if not self.app.headless:
+            pygame.display.flip()
 
     def destroy(self):
         pass
+
+
+class CpuTimer():
+    '''CPU time of named engine sections for the current frame, in milliseconds.'''
+
+    def __init__(self):
+        self.times = {}
+        self.frame_start = 0.0
+        self.section_start = 0.0
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.section_start = self.frame_start
+
+    def begin(self):
+        self.section_start = time.perf_counter()
+
+    def end(self, name):
+        now = time.perf_counter()
+        self.times[name] = (now - self.section_start) * 1000.0
+        self.section_start = now
+
+    def end_frame(self):
+        self.times['frame'] = (time.perf_counter() - self.frame_start) * 1000.0
+
+
+class Benchmark():
+    '''Replay a scripted camera path with a fixed delta time and save frame time percentiles to JSON.'''
+    sections = ['camera_update', 'scene_update', 'scene_render', 'frame']
+
+    def __init__(self, app, frames=600, warmup_frames=30, delta_time=16.0, path='benchmark.json',
+                 radius=4.0, height=1.0, pitch=15.0):
+        self.app = app
+        self.frames = frames
+        self.warmup_frames = warmup_frames
+        self.delta_time = delta_time
+        self.path = path
+        self.radius = radius
+        self.height = height
+        self.pitch = pitch
+        self.frame = 0
+        self.finished = False
+        self.samples = {name: [] for name in self.sections}
+        self.gpu_samples = {}
+        # The path is a closed loop that starts and ends at the initial camera placement
+        self.start_position = glm.vec3(app.camera.position)
+        self.start_yaw = app.camera.yaw
+        self.start_pitch = app.camera.pitch
+        # Let time run (with the fixed step) so animated objects are part of the measured work
+        self.app.paused = False
+
+    def set_camera(self):
+        angle = 2.0 * math.pi * self.frame / (self.warmup_frames + self.frames)
+        camera = self.app.camera
+        camera.position = self.start_position + glm.vec3(math.sin(angle) * self.radius,
+                                                         math.sin(angle * 2.0) * self.height,
+                                                         (math.cos(angle) - 1.0) * self.radius)
+        camera.yaw = self.start_yaw + math.degrees(angle)
+        camera.pitch = self.start_pitch + math.sin(angle * 2.0) * self.pitch
+
+    def record(self):
+        if self.frame >= self.warmup_frames:
+            for name in self.sections:
+                self.samples[name].append(self.app.cpu_timer.times[name])
+            for name, elapsed in self.app.gpu_timer.last.items():
+                self.gpu_samples.setdefault(name, []).append(elapsed)
+        self.frame += 1
+        if self.frame >= self.warmup_frames + self.frames:
+            self.finished = True
+
+    def summarize(self, samples):
+        samples = numpy.array(samples, dtype='f8')
+        return {
+            'p50': float(numpy.percentile(samples, 50)),
+            'p95': float(numpy.percentile(samples, 95)),
+            'p99': float(numpy.percentile(samples, 99)),
+            'max': float(samples.max()),
+            'mean': float(samples.mean()),
+        }
+
+    def save(self):
+        results = {
+            'frames': self.frames,
+            'warmup_frames': self.warmup_frames,
+            'delta_time': self.delta_time,
+            'win_size': list(self.app.win_size),
+            'headless': self.app.headless,
+            'renderer': self.app.ctx.info['GL_RENDERER'],
+            'cpu_ms': {name: self.summarize(samples) for name, samples in self.samples.items()},
+            'gpu_ms': {name: self.summarize(samples) for name, samples in self.gpu_samples.items()},
+        }
+        with open(self.path, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"saved benchmark: {self.path}")
+
+
+class GpuTimer():
+    '''GPU time of named render passes, in milliseconds, from time-elapsed queries.
+
+    Each pass owns a small ring of queries and a result is only read back `latency` frames
+    after it was issued, when the GPU has finished with it, so reading does not stall the frame.
+    '''
+
+    def __init__(self, app, latency=3, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.latency = latency
+        self.slots = latency + 1
+        self.slot = 0
+        self.history_size = history
+        self.queries = {}
+        self.issued = {}
+        self.history = {}
+        self.last = {}
+
+    def query(self, name):
+        '''Return the query for this pass and frame, use it as a context manager around the pass.'''
+        if name not in self.queries:
+            self.queries[name] = [self.ctx.query(time=True) for _ in range(self.slots)]
+            self.issued[name] = [False] * self.slots
+            self.history[name] = deque(maxlen=self.history_size)
+        self.issued[name][self.slot] = True
+        return self.queries[name][self.slot]
+
+    def end_frame(self):
+        # The next slot was issued `latency` frames ago, read it back before it is reused
+        self.slot = (self.slot + 1) % self.slots
+        self.last = {}
+        for name, queries in self.queries.items():
+            if self.issued[name][self.slot]:
+                elapsed = queries[self.slot].elapsed * 1e-6  # Nanoseconds to milliseconds
+                self.history[name].append(elapsed)
+                self.last[name] = elapsed
+                self.issued[name][self.slot] = False
+
+    def get_times(self):
+        '''Rolling mean GPU time per pass, in milliseconds.'''
+        return {name: sum(history) / len(history) for name, history in self.history.items() if len(history) > 0}
+
+
+class Hud():
+    '''Toggleable performance overlay, drawn as a textured quad over the finished frame.
+
+    Lines are refreshed one at a time, spread over the `refresh` interval, and only re-rendered
+    when their text changed; most frames the overlay is a single cached quad draw and at worst
+    one small font render and sub-texture write.
+    '''
+    lines = 12
+
+    def __init__(self, app, width=320, margin=10, refresh=250, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.margin = margin
+        self.refresh = refresh
+        self.elapsed = 0.0
+        self.line = 0
+        self.texts = [None] * self.lines
+        self.cost = 0.0
+        self.line_height = self.app.font.get_linesize()
+        self.size = (width, self.line_height * self.lines)
+        self.background = (0, 0, 0, 160)
+        self.text_color = (255, 255, 255)
+
+        # Rolling history of the frame, cpu section and overlay times
+        self.frame_times = deque(maxlen=history)
+        self.costs = deque(maxlen=history)
+        self.cpu_history = {}
+        self.history = history
+
+        # Texture the text is drawn into, cleared to the background colour
+        self.tex_id = self.app.texture.get_color_texture(size=self.size, name='hud')
+        self.texture = self.app.texture.textures[self.tex_id]
+        self.texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        surface = pygame.Surface(self.size, flags=pygame.SRCALPHA)
+        surface.fill(self.background)
+        self.texture.write(pygame.image.tostring(surface, 'RGBA', True))
+        self.line_surface = pygame.Surface((self.size[0], self.line_height), flags=pygame.SRCALPHA)
+
+        self.shader_program = self.app.shader.get_shader('hud')
+        self.shader_program['u_tex'] = self.tex_id
+        self.vbo = self.ctx.buffer(reserve=6 * 4 * 4)  # 6 vertices of 2f position and 2f texture coordinates
+        self.vao = self.ctx.vertex_array(self.shader_program, [
+            (self.vbo, '2f 2f', 'in_position', 'in_texcoord_0'),
+        ])
+        self.win_size = None
+
+    def set_quad(self):
+        # Pixel rectangle in the top left corner to normalized device coordinates
+        self.win_size = self.app.win_size
+        w, h = self.win_size
+        x0 = -1.0 + 2.0 * self.margin / w
+        x1 = x0 + 2.0 * self.size[0] / w
+        y1 = 1.0 - 2.0 * self.margin / h
+        y0 = y1 - 2.0 * self.size[1] / h
+        vertices = [(x0, y0, 0, 0), (x1, y0, 1, 0), (x1, y1, 1, 1), (x0, y1, 0, 1)]
+        indices = [(0, 1, 2), (2, 3, 0)]
+        self.vbo.write(generate_vertex_data(vertices, indices))
+
+    def get_lines(self):
+        lines = [f"frame {sum(self.frame_times) / len(self.frame_times):.2f} ms  fps {self.app.fps:.1f}",
+                 f"draw calls {self.app.scene.draw_calls}"]
+        for name, history in self.cpu_history.items():
+            lines.append(f"cpu {name} {sum(history) / len(history):.3f} ms")
+        for name, elapsed in self.app.gpu_timer.get_times().items():
+            lines.append(f"gpu {name} {elapsed:.3f} ms")
+        lines.append(f"hud {sum(self.costs) / len(self.costs):.3f} ms")
+        return lines
+
+    def write_line(self, text):
+        self.line_surface.fill(self.background)
+        self.line_surface.blit(self.app.font.render(text, True, self.text_color), (4, 0))
+        y = self.size[1] - (self.line + 1) * self.line_height  # Texture rows start at the bottom
+        self.texture.write(pygame.image.tostring(self.line_surface, 'RGBA', True),
+                           viewport=(0, y, self.size[0], self.line_height))
+
+    def render(self):
+        start = time.perf_counter()
+        self.frame_times.append(self.app.raw_delta_time)
+        self.costs.append(self.cost)
+        for name, value in self.app.cpu_timer.times.items():
+            if name not in self.cpu_history:
+                self.cpu_history[name] = deque(maxlen=self.history)
+            self.cpu_history[name].append(value)
+
+        # Refresh the next line once its share of the refresh interval has passed
+        self.elapsed += self.app.raw_delta_time
+        if self.elapsed >= self.refresh / self.lines:
+            self.elapsed = 0.0
+            lines = self.get_lines()
+            text = lines[self.line] if self.line < len(lines) else ''
+            if text != self.texts[self.line]:
+                self.texts[self.line] = text
+                self.write_line(text)
+            self.line = (self.line + 1) % self.lines
+
+        if self.win_size != self.app.win_size:
+            self.set_quad()
+        self.texture.use(location=self.tex_id)
+        self.ctx.disable(moderngl.DEPTH_TEST)
+        self.vao.render()
+        self.ctx.enable(moderngl.DEPTH_TEST)
+        self.cost = (time.perf_counter() - start) * 1000.0
+
+    def destroy(self):
+        self.vao.release()
+        self.vbo.release()
@@ -0,0 +1,11 @@
+#version 460 core
+
+layout (location = 0) in vec2 in_position;
+layout (location = 1) in vec2 in_texcoord_0;
+
+out vec2 uv_0;
+
+void main() {
+    uv_0 = in_texcoord_0;
+    gl_Position = vec4(in_position, 0.0, 1.0);
+}
\ No newline at end of file
@@ -12,7 +12,7 @@ out vec4 shadow_coord;
 out mat3 bump_t_b_n;
 
 uniform mat4 m_proj;
-uniform mat4 m_view;
+uniform mat4 m_proj_view;
 uniform mat4 m_model;
 uniform mat4 m_view_global_light;
 
@@ -29,7 +29,7 @@ void main() {
     uv_0 = in_texcoord_0.xy;
     normal = normalize(m3_model * in_normal);
     frag_pos = vec3(m_model * in_position4);
-    gl_Position = m_proj * m_view * m_model * in_position4;
+    gl_Position = m_proj_view * m_model * in_position4;
 
     const mat4 shadow_mvp = m_proj * m_view_global_light * m_model;
     shadow_coord = m_shadow_bias * shadow_mvp * in_position4;
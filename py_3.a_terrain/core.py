@@ -2,7 +2,16 @@ import numpy
 import moderngl
 import glm
 import pygame
+import json
+import time
 import math
+import os
+import functools
+import hashlib
+import heapq
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 mat_4 = glm.mat4(1)
 
@@ -12,6 +21,17 @@ def generate_vertex_data(vertices, indices):
     return numpy.array(data, dtype='f4')
 
 
+def generate_indexed_vertex_data(vertex_data):
+    # Weld identical interleaved vertices, returns the unique vertices in first use order and the indices
+    vertex_data = numpy.asarray(vertex_data, dtype='f4')
+    _, first, inverse = numpy.unique(vertex_data.reshape(len(vertex_data), -1), axis=0,
+                                     return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    remap = numpy.empty(len(order), dtype='u4')
+    remap[order] = numpy.arange(len(order), dtype='u4')
+    return vertex_data[first[order]], remap[inverse.reshape(-1)]
+
+
 def delta_ab(a, b):
     return glm.vec3(b[0] - a[0], b[1] - a[1], b[2] - a[2])
 
@@ -25,16 +45,159 @@ def angle_between_vectors(a, b):
     return math.acos(dot_product(a, b))
 
 
-def uniform_points_in_3d_triangle(p1, p2, p3, n):
-    points = []
-    for i in range(n):
-        for j in range(n - i):
-            k = n - i - j
-            x = (i * p1[0] + j * p2[0] + k * p3[0]) / n
-            y = (i * p1[1] + j * p2[1] + k * p3[1]) / n
-            z = (i * p1[2] + j * p2[2] + k * p3[2]) / n
-            points.append((x, y, z))
-    return points
+def uniform_points_in_3d_triangles(triangles, n, jitter=0.0, seed=0):
+    # Barycentric grid of n * (n + 1) / 2 points in each triangle of an array (count, 3, 3), in one pass
+    i, j = numpy.triu_indices(n)
+    j = j - i
+    weights = numpy.stack([i, j, n - i - j], axis=1).astype('f8')
+    if jitter:
+        # Move each point up to jitter grid steps, seeded so a chunk always scatters the same way
+        rng = numpy.random.default_rng(seed)
+        weights = weights + rng.uniform(-0.5 * jitter, 0.5 * jitter, size=(len(triangles), len(weights), 3))
+        # Clamp back into the triangle, the weights still add up to n
+        weights = numpy.maximum(weights, 0.0)
+        weights *= n / weights.sum(axis=-1, keepdims=True)
+    points = (weights[..., 0, None] * triangles[:, None, 0]
+              + weights[..., 1, None] * triangles[:, None, 1]
+              + weights[..., 2, None] * triangles[:, None, 2])
+    return points / n
+
+
+def shader_random(st):
+    # random() of the grass shaders for an array of points (count, 2), in single precision
+    st = numpy.asarray(st, dtype='f4')
+    value = numpy.sin(st @ numpy.array([12.9898, 78.233], dtype='f4')) * numpy.float32(43758.5453123)
+    return value - numpy.floor(value)
+
+
+def shader_fbm(st, octaves=3):
+    # fbm() of grass.geom (value noise, between 0 and 1) for an array of points (count, 2)
+    st = numpy.asarray(st, dtype='f4')
+    rotation = numpy.array([[math.cos(0.5), -math.sin(0.5)], [math.sin(0.5), math.cos(0.5)]], dtype='f4')
+    value = numpy.zeros(len(st), dtype='f4')
+    amplitude = 0.5
+    for _ in range(octaves):
+        i = numpy.floor(st)
+        f = st - i
+        a = shader_random(i)
+        b = shader_random(i + numpy.array([1.0, 0.0], dtype='f4'))
+        c = shader_random(i + numpy.array([0.0, 1.0], dtype='f4'))
+        d = shader_random(i + numpy.array([1.0, 1.0], dtype='f4'))
+        u = f * f * (3.0 - 2.0 * f)
+        value += amplitude * (a + (b - a) * u[:, 0] + (c - a) * u[:, 1] * (1.0 - u[:, 0]) + (d - b) * u[:, 0] * u[:, 1])
+        st = st @ rotation.T * 2.0 + 100.0
+        amplitude *= 0.5
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_height_levels(max_h, offset_h, r_factor, levels=256):
+    # Integer heights have a fixed number of levels, each with one rounded height; shared by all chunks of a terrain
+    return numpy.round(numpy.arange(levels) / (levels - 1) * max_h - offset_h, r_factor)
+
+
+def get_heights(samples, max_h, offset_h, r_factor):
+    # Height map samples to heights, integer samples go through their levels and float samples are from 0 to 1
+    samples = numpy.asarray(samples)
+    if samples.dtype.kind == 'f':
+        return numpy.round(samples.astype('f8') * max_h - offset_h, r_factor)
+    return get_height_levels(max_h, offset_h, r_factor, numpy.iinfo(samples.dtype).max + 1)[samples]
+
+
+def get_grid_indices(cells_w, cells_d):
+    # Two triangles per cell of a (cells_d + 1, cells_w + 1) vertex grid in row order, split like the terrain cells
+    first = (numpy.arange(cells_d)[:, None] * (cells_w + 1) + numpy.arange(cells_w)[None, :]).reshape(-1)
+    corners = numpy.stack([first + cells_w + 1, first + cells_w + 2, first + 1, first], axis=1)
+    return numpy.ascontiguousarray(corners[:, [0, 2, 3, 0, 1, 2]].reshape(-1), dtype='u4')
+
+
+def save_arrays(path, arrays):
+    # Arrays one after another as .npy records in one file, so each can be memory-mapped where it starts
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            for array in arrays:
+                numpy.lib.format.write_array(f, numpy.ascontiguousarray(array), allow_pickle=False)
+        # Written in full before it is visible, other threads and runs never read a partial file
+        os.replace(temp_path, path)
+    except OSError:
+        remove_file(temp_path)
+        raise
+
+
+def load_arrays(path, count):
+    # Memory-mapped (read only) views of the first count arrays of a file from save_arrays
+    arrays = []
+    with open(path, 'rb') as f:
+        for _ in range(count):
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            size = math.prod(shape) * dtype.itemsize
+            if size:
+                arrays.append(numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape))
+            else:
+                arrays.append(numpy.empty(shape, dtype=dtype))
+            f.seek(offset + size)
+    return arrays
+
+
+def remove_file(path):
+    # Delete a file if it is there, a file that cannot be deleted is left as it is
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def trim_files(path, max_size, prefix=''):
+    # Delete the least recently used files of a folder (oldest modification time first) that start with prefix,
+    # until those left add up to at most max_size bytes
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in files)
+    for _, size, file_path in sorted(files):
+        if total <= max_size:
+            break
+        remove_file(file_path)
+        total -= size
+
+
+def get_bounds(positions):
+    # Axis aligned bounding box as (centre, half extents)
+    positions = numpy.asarray(positions, dtype='f4').reshape(-1, 3)
+    b_min, b_max = positions.min(axis=0), positions.max(axis=0)
+    return (b_min + b_max) * 0.5, (b_max - b_min) * 0.5
+
+
+def transform_bounds(m_model, bounds):
+    # Box enclosing the transformed box, the extents are projected onto the world axes
+    m = numpy.array(m_model, dtype='f4')
+    center, extents = bounds
+    return m[:3, :3] @ center + m[:3, 3], numpy.abs(m[:3, :3]) @ extents
+
+
+def get_frustum_planes(m_proj_view):
+    # Left, right, bottom, top, near and far planes (a, b, c, d) taken from the rows of the matrix
+    m = numpy.array(m_proj_view, dtype='f4')
+    planes = numpy.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes / numpy.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def frustum_cull(planes, centers, extents):
+    # A box is visible unless it lies entirely behind one of the planes
+    distances = centers @ planes[:, :3].T + planes[:, 3] + extents @ numpy.abs(planes[:, :3]).T
+    return (distances >= 0.0).all(axis=1)
 
 
 class Camera:
@@ -45,6 +208,7 @@ class Camera:
     far = 100
     sensitivity = 0.1
     speed = 0.005
+    ground_clearance = 1.0  # Height kept above the terrain when the camera is not moving freely
 
     position = None
     up = glm.vec3(0, 1, 0)
@@ -61,9 +225,11 @@ class Camera:
         self.near = near
         self.far = far
         self.sensitivity = sensitivity
-        # View matrix
-        self.m_view = self.get_view_matrix()
-        # Aspect ratio and Projection matrix
+        # Matrices are only rebuilt when their inputs change, version counts the rebuilds
+        self.view_state = None
+        self.proj_state = None
+        self.version = 0
+        # Aspect ratio, View and Projection matrices
         self.set_aspect_and_projection()
         # Key bindings
         self.key_bindings = {
@@ -77,16 +243,13 @@ class Camera:
 
     def set_aspect_and_projection(self):
         self.aspect_ratio = self.app.win_size[0] / self.app.win_size[1]
-        self.m_proj = self.get_projection_matrix()
+        self.update_matrices()
 
     def rotate(self):
-        old_yaw, old_pitch = self.yaw, self.pitch
         rel_x, rel_y = pygame.mouse.get_rel()
         self.yaw += rel_x * self.sensitivity
         self.pitch -= rel_y * self.sensitivity
         self.pitch = max(-89, min(89, self.pitch))
-        if old_yaw != self.yaw or old_pitch != self.pitch:
-            self.app.scene.moved = True
 
     def update_camera_vectors(self):
         yaw, pitch = glm.radians(self.yaw), glm.radians(self.pitch)
@@ -97,14 +260,32 @@ class Camera:
         self.right = glm.normalize(glm.cross(self.forward, glm.vec3(0, 1, 0)))
         self.up = glm.normalize(glm.cross(self.right, self.forward))
 
-    def update(self):
-        self.move()
-        self.rotate()
-        self.update_camera_vectors()
-        self.m_view = self.get_view_matrix()
+    def update(self, user_input=True):
+        if user_input:
+            self.move()
+            self.rotate()
+        else:
+            # Drop the mouse motion, so it does not turn the camera once input is used again
+            pygame.mouse.get_rel()
+        self.update_matrices()
+
+    def update_matrices(self):
+        view_state = (self.position.x, self.position.y, self.position.z, self.yaw, self.pitch)
+        proj_state = (self.fov, self.aspect_ratio, self.near, self.far)
+        if view_state == self.view_state and proj_state == self.proj_state:
+            return
+        if view_state != self.view_state:
+            self.view_state = view_state
+            self.update_camera_vectors()
+            self.m_view = self.get_view_matrix()
+        if proj_state != self.proj_state:
+            self.proj_state = proj_state
+            self.m_proj = self.get_projection_matrix()
+        self.m_proj_view = self.m_proj * self.m_view
+        self.frustum_planes = get_frustum_planes(self.m_proj_view)
+        self.version += 1
 
     def move(self):
-        old_x, old_y, old_z = self.position.xyz
         self.velocity = self.speed * self.app.raw_delta_time
         keys = pygame.key.get_pressed()
         if keys[self.key_bindings["forward"]]:
@@ -119,8 +300,11 @@ class Camera:
             self.position += self.up * self.velocity
         if keys[self.key_bindings["down"]]:
             self.position -= self.up * self.velocity
-        if self.position.x != old_x or self.position.y != old_y or self.position.z != old_z:
-            self.app.scene.moved = True
+        if not self.app.free_move:
+            # Walk on the terrain instead of flying through it
+            ground = self.app.terrain.get_height(self.position.x, self.position.z)
+            if ground is not None:
+                self.position.y = max(self.position.y, ground + self.ground_clearance)
 
     def get_view_matrix(self):
         return glm.lookAt(self.position, self.position + self.forward, self.up)
@@ -198,14 +382,16 @@ class Shader():
         self.programs_count = -1
         self.programs_map = {}
 
-    def get_shader(self, shader_name, geometry=False):
+    def get_shader(self, shader_name, geometry=False, fragment_name=None):
         if shader_name in self.programs_map:
             # print(f"Reuse shader: {shader_name} at index: {self.programs_map[shader_name]}")
             return self.programs[self.programs_map[shader_name]]
 
+        # The fragment stage can come from another shader, e.g. a different way to place the same surface
+        fragment_name = fragment_name or shader_name
         with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.vert', 'r') as f:
             vertex_shader_source = f.read()
-        with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.frag', 'r') as f:
+        with open(f'{self.app.base_path}/{self.app.shader_path}/{fragment_name}.frag', 'r') as f:
             fragment_shader_source = f.read()
 
         if geometry is True:
@@ -227,12 +413,30 @@ class Shader():
         print(f"loaded shader: {shader_name} at index: {self.programs_count}")
         return shader_program
 
+    def get_compute_shader(self, shader_name):
+        if shader_name in self.programs_map:
+            return self.programs[self.programs_map[shader_name]]
+
+        with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.comp', 'r') as f:
+            compute_shader_source = f.read()
+        shader_program = self.ctx.compute_shader(compute_shader_source)
+        self.programs_count += 1
+        self.programs_map[shader_name] = self.programs_count
+        self.programs.append(shader_program)
+        print(f"loaded compute shader: {shader_name} at index: {self.programs_count}")
+        return shader_program
+
     def destroy(self):
         for program in self.programs:
             program.release()
 
 
 class Texture:
+    # Raw height maps, little-endian and square: R16 and R32F (from 0 to 1)
+    height_map_formats = {'.r16': '<u2', '.r32': '<f4'}
+    # Height samples to texture types, see get_height_tiles
+    height_texture_dtypes = {'u1': 'f1', 'u2': 'nu2', 'f4': 'f4'}
+
     def __init__(self, app):
         self.app = app
         self.ctx = app.ctx
@@ -280,6 +484,53 @@ class Texture:
         print(f"loaded depth texture: {name} at index: {self.texture_count}")
         return self.texture_count
 
+    def get_height_tiles(self, size, layers, dtype, name='height_tiles'):
+        '''Single channel texture array of square height tiles, one per layer, sampled with texelFetch.
+
+        8 and 16-bit samples are normalized and float samples kept, so they all read from 0 to 1.
+        A texture of that name with too few layers is replaced by a larger one, keeping its tiles.
+        '''
+        old_texture = None
+        if name in self.texture_map:
+            old_texture = self.textures[self.texture_map[name]]
+            if old_texture.size[2] >= layers:
+                return self.texture_map[name]
+        height_texture = self.ctx.texture_array(size=(size, size, layers), components=1, alignment=1,
+                                                dtype=self.height_texture_dtypes[numpy.dtype(dtype).str[1:]])
+        height_texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        height_texture.repeat_x = False
+        height_texture.repeat_y = False
+        if old_texture is not None:
+            height_texture.write(old_texture.read(alignment=1), viewport=(0, 0, 0, *old_texture.size), alignment=1)
+            old_texture.release()
+            self.textures[self.texture_map[name]] = height_texture
+            print(f"resized height tiles: {name} to {layers} layers")
+            return self.texture_map[name]
+        # Add to list
+        self.texture_count += 1
+        self.texture_map[name] = self.texture_count
+        self.textures.append(height_texture)
+        print(f"loaded height tiles: {name} at index: {self.texture_count}")
+        return self.texture_count
+
+    def get_color_texture(self, size, name='color_texture', samples=None, disable_repeat=False):
+        if name in self.texture_map:
+            return self.texture_map[name]
+        if samples == None:
+            color_texture = self.ctx.texture(size=size, components=4)
+        else:
+            color_texture = self.ctx.texture(size=size, components=4, samples=samples)
+        # Remove repetition
+        if disable_repeat:
+            color_texture.repeat_x = False
+            color_texture.repeat_y = False
+        # Add to list
+        self.texture_count += 1
+        self.texture_map[name] = self.texture_count
+        self.textures.append(color_texture)
+        print(f"loaded color texture: {name} at index: {self.texture_count}")
+        return self.texture_count
+
     def get_alpha_texture(self, path):
         if path in self.texture_map:
             return self.texture_map[path]
@@ -324,6 +575,26 @@ class Texture:
         image = pygame.surfarray.array3d(image)  # Convert image to numpy array
         return image, width, height
 
+    def get_height_map(self, path):
+        '''Return height map samples (depth, width), indexed [z][x], and the size for a height map file.
+
+        Raw files (see tools/height_map_to_raw.py) are memory-mapped, so only the samples that are
+        read are paged in; edits stay in memory. Other images are decoded whole, first channel only.
+        A path without an extension is a PNG image.
+        '''
+        ext = os.path.splitext(path)[1]
+        if not ext:
+            path, ext = f'{path}.png', '.png'
+        if ext not in self.height_map_formats:
+            image, width, height = self.get_image_data(path)
+            return numpy.ascontiguousarray(image[:, :, 0]), width, height
+        samples = numpy.memmap(path, dtype=self.height_map_formats[ext], mode='c')
+        size = math.isqrt(samples.size)
+        if size * size != samples.size:
+            raise ValueError(f"raw height map must be square: {path}")
+        # Rows are stored top to bottom like the image, so view them the way get_image_data lays an image out
+        return samples.reshape(size, size)[::-1].T, size, size
+
     def random_quad(self):
         '''Return random texture coordinates for a quad.'''
         rand_int = numpy.random.randint(4)
@@ -350,6 +621,15 @@ class Texture:
             texture_coords.append((1, 1))
         return texture_coords
 
+    def random_quads(self, count, rng=None):
+        '''Return random texture coordinates for count quads, like random_quad, as an array (count, 4, 2).
+
+        With a numpy Generator as rng the quads are drawn from it, so they can be seeded.
+        '''
+        corners = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1)])
+        rand_ints = numpy.random.randint(4, size=count) if rng is None else rng.integers(4, size=count)
+        return corners[(rand_ints[:, None] + numpy.arange(4)) % 4]
+
     def get_texture_cube(self, path, ext='png'):
         faces = ['right', 'left', 'top', 'bottom'] + ['front', 'back'][::-1]
         textures = []
@@ -378,19 +658,35 @@ class Texture:
 
 
 class Shadow():
-    def __init__(self, app, name="depth_texture", depth_size=[4096, 4096]):
+    '''Cascaded shadow maps for the global light.
+
+    The camera frustum is split in depth into cascades, the first ones covering the nearest slices. Each cascade
+    renders the casters through an orthographic projection fitted around its slice into its own column of one
+    depth texture, so the texels are spent where the camera looks instead of over the whole light view.
+    '''
+    split_lambda = 0.75  # Blend of logarithmic (1) and uniform (0) cascade splits
+    distance = 100.0  # Furthest view depth that receives shadows, the camera far plane if that is nearer
+    caster_margin = 50.0  # Extends each cascade towards the light, for casters outside its slice
+
+    def __init__(self, app, name="depth_texture", cascades=4, depth_size=1024):
         self.app = app
         self.ctx = app.ctx
-
-        print(f"shadow depth texture: {depth_size}")
+        if not 1 <= cascades <= UniformBuffers.max_cascades:
+            raise ValueError(f"shadow cascades must be from 1 to {UniformBuffers.max_cascades}: {cascades}")
+        self.cascades = cascades
+        self.depth_size = depth_size
+
+        # One column of the depth texture per cascade
+        size = (depth_size * cascades, depth_size)
+        print(f"shadow depth texture: {size}, {cascades} cascades")
         # Assuming the depth buffer is a single float (4 bytes)
-        # for 4096x it is 16,777,216 pixels × 4 bytes/pixel = 67,108,864 bytes
-        # or 67,108,864 bytes ÷ (1024 × 1024) = 64 MB.
+        # for 4 cascades of 1024x it is 4,194,304 pixels × 4 bytes/pixel = 16,777,216 bytes
+        # or 16 MB, where the single 4096x map was 64 MB.
 
         # Using a texture here not a renderbuffer because we pass it to the shader
-        self.depth_tex_id = self.app.texture.get_depth_texture(depth_size, name, disable_repeat=True)
+        self.depth_tex_id = self.app.texture.get_depth_texture(size, name, disable_repeat=True)
         self.depth_texture = self.app.texture.textures[self.depth_tex_id]
-        # self.depth_buffer = self.ctx.depth_renderbuffer(size=depth_size)
+        # self.depth_buffer = self.ctx.depth_renderbuffer(size=size)
 
         self.depth_fbo = self.ctx.framebuffer(depth_attachment=self.depth_texture)
         # self.depth_fbo = self.ctx.framebuffer(depth_attachment=self.depth_buffer)
@@ -399,12 +695,176 @@ class Shadow():
         self.shader_program = app.shader.get_shader("default")
         self.shader_program['shadow_map_tex'] = self.depth_tex_id
         self.app.texture.textures[self.depth_tex_id].use(location=self.depth_tex_id)
+        self.shadow_program = app.shader.get_shader("shadow")
+
+        # Per cascade, rebuilt only when the camera or the global light has moved
+        self.state = None
+        self.version = 0
+        self.splits = [0.0] * cascades  # View depth where each cascade ends
+        self.m_light_proj_view = [mat_4] * cascades  # World to light clip space
+        self.m_shadow = [mat_4] * cascades  # World to shadow map coordinates, in the column of the cascade
+
+    def get_splits(self, near, far):
+        # Practical split scheme, logarithmic splits near the camera blended with uniform splits further away
+        splits = []
+        for i in range(1, self.cascades + 1):
+            f = i / self.cascades
+            log_split = near * (far / near) ** f
+            uniform_split = near + (far - near) * f
+            splits.append(self.split_lambda * log_split + (1.0 - self.split_lambda) * uniform_split)
+        return splits
+
+    def update(self):
+        camera = self.app.camera
+        m_view_light = self.app.global_light.m_view_light
+        state = (camera.version, m_view_light)
+        if state == self.state:
+            return
+        self.state = state
+        self.version += 1
+
+        near = camera.near
+        far = min(camera.far, self.distance)
+        self.splits = self.get_splits(near, far)
+        tan_y = math.tan(math.radians(camera.fov) * 0.5)
+        tan_x = tan_y * camera.aspect_ratio
+        texel_scale = 0.5 / self.cascades
+        for i, split in enumerate(self.splits):
+            # Bounding sphere of the frustum slice, its radius does not change as the camera turns
+            corners = [camera.position + camera.forward * d + camera.right * (x * tan_x * d)
+                       + camera.up * (y * tan_y * d) for d in (near, split) for x in (-1, 1) for y in (-1, 1)]
+            centre = sum(corners, glm.vec3(0)) / 8.0
+            radius = max(glm.length(corner - centre) for corner in corners)
+            radius = math.ceil(radius * 16.0) / 16.0
+            # Snap the centre in light space to whole texels, so the shadows do not shimmer as the camera moves
+            texel = 2.0 * radius / self.depth_size
+            centre = m_view_light * centre
+            x = math.floor(centre.x / texel) * texel
+            y = math.floor(centre.y / texel) * texel
+            m_proj = glm.ortho(x - radius, x + radius, y - radius, y + radius,
+                               -centre.z - radius - self.caster_margin, -centre.z + radius)
+            self.m_light_proj_view[i] = m_proj * m_view_light
+            # Clip space [-1, 1] to the [0, 1] texture space of the column of this cascade
+            m_bias = glm.mat4(texel_scale, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0,
+                              (i + 0.5) / self.cascades, 0.5, 0.5, 1.0)
+            self.m_shadow[i] = m_bias * self.m_light_proj_view[i]
+            near = split
+
+    def render(self, casters):
+        # Each cascade draws its casters into its own column of the depth texture
+        size = self.depth_size
+        self.depth_fbo.viewport = (0, 0, size * self.cascades, size)
+        self.depth_fbo.clear()
+        draw_calls = 0
+        for i, objects in enumerate(casters):
+            self.depth_fbo.viewport = (i * size, 0, size, size)
+            self.depth_fbo.use()
+            self.shadow_program['m_light_proj_view'].write(self.m_light_proj_view[i])
+            for obj in objects:
+                obj.render_shadow()
+            draw_calls += len(objects)
+        return draw_calls
 
     def destroy(self):
         self.depth_fbo.release()
         self.depth_texture.release()
 
 
+class UniformBuffers():
+    # std140 uniform blocks shared by every program, the bindings match layout (binding = n) in the shaders
+    camera_binding = 0
+    lights_binding = 1
+    debug_binding = 2
+    shadows_binding = 3
+    max_lights = 99  # Same as max_lights in the shaders
+    max_cascades = 4  # Same as max_cascades in the shaders
+
+    def __init__(self, app):
+        self.app = app
+        self.ctx = app.ctx
+        self.camera_version = -1
+        self.shadow_version = -1
+        self.debug_state = None
+
+        # Camera: m_proj, m_proj_view and cam_pos
+        self.camera_data = numpy.zeros(36, dtype='f4')
+        # Lights: global_light, flash_light, num_lights and lights[max_lights] (each point light is 8 floats)
+        self.lights_data = numpy.zeros(32 + 8 * self.max_lights, dtype='f4')
+        # Debug: texture_blend and local_light_blend
+        self.debug_data = numpy.zeros(4, dtype='f4')
+        # Shadows: m_shadow[max_cascades], cascade_splits and shadow_forward (camera forward and cascade count)
+        self.shadows_data = numpy.zeros(16 * self.max_cascades + 8, dtype='f4')
+
+        self.camera_ubo = self.ctx.buffer(reserve=self.camera_data.nbytes)
+        self.lights_ubo = self.ctx.buffer(reserve=self.lights_data.nbytes)
+        self.debug_ubo = self.ctx.buffer(reserve=self.debug_data.nbytes)
+        self.shadows_ubo = self.ctx.buffer(reserve=self.shadows_data.nbytes)
+        self.camera_ubo.bind_to_uniform_block(self.camera_binding)
+        self.lights_ubo.bind_to_uniform_block(self.lights_binding)
+        self.debug_ubo.bind_to_uniform_block(self.debug_binding)
+        self.shadows_ubo.bind_to_uniform_block(self.shadows_binding)
+
+    def update(self):
+        camera = self.app.camera
+        global_light = self.app.global_light
+        flash_light = self.app.flash_light
+
+        # Camera, only when the camera has moved
+        if self.camera_version != camera.version:
+            self.camera_version = camera.version
+            data = self.camera_data
+            data[0:16] = numpy.frombuffer(camera.m_proj.to_bytes(), dtype='f4')
+            data[16:32] = numpy.frombuffer(camera.m_proj_view.to_bytes(), dtype='f4')
+            data[32:35] = camera.position
+            self.camera_ubo.write(data)
+
+        # Shadow cascades, only when the camera or the global light has moved
+        shadow = self.app.shadow
+        if self.shadow_version != shadow.version:
+            self.shadow_version = shadow.version
+            data = self.shadows_data
+            for i, m_shadow in enumerate(shadow.m_shadow):
+                data[i * 16:i * 16 + 16] = numpy.frombuffer(m_shadow.to_bytes(), dtype='f4')
+            offset = 16 * self.max_cascades
+            data[offset:offset + shadow.cascades] = shadow.splits
+            data[offset + 4:offset + 7] = camera.forward
+            data[offset + 7] = shadow.cascades
+            self.shadows_ubo.write(data)
+
+        # Lights, every frame as the global light rotates and the flash light follows the camera
+        data = self.lights_data
+        data[0:3] = global_light.position
+        data[4:7] = global_light.direction
+        data[8:11] = global_light.color
+        data[11] = global_light.strength
+        data[12:15] = flash_light.position
+        data[16:19] = flash_light.direction
+        data[20:23] = flash_light.color
+        data[23] = flash_light.strength
+        data[24] = flash_light.cutoff
+        data[25] = flash_light.softness
+        data[28] = len(self.app.lights)
+        for i, light in enumerate(self.app.lights):
+            offset = 32 + i * 8
+            data[offset:offset + 3] = light.position
+            data[offset + 4:offset + 7] = light.color
+            data[offset + 7] = light.strength
+        self.lights_ubo.write(data[:32 + 8 * len(self.app.lights)])
+
+        # Debug, only when toggled
+        debug_state = (self.app.texture_blend, self.app.local_light)
+        if self.debug_state != debug_state:
+            self.debug_state = debug_state
+            self.debug_data[0:2] = debug_state
+            self.debug_ubo.write(self.debug_data)
+
+    def destroy(self):
+        self.camera_ubo.release()
+        self.lights_ubo.release()
+        self.debug_ubo.release()
+        self.shadows_ubo.release()
+
+
 class Prototype:
     def __init__(self, app):
         self.app = app
@@ -429,6 +889,8 @@ class Prototype:
             base_object = PrototypeGrass(app=self.app)  # Not 100% settled on this design
         elif name == "ground":
             base_object = PrototypeGround(app=self.app)
+        elif name == "height_map_ground":
+            base_object = PrototypeHeightMapGround(app=self.app)
 
         # Add to list
         self.object_count += 1
@@ -438,117 +900,8 @@ class Prototype:
         return base_object
 
     def common_render_update(self):
-        # Default shader #
-        shader_program = self.app.shader.get_shader('default')
-        # Resolution
-        # shader_program['u_resolution'].write(glm.vec2(self.app.win_size))
-
-        # Position
-        shader_program['cam_pos'].write(self.app.camera.position)
-        shader_program['m_proj'].write(self.app.camera.m_proj)
-        shader_program['m_view'].write(self.app.camera.m_view)
-
-        # Send lights into uniform array of Light struct
-        shader_program['num_lights'].value = len(self.app.lights)
-        for i, light in enumerate(self.app.lights):
-            shader_program[f'lights[{i}].position'].value = light.position
-            shader_program[f'lights[{i}].color'].value = light.color
-            shader_program[f'lights[{i}].strength'].value = light.strength
-
-        # Send global_light from self.global_light
-        shader_program['m_view_global_light'].write(self.app.global_light.m_view_light)
-        shader_program['global_light.position'].value = self.app.global_light.position
-        shader_program['global_light.direction'].value = self.app.global_light.direction
-        shader_program['global_light.color'].value = self.app.global_light.color
-        shader_program['global_light.strength'].value = self.app.global_light.strength
-
-        # Send flash_light from self.flash_light
-        shader_program['flash_light.position'].value = self.app.flash_light.position
-        shader_program['flash_light.color'].value = self.app.flash_light.color
-        shader_program['flash_light.strength'].value = self.app.flash_light.strength
-        shader_program['flash_light.cutoff'].value = self.app.flash_light.cutoff
-        shader_program['flash_light.direction'].value = self.app.flash_light.direction
-        shader_program['flash_light.softness'].value = self.app.flash_light.softness
-
-        # Shadow Shader #
-        shadow_program = self.app.shader.get_shader('shadow')
-        shadow_program['m_proj'].write(self.app.camera.m_proj)
-        shadow_program['m_view_light'].write(self.app.global_light.m_view_light)
-
-        # Debug
-        shader_program["texture_blend"].value = self.app.texture_blend
-        shader_program["local_light_blend"].value = self.app.local_light
-
-        # Debug Light
-        light_program = self.app.shader.get_shader('light')
-        light_program['m_proj'].write(self.app.camera.m_proj)
-        light_program['m_view'].write(self.app.camera.m_view)
-
-        # Grass shader #
-        grass_program = self.app.shader.get_shader('grass')
-        # Position
-        grass_program['m_proj'].write(self.app.camera.m_proj)
-        grass_program['m_view'].write(self.app.camera.m_view)
-        grass_program['cam_pos'].write(self.app.camera.position)
-
-        # Send lights into uniform array of Light struct
-        grass_program['num_lights'].value = len(self.app.lights)
-        for i, light in enumerate(self.app.lights):
-            grass_program[f'lights[{i}].position'].value = light.position
-            grass_program[f'lights[{i}].color'].value = light.color
-            grass_program[f'lights[{i}].strength'].value = light.strength
-
-        # Send global_light from self.global_light
-        grass_program['m_view_global_light'].write(self.app.global_light.m_view_light)
-        grass_program['global_light.position'].value = self.app.global_light.position
-        grass_program['global_light.direction'].value = self.app.global_light.direction
-        grass_program['global_light.color'].value = self.app.global_light.color
-        grass_program['global_light.strength'].value = self.app.global_light.strength
-
-        # Send flash_light from self.flash_light
-        grass_program['flash_light.position'].value = self.app.flash_light.position
-        grass_program['flash_light.color'].value = self.app.flash_light.color
-        grass_program['flash_light.strength'].value = self.app.flash_light.strength
-        grass_program['flash_light.cutoff'].value = self.app.flash_light.cutoff
-        grass_program['flash_light.direction'].value = self.app.flash_light.direction
-        grass_program['flash_light.softness'].value = self.app.flash_light.softness
-
-        # Debug
-        grass_program["texture_blend"].value = self.app.texture_blend
-        grass_program["local_light_blend"].value = self.app.local_light
-
-        # Ground shader #
-        ground_program = self.app.shader.get_shader('ground')
-        # Position
-        ground_program['cam_pos'].write(self.app.camera.position)
-        ground_program['m_proj'].write(self.app.camera.m_proj)
-        ground_program['m_view'].write(self.app.camera.m_view)
-
-        # Send lights into uniform array of Light struct
-        ground_program['num_lights'].value = len(self.app.lights)
-        for i, light in enumerate(self.app.lights):
-            ground_program[f'lights[{i}].position'].value = light.position
-            ground_program[f'lights[{i}].color'].value = light.color
-            ground_program[f'lights[{i}].strength'].value = light.strength
-
-        # Send global_light from self.global_light
-        ground_program['m_view_global_light'].write(self.app.global_light.m_view_light)
-        ground_program['global_light.position'].value = self.app.global_light.position
-        ground_program['global_light.direction'].value = self.app.global_light.direction
-        ground_program['global_light.color'].value = self.app.global_light.color
-        ground_program['global_light.strength'].value = self.app.global_light.strength
-
-        # Send flash_light from self.flash_light
-        ground_program['flash_light.position'].value = self.app.flash_light.position
-        ground_program['flash_light.color'].value = self.app.flash_light.color
-        ground_program['flash_light.strength'].value = self.app.flash_light.strength
-        ground_program['flash_light.cutoff'].value = self.app.flash_light.cutoff
-        ground_program['flash_light.direction'].value = self.app.flash_light.direction
-        ground_program['flash_light.softness'].value = self.app.flash_light.softness
-
-        # Debug
-        ground_program["texture_blend"].value = self.app.texture_blend
-        ground_program["local_light_blend"].value = self.app.local_light
+        # Camera, lights and debug state reach every program through the shared uniform buffers
+        self.app.uniform_buffers.update()
 
     def destroy(self):
         for obj in self.objects:
@@ -571,17 +924,18 @@ class PrototypeCube:
         self.vao.release()
         self.shadow_vao.release()
         self.vbo.release()
+        self.ibo.release()
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_shadow_vao(self, vbo, shadow_program):
         vao = self.ctx.vertex_array(shadow_program, [
             (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ], skip_errors=True)
+        ], index_buffer=self.ibo, index_element_size=4, skip_errors=True)
         # Temporary fix for the issue with the shadow program because we are not using texture coordinates
         # So we set skip_errors=True to ignore the missing in_texcoord_0 attribute
         return vao
@@ -634,7 +988,11 @@ class PrototypeCube:
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        # Identical vertices are welded, the faces share them through the index buffer
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.bounds = get_bounds(vertex_data[:, 2:5])
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 class PrototypeLightSource():
@@ -649,11 +1007,12 @@ class PrototypeLightSource():
     def destroy(self):
         self.vao.release()
         self.vbo.release()
+        self.ibo.release()
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '3f', 'in_position'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_vertex_data(self):
@@ -679,7 +1038,9 @@ class PrototypeLightSource():
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 def generate_vertex_data(vertices, indices):
@@ -699,6 +1060,7 @@ class Cube:
         self.position = glm.scale(self.position, glm.vec3(scale))
         self.can_update = can_update
         self.can_render = True
+        self.can_render_shadow = True
         self.has_shadow = True
 
         self.albedo = glm.vec3(albedo)
@@ -707,6 +1069,7 @@ class Cube:
 
         this_object = self.app.prototype.get_object(name)
         self.vao = this_object.vao
+        self.bounds = this_object.bounds
         self.shadow_vao = this_object.shadow_vao
         self.shader_program = this_object.shader_program
         self.shadow_program = this_object.shadow_program
@@ -714,22 +1077,34 @@ class Cube:
         self.tex_id = app.texture.get_texture(path=f'../textures/{texture}.png')
         self.m_model = self.position
 
+        # Render queue state keys
+        self.transparent = False
+        self.textures = (self.tex_id,)
+        self.material = (*self.albedo, self.roughness, self.metallic)
+
     def update(self):
         self.m_model = glm.rotate(self.position, self.app.time, glm.vec3(0, 1, 0))
 
-    def render(self):
-        # Texture
+    def bind_textures(self):
         self.shader_program['u_tex_albedo'] = self.tex_id
         self.app.texture.textures[self.tex_id].use(location=self.tex_id)
-        # Position
-        self.shader_program['m_model'].write(self.m_model)
-        # Material
+
+    def bind_material(self):
         self.shader_program['material.a'].value = self.albedo
         self.shader_program['material.d'].value = self.roughness
         self.shader_program['material.s'].value = self.metallic
+
+    def draw(self):
+        # Position
+        self.shader_program['m_model'].write(self.m_model)
         # Render
         self.vao.render()
 
+    def render(self):
+        self.bind_textures()
+        self.bind_material()
+        self.draw()
+
     def render_shadow(self):
         self.shadow_program['m_model'].write(self.m_model)
         self.shadow_vao.render()
@@ -768,7 +1143,330 @@ class LightSource:
         self.vao.render()
 
 
+class HeightPyramid:
+    '''Min/max quadtree over the cells of a height map, for terrain bounds and ray queries.
+
+    Level 0 holds the lowest and highest sample of each cell (its four corners), every next level
+    those of 2x2 nodes of the level below, up to one node over the whole map. Samples are kept as
+    they are in the height map and turned into world heights when read, like the terrain meshes.
+    Node (i, j) of level k covers the cells from (i, j) * 2 ** k, so a chunk is one node of the
+    level log2(chunk_size).
+
+    Only the levels from tile_level up, one node per tile of 2 ** tile_level cells and larger, are
+    kept for the whole map. They are built one band of tiles at a time, so the samples are never
+    all in memory, and with a cache_file they are saved and loaded on later runs instead. The levels
+    below are built per tile the first time they are needed (e.g. when its chunk is generated, or
+    a ray passes through it), and only the max_tiles most recently used tiles are kept.
+    '''
+    def __init__(self, height_map, centre, max_height=100.0, base_height=0.0, rounding_factor=6, scale=1.0,
+                 tile_level=4, max_tiles=256, cache_file=None):
+        self.height_map = height_map
+        self.centre = centre
+        self.max_height = max_height
+        self.base_height = base_height
+        self.rounding_factor = rounding_factor
+        self.scale = scale
+        # The ray queries read heights one at a time, so those of integer samples are looked up in a list
+        self.levels = None
+        if height_map.dtype.kind != 'f':
+            self.levels = get_height_levels(max_height, base_height, rounding_factor,
+                                            numpy.iinfo(height_map.dtype).max + 1).tolist()
+        self.cells_d, self.cells_w = height_map.shape[0] - 1, height_map.shape[1] - 1
+        # Nodes (depth, width) of every level
+        self.shapes = [(self.cells_d, self.cells_w)]
+        while self.shapes[-1] != (1, 1):
+            d, w = self.shapes[-1]
+            self.shapes.append(((d + 1) // 2, (w + 1) // 2))
+        self.tile_level = min(tile_level, len(self.shapes) - 1)
+        self.tile_size = 2 ** self.tile_level
+        self.max_tiles = max_tiles
+        # Levels from tile_level up, those below it are in the tiles
+        self.mins = [None] * len(self.shapes)
+        self.maxs = [None] * len(self.shapes)
+        # Tile (i, j) to the (mins, maxs) of its levels below tile_level, least recently used first; the
+        # workers build them too, the version tells them an edit came in while they were reading samples
+        self.tiles = OrderedDict()
+        self.tiles_lock = threading.Lock()
+        self.version = 0
+        if cache_file is None or not self.load_cache(cache_file):
+            self.build_tile_level()
+            if cache_file is not None:
+                self.save_cache(cache_file)
+        self.build_levels(self.tile_level + 1, 0, self.shapes[self.tile_level][1], 0, self.shapes[self.tile_level][0])
+
+    @staticmethod
+    def reduce_level(children, combine):
+        # Nodes over 2x2 children (depth, width), an odd last row or column is its own pair
+        children = numpy.pad(children, ((0, children.shape[0] % 2), (0, children.shape[1] % 2)), mode='edge')
+        return functools.reduce(combine, [children[dz::2, dx::2] for dz in (0, 1) for dx in (0, 1)])
+
+    def build_tile_level(self):
+        # Each tile takes the extremes of its samples, its edges included, read one band of tiles at a time
+        size = self.tile_size
+        shape = self.shapes[self.tile_level]
+        self.mins[self.tile_level] = numpy.empty(shape, dtype=self.height_map.dtype)
+        self.maxs[self.tile_level] = numpy.empty(shape, dtype=self.height_map.dtype)
+        starts = numpy.arange(shape[1]) * size
+        ends = numpy.minimum(starts + size, self.cells_w)
+        for j in range(shape[0]):
+            band = numpy.asarray(self.height_map[j * size:min((j + 1) * size, self.cells_d) + 1])
+            for nodes, combine, columns in ((self.mins, numpy.minimum, band.min(axis=0)),
+                                            (self.maxs, numpy.maximum, band.max(axis=0))):
+                nodes[self.tile_level][j] = combine(combine.reduceat(columns, starts), columns[ends])
+
+    def build_levels(self, level, x0, x1, z0, z1):
+        # Nodes from level up over the nodes [z0:z1, x0:x1] of the level below
+        for level in range(level, len(self.shapes)):
+            x0, x1, z0, z1 = x0 // 2, (x1 + 1) // 2, z0 // 2, (z1 + 1) // 2
+            for nodes, combine in ((self.mins, numpy.minimum), (self.maxs, numpy.maximum)):
+                if nodes[level] is None:
+                    nodes[level] = numpy.empty(self.shapes[level], dtype=self.height_map.dtype)
+                nodes[level][z0:z1, x0:x1] = self.reduce_level(nodes[level - 1][z0 * 2:z1 * 2, x0 * 2:x1 * 2],
+                                                               combine)
+
+    def load_cache(self, cache_file):
+        # Tile level saved by an earlier run, False when there is no usable file
+        try:
+            mins, maxs = load_arrays(cache_file, 2)
+            os.utime(cache_file)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        except (OSError, ValueError) as error:
+            print(f"height pyramid cache: can't read {cache_file}, building it again: {error}")
+            remove_file(cache_file)
+            return False
+        shape = self.shapes[self.tile_level]
+        if mins.shape != shape or maxs.shape != shape or mins.dtype != self.height_map.dtype:
+            return False
+        self.mins[self.tile_level] = numpy.array(mins)
+        self.maxs[self.tile_level] = numpy.array(maxs)
+        return True
+
+    def save_cache(self, cache_file):
+        try:
+            os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+            save_arrays(cache_file, [self.mins[self.tile_level], self.maxs[self.tile_level]])
+        except OSError as error:
+            print(f"height pyramid cache: can't write {cache_file}: {error}")
+
+    def get_tile(self, i, j):
+        '''Lists (mins, maxs) of the levels below tile_level of tile (i, j), built the first time they are needed.'''
+        with self.tiles_lock:
+            if (i, j) in self.tiles:
+                self.tiles.move_to_end((i, j))
+                return self.tiles[(i, j)]
+            version = self.version
+        size = self.tile_size
+        x0, z0 = i * size, j * size
+        x1, z1 = min(x0 + size, self.cells_w), min(z0 + size, self.cells_d)
+        samples = numpy.asarray(self.height_map[z0:z1 + 1, x0:x1 + 1])
+        corners = [samples[dz:dz + z1 - z0, dx:dx + x1 - x0] for dz in (0, 1) for dx in (0, 1)]
+        mins = [functools.reduce(numpy.minimum, corners)]
+        maxs = [functools.reduce(numpy.maximum, corners)]
+        for _ in range(1, self.tile_level):
+            mins.append(self.reduce_level(mins[-1], numpy.minimum))
+            maxs.append(self.reduce_level(maxs[-1], numpy.maximum))
+        with self.tiles_lock:
+            if version == self.version:
+                self.tiles[(i, j)] = (mins, maxs)
+                while len(self.tiles) > self.max_tiles:
+                    self.tiles.popitem(last=False)
+        return mins, maxs
+
+    def get_node(self, level, i, j):
+        # Lowest and highest sample of node (i, j) of a level
+        if level >= self.tile_level:
+            return self.mins[level][j, i], self.maxs[level][j, i]
+        shift = self.tile_level - level
+        mins, maxs = self.get_tile(i >> shift, j >> shift)
+        i, j = i & ((1 << shift) - 1), j & ((1 << shift) - 1)
+        return mins[level][j, i], maxs[level][j, i]
+
+    def update(self, x, z, width, depth):
+        '''Build the nodes again over the samples from (x, z), of size (width, depth), e.g. after an edit.'''
+        # Cells share their edge samples, so the cells just before the area are touched too
+        size = self.tile_size
+        i0, i1 = max(x - 1, 0) // size, (min(x + width, self.cells_w) - 1) // size + 1
+        j0, j1 = max(z - 1, 0) // size, (min(z + depth, self.cells_d) - 1) // size + 1
+        with self.tiles_lock:
+            self.version += 1
+            for key in [key for key in self.tiles if i0 <= key[0] < i1 and j0 <= key[1] < j1]:
+                del self.tiles[key]
+        for j in range(j0, j1):
+            for i in range(i0, i1):
+                samples = self.height_map[j * size:min((j + 1) * size, self.cells_d) + 1,
+                                          i * size:min((i + 1) * size, self.cells_w) + 1]
+                self.mins[self.tile_level][j, i] = samples.min()
+                self.maxs[self.tile_level][j, i] = samples.max()
+        self.build_levels(self.tile_level + 1, i0, i1, j0, j1)
+
+    def get_heights(self, samples):
+        return get_heights(samples, self.max_height, self.base_height, self.rounding_factor)
+
+    def get_height_of(self, sample):
+        if self.levels is not None:
+            return self.levels[sample]
+        return round(float(sample) * self.max_height - self.base_height, self.rounding_factor)
+
+    def get_cell_heights(self, i, j):
+        # Heights of the corners (i, j), (i + 1, j), (i, j + 1) and (i + 1, j + 1) of a cell
+        samples = self.height_map
+        return (self.get_height_of(samples[j, i]), self.get_height_of(samples[j, i + 1]),
+                self.get_height_of(samples[j + 1, i]), self.get_height_of(samples[j + 1, i + 1]))
+
+    def get_position(self, x, z):
+        # World xz of height map sample (x, z), as the terrain meshes place it
+        return (x - self.centre[0] + 0.5) * self.scale, (z - self.centre[1] + 0.5) * self.scale
+
+    def get_bounds(self, level, nodes):
+        '''Bounds (centres, half extents) of the nodes [(i, j), ...] of a level, as arrays (count, 3).'''
+        nodes = numpy.asarray(nodes, dtype=int).reshape(-1, 2)
+        size = 2 ** level
+        x0, z0 = nodes[:, 0] * size, nodes[:, 1] * size
+        x1, z1 = numpy.minimum(x0 + size, self.cells_w), numpy.minimum(z0 + size, self.cells_d)
+        if level >= self.tile_level:
+            mins, maxs = self.mins[level][nodes[:, 1], nodes[:, 0]], self.maxs[level][nodes[:, 1], nodes[:, 0]]
+        else:
+            mins, maxs = numpy.array([self.get_node(level, i, j) for i, j in nodes.tolist()],
+                                     dtype=self.height_map.dtype).reshape(-1, 2).T
+        b_min = numpy.stack([*self.get_position(x0, z0), self.get_heights(mins)], axis=1)[:, [0, 2, 1]]
+        b_max = numpy.stack([*self.get_position(x1, z1), self.get_heights(maxs)], axis=1)[:, [0, 2, 1]]
+        return ((b_min + b_max) * 0.5).astype('f4'), ((b_max - b_min) * 0.5).astype('f4')
+
+    def get_height(self, x, z):
+        '''Height of the full resolution ground mesh at world (x, z), or None off the height map.'''
+        x = x / self.scale + self.centre[0] - 0.5
+        z = z / self.scale + self.centre[1] - 0.5
+        i, j = math.floor(x), math.floor(z)
+        if not (0 <= i < self.cells_w and 0 <= j < self.cells_d):
+            return None
+        u, w = x - i, z - j
+        h3, h2, h0, h1 = self.get_cell_heights(i, j)
+        # The cells are split along their (0, 1) to (1, 0) diagonal, like the meshes
+        if u + w <= 1.0:
+            return h3 + u * (h2 - h3) + w * (h0 - h3)
+        return h1 + (1.0 - u) * (h0 - h1) + (1.0 - w) * (h2 - h1)
+
+    def raycast(self, origin, direction, max_distance=math.inf):
+        '''Distance along a ray to the first hit on the full resolution ground mesh, or None.
+
+        Nodes are opened nearest first, and only those whose bounds the ray enters, so only the
+        cells along the ray are read. Distances are in lengths of direction, so a segment from a to b
+        is the ray (a, b - a) up to 1.
+        '''
+        origin, direction = tuple(glm.vec3(origin)), tuple(glm.vec3(direction))
+        top = len(self.shapes) - 1
+        distance = self.intersect_node(origin, direction, top, 0, 0, max_distance)
+        heap = [] if distance is None else [(distance, top, 0, 0)]
+        hit = None
+        while heap:
+            distance, level, i, j = heapq.heappop(heap)
+            if hit is not None and distance > hit:
+                break
+            if level == 0:
+                distance = self.intersect_cell(origin, direction, i, j)
+                if distance is not None and distance <= max_distance and (hit is None or distance < hit):
+                    hit = distance
+                continue
+            for ci, cj in ((i * 2, j * 2), (i * 2 + 1, j * 2), (i * 2, j * 2 + 1), (i * 2 + 1, j * 2 + 1)):
+                if ci < self.shapes[level - 1][1] and cj < self.shapes[level - 1][0]:
+                    distance = self.intersect_node(origin, direction, level - 1, ci, cj,
+                                                   max_distance if hit is None else hit)
+                    if distance is not None:
+                        heapq.heappush(heap, (distance, level - 1, ci, cj))
+        return hit
+
+    def intersect_node(self, origin, direction, level, i, j, max_distance):
+        # Distance where the ray enters the bounds of a node (slab test), or None if it misses them;
+        # xz first, as the heights are only read for nodes the ray passes over
+        size = 2 ** level
+        x0, z0 = self.get_position(i * size, j * size)
+        x1, z1 = self.get_position(min((i + 1) * size, self.cells_w), min((j + 1) * size, self.cells_d))
+        t_min, t_max = 0.0, max_distance
+        for axis, b_min, b_max in ((0, x0, x1), (2, z0, z1), (1, None, None)):
+            if b_min is None:
+                b_min, b_max = self.get_node(level, i, j)
+                b_min, b_max = self.get_height_of(b_min), self.get_height_of(b_max)
+            o, d = origin[axis], direction[axis]
+            if d == 0.0:
+                if o < b_min or o > b_max:
+                    return None
+                continue
+            t0, t1 = (b_min - o) / d, (b_max - o) / d
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > t_min:
+                t_min = t0
+            if t1 < t_max:
+                t_max = t1
+            if t_min > t_max:
+                return None
+        return t_min
+
+    def intersect_cell(self, origin, direction, i, j):
+        # Nearest hit on the two triangles of a cell (Moller-Trumbore), or None
+        h3, h2, h0, h1 = self.get_cell_heights(i, j)
+        x0, z0 = self.get_position(i, j)
+        x1, z1 = self.get_position(i + 1, j + 1)
+        origin, direction = glm.vec3(origin), glm.vec3(direction)
+        v0, v1, v2, v3 = glm.vec3(x0, h0, z1), glm.vec3(x1, h1, z1), glm.vec3(x1, h2, z0), glm.vec3(x0, h3, z0)
+        hit = None
+        for a, b, c in ((v0, v2, v3), (v0, v1, v2)):
+            edge_1, edge_2 = b - a, c - a
+            p = glm.cross(direction, edge_2)
+            det = glm.dot(edge_1, p)
+            if abs(det) < 1e-12:
+                continue
+            s = origin - a
+            u = glm.dot(s, p) / det
+            q = glm.cross(s, edge_1)
+            v = glm.dot(direction, q) / det
+            t = glm.dot(edge_2, q) / det
+            if u >= 0.0 and v >= 0.0 and u + v <= 1.0 and t >= 0.0 and (hit is None or t < hit):
+                hit = t
+        return hit
+
+
 class TerrainChunk:
+    '''Streams terrain chunks around the camera.
+
+    The height map is tiled into a grid of `chunk_size` cells. Chunks within `view_distance` of the
+    camera are generated on a worker pool, uploaded on the render thread at most `uploads_per_frame` a
+    frame and added to the scene. Chunks that leave the view are taken out of the scene but keep their
+    buffers, up to `max_chunks` in total; past that the least recently needed chunks are released.
+
+    The ground of each chunk is drawn with every (2 ** level)-th height sample, the level going up
+    by one for each of `lod_distances` the chunk is further from the camera (geomipmapping). Edges
+    next to a coarser neighbour are stitched to it, and grass is only drawn up to `grass_distance`.
+    The meshes of a new level are also built on the workers; a chunk draws its current mesh until
+    the new one is ready, and at most `lod_swaps_per_frame` are swapped in a frame.
+
+    With `gpu_ground` the ground is not baked into buffers per chunk: every chunk draws the shared
+    grid of its level, displaced in the vertex shader from its height tile (see HeightMapGround).
+    Edited heights are then written into the tiles, and only the grass of the chunks is generated
+    again.
+
+    The bounds of every chunk come from a min/max pyramid of the height map (see HeightPyramid), so
+    the chunks in view are known, and generated first, before they are built. The pyramid also
+    answers height and ray queries against the ground; its levels inside a chunk are built on the
+    workers with the chunk.
+    '''
+    chunk_size = 16  # Cells per chunk side, a power of two
+    view_distance = 64.0  # Chunks closer than this to the camera (xz) are shown
+    grass_distance = 24.0  # Chunks closer than this also show their grass
+    lod_distances = (16.0, 32.0, 48.0)  # Distances where the ground drops to the next level of detail
+    max_chunks = 96  # Chunks kept on the GPU, shown or cached
+    gpu_ground = False  # Displace a shared grid from height tiles instead of a mesh per chunk
+    workers = 2
+    uploads_per_frame = 1
+    lod_swaps_per_frame = 2
+    height_map_path = "height_map"
+    # Generated chunks are saved here and loaded on later runs, None turns it off
+    cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+    cache_size = 256 * 2 ** 20  # Bytes the cache is trimmed to at start and exit, least recently used first
+    max_height = 100.0
+    scale = 1.0
+    rounding_factor = 6
 
     def __init__(self, app):
         self.app = app
@@ -777,17 +1475,31 @@ class TerrainChunk:
         self.chunks_count = -1
         self.chunks_map = {}
 
+        # Streaming state, chunks are keyed by their (x, z) index in the grid
+        self.height_map = None
+        self.pyramid = None
+        self.pool = None
+        self.pending = {}  # Key to the future of the chunk being generated
+        self.loaded = OrderedDict()  # Key to the (grass, ground) objects, least recently needed first
+        self.shown = set()  # Keys of the loaded chunks that are in the scene
+        self.in_scene = set()  # Their grass and ground objects in the scene
+        self.edited = set()  # Keys of the chunks whose heights were edited, they are not cached
+        self.regrow = {}  # Key to the future of the chunk generated again for its grass, with gpu_ground
+        self.triangles = 0  # Ground triangles in the scene
+
     def add_chunk(self, app, name: int, position=(0, 0, 0), width=40, depth=40, max_height=100.0,
-                  height_map_path="height_map", scale=1.0, rounding_factor=6):
+                  height_map_path="height_map", scale=1.0, rounding_factor=6,
+                  grass_density=10, grass_jitter=0.0, grass_seed=0):
         # Note this is still an old method where I'm loading a file and creating the terrain from it,
-        # which isn't that useful for a chunked terrain system -- this needs to be moved to the scene builder
-        # where we can chunk up the map area and create each chunk ready to go in the scene objects.
+        # which isn't that useful for a chunked terrain system -- the streamed chunks below are built
+        # from tiles of one height map instead.
         if name in self.chunks_map:
             return self.chunks[self.chunks_map[name]]
 
         terrain_chunk = Terrain(app=app, position=position, width=width, depth=depth,
                                 max_height=max_height, height_map_path=height_map_path,
-                                scale=scale, rounding_factor=rounding_factor)
+                                scale=scale, rounding_factor=rounding_factor,
+                                grass_density=grass_density, grass_jitter=grass_jitter, grass_seed=grass_seed)
 
         self.chunks_count += 1
         self.chunks_map[name] = self.chunks_count
@@ -795,95 +1507,480 @@ class TerrainChunk:
         print(f"loaded terrain chunk: {name} at index: {self.chunks_count}")
         return terrain_chunk
 
+    def load_height_map(self):
+        # Raw height maps are memory-mapped, each chunk only reads its own tile
+        self.height_map, self.width, self.depth = self.app.texture.get_height_map(
+            f'../textures/{self.height_map_path}')
+        # The middle sample of the height map sits at the world origin, just under the camera
+        self.centre = (self.width // 2, self.depth // 2)
+        self.base_height = float(get_heights(self.height_map[self.centre[1], self.centre[0]], self.max_height,
+                                             0, self.rounding_factor)) + 1
+        self.grid_w = (self.width - 1) // self.chunk_size
+        self.grid_d = (self.depth - 1) // self.chunk_size
+        self.chunk_level = int(math.log2(self.chunk_size))  # Pyramid level where a node is a chunk
+        # Only the chunk level and up are built here, the levels inside a chunk are built when it is generated
+        self.pyramid = HeightPyramid(self.height_map, self.centre, self.max_height, self.base_height,
+                                     self.rounding_factor, self.scale, tile_level=self.chunk_level,
+                                     max_tiles=self.max_chunks, cache_file=self.get_pyramid_cache_file())
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='terrain')
+        if self.cache_path is not None:
+            self.pool.submit(trim_files, self.cache_path, self.cache_size, Terrain.cache_prefix)
+
+    def get_pyramid_cache_file(self):
+        # Named by the height map file as it is on disk, edits only live in memory
+        if self.cache_path is None:
+            return None
+        path = f'../textures/{self.height_map_path}'
+        if not os.path.splitext(path)[1]:
+            path = f'{path}.png'
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = hashlib.sha1(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, self.height_map.dtype.str,
+                                 self.height_map.shape, self.chunk_level)).encode())
+        return os.path.join(self.cache_path, f'{Terrain.cache_prefix}pyramid_{key.hexdigest()}.bin')
+
+    def get_wanted(self, position):
+        # Chunks with any part within view_distance of the camera, nearest first
+        size = self.chunk_size * self.scale
+        x = position.x / self.scale + self.centre[0]
+        z = position.z / self.scale + self.centre[1]
+        reach = int(math.ceil(self.view_distance / size))
+        cx, cz = int(x // self.chunk_size), int(z // self.chunk_size)
+        wanted = []
+        for i in range(max(cx - reach, 0), min(cx + reach + 1, self.grid_w)):
+            for j in range(max(cz - reach, 0), min(cz + reach + 1, self.grid_d)):
+                dx = max(i * self.chunk_size - x, 0, x - (i + 1) * self.chunk_size) * self.scale
+                dz = max(j * self.chunk_size - z, 0, z - (j + 1) * self.chunk_size) * self.scale
+                distance = math.sqrt(dx * dx + dz * dz)
+                if distance <= self.view_distance:
+                    wanted.append((distance, (i, j)))
+        return [(key, distance) for distance, key in sorted(wanted)]
+
+    def get_level(self, distance):
+        level = sum(distance > lod_distance for lod_distance in self.lod_distances)
+        return min(level, int(math.log2(self.chunk_size)))
+
+    def generate(self, key):
+        # Runs on a worker thread, CPU side only: no OpenGL calls in here
+        i, j = key
+        x0, z0 = i * self.chunk_size, j * self.chunk_size
+        # The pyramid levels inside the chunk, for ray queries over it
+        self.pyramid.get_tile(i, j)
+        tile = self.height_map[z0:z0 + self.chunk_size + 1, x0:x0 + self.chunk_size + 1]
+        border = self.get_border(key)
+        # Edited heights are only in memory, a later run would never load their files
+        cache_path = None if key in self.edited else self.cache_path
+        return Terrain(app=self.app, max_height=self.max_height, scale=self.scale,
+                       rounding_factor=self.rounding_factor, grass_seed=z0 * self.width + x0,
+                       height_map=tile, centre=(self.centre[0] - x0, self.centre[1] - z0),
+                       base_height=self.base_height, build_mesh=not self.gpu_ground, cache_path=cache_path,
+                       height_map_border=border)
+
+    def get_border(self, key):
+        # The tile of a chunk with the next sample of the neighbouring tiles around it, repeated at the
+        # edges of the map
+        x0, z0 = key[0] * self.chunk_size, key[1] * self.chunk_size
+        top, left = int(z0 == 0), int(x0 == 0)
+        border = self.height_map[z0 - 1 + top:z0 + self.chunk_size + 2, x0 - 1 + left:x0 + self.chunk_size + 2]
+        return numpy.pad(border, ((top, self.chunk_size + 3 - top - border.shape[0]),
+                                  (left, self.chunk_size + 3 - left - border.shape[1])), mode='edge')
+
+    def get_bounds(self, keys):
+        # Bounds (centres, half extents) of chunks, they contain the ground of every level of detail
+        return self.pyramid.get_bounds(self.chunk_level, keys)
+
+    def upload(self, key, terrain_chunk):
+        # Render thread, the buffers of each chunk are created here
+        center, extents = self.get_bounds([key])
+        if self.gpu_ground:
+            ground = HeightMapGround(self.app, terrain_chunk=terrain_chunk, bounds=(center[0], extents[0]),
+                                     origin=(key[0] * self.chunk_size, key[1] * self.chunk_size))
+        else:
+            ground = Ground(self.app, terrain_chunk=terrain_chunk, bounds=(center[0], extents[0]))
+        self.loaded[key] = (Grass(self.app, terrain_chunk=terrain_chunk), ground)
+
+    def clear(self, scene, keys=None):
+        # Take chunks out of the scene and release them, they are streamed in again when needed
+        for key in list(self.loaded) if keys is None else [key for key in keys if key in self.loaded]:
+            for obj in self.loaded.pop(key):
+                self.show(scene, obj, False)
+                obj.destroy()
+            self.shown.discard(key)
+        for futures in (self.pending, self.regrow):
+            for key in list(futures) if keys is None else [key for key in keys if key in futures]:
+                futures.pop(key).cancel()
+
+    def set_gpu_ground(self, scene, gpu_ground):
+        if gpu_ground != self.gpu_ground:
+            self.gpu_ground = gpu_ground
+            self.clear(scene)
+
+    def write_heights(self, scene, x, z, heights):
+        '''Edit the height map from sample (x, z) with an array of samples (depth, width).
+
+        With `gpu_ground` the height tiles and bounds of the touched chunks are updated in place, and
+        only their grass is generated again; the old grass is drawn until the new one is uploaded.
+        Otherwise the touched chunks are generated again, as their ground meshes are built from the
+        heights.
+        '''
+        heights = numpy.asarray(heights, dtype=self.height_map.dtype)
+        depth, width = heights.shape
+        self.height_map[z:z + depth, x:x + width] = heights
+        self.pyramid.update(x, z, width, depth)
+        # Chunks share their edge samples and read one more for their normals, so the chunks next to
+        # the edited area are touched too
+        size = self.chunk_size
+        keys = [(i, j) for i in range((x - 2) // size, (x + width) // size + 1)
+                for j in range((z - 2) // size, (z + depth) // size + 1)]
+        self.edited.update(keys)
+        if not self.gpu_ground:
+            self.clear(scene, keys)
+            return
+        # Chunks being generated may have read the old heights
+        self.clear(scene, [key for key in keys if key in self.pending])
+        for key in [key for key in keys if key in self.loaded]:
+            ground = self.loaded[key][1]
+            ground.write_tile(self.get_border(key))
+            center, extents = self.get_bounds([key])
+            ground.bounds = (center[0], extents[0])
+        scene.dirty = True
+        # Grass only grows from the samples of its own tile, x0 to x0 + chunk_size
+        for i in range((x - 1) // size, (x + width - 1) // size + 1):
+            for j in range((z - 1) // size, (z + depth - 1) // size + 1):
+                if (i, j) in self.loaded:
+                    if (i, j) in self.regrow:
+                        self.regrow[(i, j)].cancel()
+                    self.regrow[(i, j)] = self.pool.submit(self.generate, (i, j))
+
+    def get_height(self, x, z):
+        '''Height of the ground at world (x, z), or None off the height map.'''
+        return self.pyramid.get_height(x, z)
+
+    def raycast(self, origin, direction, max_distance=math.inf):
+        '''Distance along a ray (in lengths of direction) to the ground, or None; see HeightPyramid.'''
+        return self.pyramid.raycast(origin, direction, max_distance)
+
+    def show(self, scene, obj, shown=True):
+        if shown and obj not in self.in_scene:
+            scene.add_object(obj)
+            self.in_scene.add(obj)
+        elif not shown and obj in self.in_scene:
+            scene.remove_object(obj)
+            self.in_scene.discard(obj)
+
+    def update(self, scene, wait=False):
+        '''Queue, upload, show, hide and evict chunks for the current camera position.
+
+        Only finished chunks are uploaded, so a frame never waits on the workers; wait=True blocks
+        until everything in view is loaded, for building the first frame.
+        '''
+        if self.height_map is None:
+            self.load_height_map()
+        distances = dict(self.get_wanted(self.app.camera.position))
+        wanted = list(distances)
+        wanted_set = set(wanted)
+        # Chunks in the view frustum are generated and uploaded first, nearest first within each group
+        if wanted:
+            in_view = frustum_cull(self.app.camera.frustum_planes, *self.get_bounds(wanted))
+            wanted = [wanted[i] for i in numpy.argsort(~in_view, kind='stable')]
+
+        # Drop queued work that is no longer needed, running work is discarded when it finishes
+        for key in [key for key in self.pending if key not in wanted_set]:
+            if self.pending[key].cancel():
+                del self.pending[key]
+        for key in wanted:
+            if key not in self.loaded and key not in self.pending:
+                self.pending[key] = self.pool.submit(self.generate, key)
+
+        # Upload finished chunks, nearest first
+        uploads = 0
+        for key in wanted:
+            if key not in self.pending or (uploads >= self.uploads_per_frame and not wait):
+                continue
+            future = self.pending[key]
+            if not future.done() and not wait:
+                continue
+            del self.pending[key]
+            self.upload(key, future.result())
+            uploads += 1
+        for key in [key for key, future in self.pending.items() if future.done() and key not in wanted_set]:
+            del self.pending[key]
+        # Swap in the grass of edited chunks, their ground already draws the new heights
+        for key in [key for key, future in self.regrow.items() if future.done()]:
+            if uploads >= self.uploads_per_frame and not wait:
+                break
+            future = self.regrow.pop(key)
+            if future.cancelled() or key not in self.loaded:
+                continue
+            grass, ground = self.loaded[key]
+            self.show(scene, grass, False)
+            grass.destroy()
+            self.loaded[key] = (Grass(self.app, terrain_chunk=future.result()), ground)
+            uploads += 1
+
+        # Show the chunks in view and mark them as the most recently needed
+        for key in wanted:
+            if key in self.loaded:
+                self.loaded.move_to_end(key)
+                grass, ground = self.loaded[key]
+                self.show(scene, ground)
+                self.show(scene, grass, distances[key] <= self.grass_distance)
+                self.shown.add(key)
+        for key in [key for key in self.shown if key not in wanted_set]:
+            for obj in self.loaded[key]:
+                self.show(scene, obj, False)
+            self.shown.discard(key)
+
+        # Level of detail of each shown chunk, its sides take the coarser level of the two chunks
+        levels = {key: self.get_level(distances[key]) for key in self.shown}
+        self.triangles = 0
+        swaps = 0
+        for (i, j), level in levels.items():
+            neighbours = ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1))
+            edges = tuple(max(levels.get(neighbour, level), level) for neighbour in neighbours)
+            ground = self.loaded[(i, j)][1]
+            ground.set_lod(level, edges, self.pool)
+            if (swaps < self.lod_swaps_per_frame or wait) and ground.swap_lod(wait):
+                swaps += 1
+            self.triangles += ground.triangles
+
+        # Release the least recently needed chunks over the budget
+        for key in list(self.loaded):
+            if len(self.loaded) <= self.max_chunks:
+                break
+            if key not in wanted_set:
+                for obj in self.loaded.pop(key):
+                    obj.destroy()
+                if key in self.regrow:
+                    self.regrow.pop(key).cancel()
+
+    def destroy(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        for objects in self.loaded.values():
+            for obj in objects:
+                obj.destroy()
+        self.loaded.clear()
+        self.shown.clear()
+        self.in_scene.clear()
+        if self.cache_path is not None:
+            trim_files(self.cache_path, self.cache_size, Terrain.cache_prefix)
+
 
 class Terrain:
+    '''Ground mesh and grass points of a height map, or of a tile of one.
+
+    Everything is seeded by grass_seed, so the same heights and parameters always give the same
+    buffers. With a cache_path they are saved there in a file named by a hash of both, and later
+    loaded from it memory-mapped instead of being generated again. A file that cannot be read is
+    deleted and generated again, and one that cannot be written is skipped.
+    '''
+    cache_version = 2  # Part of the cache key, bump it when the generated data changes
+    cache_prefix = 'terrain_'  # Start of the cache file names
 
     def __init__(self, app, position=(0, 0, 0), width=40, depth=40, max_height=100.0,
-                 height_map_path="height_map", scale=1.0, rounding_factor=6):
+                 height_map_path="height_map", scale=1.0, rounding_factor=6,
+                 grass_density=10, grass_jitter=0.0, grass_seed=0,
+                 height_map=None, centre=None, base_height=None, build_mesh=True, cache_path=None,
+                 height_map_border=None):
         self.app = app
         self.ctx = app.ctx
         self.position = glm.mat4(glm.translate(glm.mat4(1), glm.vec3(position)))
         self.rounding_factor = rounding_factor
         self.max_height = max_height
+        # Grass blades per triangle edge, random offset in grid steps (0 keeps the regular grid) and its seed
+        self.grass_density = grass_density
+        self.grass_jitter = grass_jitter
+        self.grass_seed = grass_seed
 
         self.scale = scale
         self.half_scale = self.scale * 0.5
-        terrain_image_path = f'../textures/{height_map_path}.png'
-        self.height_map, self.height_map_w, self.height_map_d = app.texture.get_image_data(terrain_image_path)
+        if height_map is None:
+            terrain_image_path = f'../textures/{height_map_path}'
+            self.height_map, self.height_map_w, self.height_map_d = app.texture.get_height_map(terrain_image_path)
+        else:
+            # A tile of a height map that is already loaded, e.g. by the chunk streaming
+            self.height_map = height_map
+            self.height_map_d, self.height_map_w = height_map.shape
 
         # Temporary limit for terrain size
         if width != self.height_map_w and width <= self.height_map_w:
             self.height_map_w = width
         if depth != self. height_map_d and depth <= self.height_map_d:
             self.height_map_d = depth
-        self.half_width = math.floor(self.height_map_w / 2 * self.scale)
-        self.half_depth = math.floor(self.height_map_d / 2 * self.scale)
+        if centre is None:
+            self.half_width = math.floor(self.height_map_w / 2 * self.scale)
+            self.half_depth = math.floor(self.height_map_d / 2 * self.scale)
+        else:
+            # Sample placed at the world origin, relative to this tile (it can lie outside of it)
+            self.half_width, self.half_depth = centre
+
+        # The heights with one more sample on each side, for normals that match those of the next tiles
+        if height_map_border is None:
+            height_map_border = numpy.pad(self.height_map[:self.height_map_d, :self.height_map_w], 1, mode='edge')
+        self.height_map_border = height_map_border
 
         # Get value at 0,0 i.e. half_width, half_depth; use this to place the terrain under the camera
-        self.base_height = self.lookup_height(self.half_width, self.half_depth) + 1
+        if base_height is None:
+            self.base_height = self.lookup_height(self.half_width, self.half_depth) + 1
+        else:
+            self.base_height = base_height
+        self.uv_quad = None
+        self.normals = None
+        self.vertex_data, self.indices = None, None
+        self.cache_file = None
+        if cache_path is not None:
+            self.cache_file = os.path.join(cache_path, f'{self.cache_prefix}{self.get_cache_key(build_mesh)}.bin')
+            if self.load_cache(build_mesh):
+                return
         self.vertices = self.get_vertices(self.height_map_w, self.height_map_d, self.max_height,
                                           self.base_height, self.height_map,
                                           self.half_width, self.half_depth, self.rounding_factor)
-        self.vertex_data = self.generate_vertex_data(self.vertices)
+        # One vertex per height sample, shared by the cells around it through the index buffer
+        if build_mesh:
+            self.vertex_data, self.indices = self.get_lod_data()
+        self.vertices_mesh = self.get_grass_points(self.vertices)
+        if self.cache_file is not None:
+            self.save_cache(build_mesh)
+
+    def get_cache_key(self, build_mesh):
+        # Hash of the heights used and of every parameter the outputs depend on
+        key = hashlib.sha1()
+        heights = numpy.ascontiguousarray(self.height_map_border)
+        key.update(heights.dtype.str.encode())
+        key.update(heights.tobytes())
+        key.update(repr((self.cache_version, self.height_map_w, self.height_map_d, self.max_height,
+                         self.scale, self.rounding_factor, self.base_height, self.half_width, self.half_depth,
+                         self.grass_density, self.grass_jitter, self.grass_seed, build_mesh)).encode())
+        return key.hexdigest()
+
+    def load_cache(self, build_mesh):
+        # Memory-mapped, the pages are read when the buffers are created from them; returns False when
+        # there is no usable file, a truncated or corrupt one is deleted
+        try:
+            arrays = load_arrays(self.cache_file, 4 if build_mesh else 2)
+            # Recently used files are kept when the cache is trimmed
+            os.utime(self.cache_file)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        except (OSError, ValueError) as error:
+            print(f"terrain cache: can't read {self.cache_file}, generating it again: {error}")
+            remove_file(self.cache_file)
+            return False
+        if build_mesh:
+            self.vertices, self.vertices_mesh, self.vertex_data, self.indices = arrays
+        else:
+            self.vertices, self.vertices_mesh = arrays
+        return True
+
+    def save_cache(self, build_mesh):
+        arrays = [self.vertices, self.vertices_mesh]
+        if build_mesh:
+            arrays += [self.vertex_data, self.indices]
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+            save_arrays(self.cache_file, arrays)
+        except OSError as error:
+            print(f"terrain cache: can't write {self.cache_file}: {error}")
 
     def lookup_height(self, x, z):
-        height = round(self.height_map[z][x][0] / 255 * self.max_height, self.rounding_factor)
+        height = float(get_heights(self.height_map[z][x], self.max_height, 0, self.rounding_factor))
         return height
 
-    def get_vertices(self, height_map_w: int, height_map_d: int, max_h: float, offset_h: int,
-                     height_map: list, half_width: int, half_depth: int, r_factor=5):
-        vertices = []
+    def get_grid(self, height_map_w: int, height_map_d: int, max_h: float, offset_h: int,
+                 height_map: list, half_width: int, half_depth: int, r_factor=5, step=1, edges=(1, 1, 1, 1)):
+        # Positions of every step-th height sample, as a (rows, columns, 3) array
         offset_w = half_width * self.scale
         offset_d = half_depth * self.scale
-        for z in range(1, height_map_d):
-            for x in range(1, height_map_w):
-                y1 = round((height_map[z][x-1][0] / 255) * max_h - offset_h, r_factor)
-                y2 = round((height_map[z][x][0] / 255) * max_h - offset_h, r_factor)
-                y3 = round((height_map[z-1][x][0] / 255) * max_h - offset_h, r_factor)
-                y4 = round((height_map[z-1][x-1][0] / 255) * max_h - offset_h, r_factor)
-                x_pos = x * self.scale
-                z_pos = z * self.scale
-                vertices.append((x_pos-self.half_scale-offset_w, y1, z_pos+self.half_scale-offset_d))
-                vertices.append((x_pos+self.half_scale-offset_w, y2, z_pos+self.half_scale-offset_d))
-                vertices.append((x_pos+self.half_scale-offset_w, y3, z_pos-self.half_scale-offset_d))
-                vertices.append((x_pos-self.half_scale-offset_w, y4, z_pos-self.half_scale-offset_d))
-        return vertices
-
-    def generate_vertex_data(self, vertices):
-        grass_density = 10
-        grass_vertices = []
-        indices = []
-        texture_coords = []
-        texture_indices = []
-        normals = []
-        for i in range(0, len(vertices) - 1, 4):
-            v1 = vertices[i]
-            v2 = vertices[i + 1]
-            v3 = vertices[i + 2]
-            v4 = vertices[i + 3]
-            indices.append((i, i + 2, i + 3))  # Triangle 1
-            indices.append((i, i + 1, i + 2))  # Triangle 2
-            texture_coords.extend(self.app.texture.random_quad())
-            texture_indices.append((0, 2, 3))
-            texture_indices.append((0, 1, 2))
-            # Normals of the terrain triangles
-            normal_1 = glm.normalize(glm.cross(delta_ab(v1, v3), delta_ab(v1, v4)))
-            new_normals = [[normal_1] * 3]
-            normal_2 = glm.normalize(glm.cross(delta_ab(v1, v2), delta_ab(v1, v3)))
-            new_normals.extend([[normal_2] * 3])
-            normals.append(new_normals)
-            # Add grass blade points along each triangle of this piece
-            grass_vertices.append(uniform_points_in_3d_triangle(v1, v2, v3, grass_density))
-            grass_vertices.append(uniform_points_in_3d_triangle(v1, v3, v4, grass_density))
-        self.vertices_mesh = numpy.array(grass_vertices, dtype='f4')
-
-        # Pack vertex data
-        texture_coord_data = generate_vertex_data(texture_coords, texture_indices)
-        vertex_data = generate_vertex_data(vertices, indices)
-        vertex_data = numpy.hstack([texture_coord_data, vertex_data])
-        normals = numpy.array(normals, dtype='f4').reshape(int(len(normals * 6)), 3)
-        vertex_data = numpy.hstack([vertex_data, normals])
-        return numpy.array(vertex_data, dtype='f4')
+        heights = get_heights(height_map[:height_map_d:step, :height_map_w:step], max_h, offset_h, r_factor)
+        # Edges (-x, +x, -z, +z) next to a coarser step follow its straight lines, so the seams have no cracks
+        for line, edge in zip((heights[:, 0], heights[:, -1], heights[0], heights[-1]), edges):
+            ratio = edge // step
+            if ratio > 1:
+                coarse = numpy.arange(0, len(line), ratio)
+                line[:] = numpy.interp(numpy.arange(len(line)), coarse, line[coarse])
+        grid = numpy.empty(heights.shape + (3,))
+        grid[:, :, 0] = (numpy.arange(heights.shape[1]) * step + 0.5) * self.scale - offset_w
+        grid[:, :, 1] = heights
+        grid[:, :, 2] = ((numpy.arange(heights.shape[0]) * step + 0.5) * self.scale - offset_d)[:, None]
+        return grid
+
+    def get_vertices(self, height_map_w: int, height_map_d: int, max_h: float, offset_h: int,
+                     height_map: list, half_width: int, half_depth: int, r_factor=5, step=1, edges=(1, 1, 1, 1)):
+        # Four corners per cell of every step-th height sample, as a (cells * 4, 3) array in row order
+        grid = self.get_grid(height_map_w, height_map_d, max_h, offset_h, height_map, half_width, half_depth,
+                             r_factor, step, edges)
+        vertices = numpy.stack([grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:], grid[:-1, :-1]], axis=2)
+        return vertices.reshape(-1, 3)
+
+    def get_normals(self):
+        # Normal of every height sample from central differences of the heights, as a (depth, width, 3) array
+        heights = get_heights(self.height_map_border, self.max_height, 0, self.rounding_factor)
+        normals = numpy.empty(heights[1:-1, 1:-1].shape + (3,))
+        normals[:, :, 0] = heights[1:-1, :-2] - heights[1:-1, 2:]
+        normals[:, :, 1] = 2.0 * self.scale
+        normals[:, :, 2] = heights[:-2, 1:-1] - heights[2:, 1:-1]
+        return normals / numpy.sqrt((normals * normals).sum(axis=2))[:, :, None]
+
+    def generate_vertex_data(self, grid, step=1):
+        # Texture coordinates, position and normal of every grid vertex, and the indices of the cells
+        rows, columns = grid.shape[:2]
+        if self.normals is None:
+            self.normals = self.get_normals()
+        if self.uv_quad is None:
+            # Every cell uses the coordinates of one random quad, seeded so each level draws the same one
+            self.uv_quad = self.app.texture.random_quads(1, numpy.random.default_rng(self.grass_seed))[0]
+        # The quad carries on over the grid with the texture repeating, so the cells can share their corners;
+        # coarser cells repeat the texture step times, so it keeps its size on screen
+        x = numpy.arange(columns)[None, :, None] * step
+        z = numpy.arange(rows)[:, None, None] * step
+        vertex_data = numpy.empty((rows, columns, 8), dtype='f4')
+        vertex_data[:, :, 0:2] = (self.uv_quad[3] + x * (self.uv_quad[2] - self.uv_quad[3])
+                                  + z * (self.uv_quad[0] - self.uv_quad[3]))
+        vertex_data[:, :, 2:5] = grid
+        # Full resolution normals at every level, so the shading does not change with the level of detail
+        vertex_data[:, :, 5:8] = self.normals[:self.height_map_d:step, :self.height_map_w:step]
+        return vertex_data.reshape(-1, 8), get_grid_indices(columns - 1, rows - 1)
+
+    def get_grass_points(self, vertices):
+        # Add grass blade points along each triangle of every cell
+        triangles = vertices.reshape(-1, 4, 3)[:, [[0, 1, 2], [0, 2, 3]]].reshape(-1, 3, 3)
+        return uniform_points_in_3d_triangles(triangles, self.grass_density,
+                                              self.grass_jitter, self.grass_seed).astype('f4')
+
+    def get_lod_data(self, level=0, edges=(0, 0, 0, 0)):
+        '''Vertex data and indices of a grid of every (2 ** level)-th height sample.
+
+        edges are the levels of the (-x, +x, -z, +z) neighbours; sides next to a coarser level are
+        stitched to it. Level 0 with no coarser neighbours is the full resolution mesh.
+        '''
+        if level == 0 and not any(edges) and self.vertex_data is not None:
+            return self.vertex_data, self.indices
+        step = 2 ** level
+        grid = self.get_grid(self.height_map_w, self.height_map_d, self.max_height,
+                             self.base_height, self.height_map, self.half_width, self.half_depth,
+                             self.rounding_factor, step=step, edges=[2 ** edge for edge in edges])
+        return self.generate_vertex_data(grid, step=step)
+
+
+class TerrainMesh():
+    '''Buffers and vertex arrays of one terrain chunk, the programs belong to the prototype.'''
+    def __init__(self, vbo, vao, shadow_vao, bounds, ibo=None):
+        self.vbo = vbo
+        self.ibo = ibo
+        self.vao = vao
+        self.shadow_vao = shadow_vao
+        self.bounds = bounds
+        self.triangles = ibo.size // 12 if ibo is not None else 0  # 3 u4 indices each
+
+    def release(self):
+        self.vao.release()
+        self.shadow_vao.release()
+        self.vbo.release()
+        if self.ibo is not None:
+            self.ibo.release()
 
 
 class PrototypeGround():
@@ -893,43 +1990,37 @@ class PrototypeGround():
         self.shader_program = app.shader.get_shader('ground')
         self.shadow_program = app.shader.get_shader("shadow")
 
-    def build(self, terrain_chunk: int = None):
-        self.terrain_chunk = terrain_chunk
-        self.vbo = self.get_vbo()
-        self.vao = self.get_vao()
-        self.shadow_vao = self.get_shadow_vao()
+    def build(self, terrain_chunk: Terrain = None, level=0, edges=(0, 0, 0, 0)):
+        return self.get_mesh(*terrain_chunk.get_lod_data(level, edges))
+
+    def get_mesh(self, vertex_data, indices):
+        # Every chunk gets its own buffers, the programs are shared
+        vbo = self.ctx.buffer(vertex_data)
+        ibo = self.ctx.buffer(indices)
+        return TerrainMesh(vbo, self.get_vao(vbo, ibo), self.get_shadow_vao(vbo, ibo),
+                           get_bounds(vertex_data[:, 2:5]), ibo=ibo)
 
     def destroy(self):
         self.shader_program.release()
-        self.vao.release()
-        self.shadow_vao.release()
-        self.vbo.release()
 
-    def get_vao(self):
+    def get_vao(self, vbo, ibo):
         vao = self.ctx.vertex_array(self.shader_program, [
-            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ])
+            (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+        ], index_buffer=ibo, index_element_size=4)
         return vao
 
-    def get_shadow_vao(self):
+    def get_shadow_vao(self, vbo, ibo):
         vao = self.ctx.vertex_array(self.shadow_program, [
-            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ], skip_errors=True)
+            (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+        ], index_buffer=ibo, index_element_size=4, skip_errors=True)
         # Temporary fix for the issue with the shadow program because we are not using texture coordinates
         # So we set skip_errors=True to ignore the missing in_texcoord_0 attribute
         return vao
 
-    def get_vbo(self):
-        return self.ctx.buffer(self.terrain_chunk.vertex_data)
-
-    def render_shadow(self):
-        self.shadow_program['m_model'].write(self.position)
-        self.shadow_vao.render(moderngl.TRIANGLES)
-
 
 class Ground():
     def __init__(self, app, position=(0, 0, 0), texture: str = 'dirt',
-                 terrain_chunk: Terrain = None,
+                 terrain_chunk: Terrain = None, bounds=None,
                  albedo=(1.0, 1.0, 1.0), roughness=0.75, metallic=0.25):
         self.app = app
         self.ctx = app.ctx
@@ -939,6 +2030,7 @@ class Ground():
         self.m_model = self.position
         self.can_update = True
         self.can_render = True
+        self.can_render_shadow = True
         self.has_shadow = False  # Not sure if this is rendering completely correctly -- return to this.
 
         self.albedo = glm.vec3(albedo)
@@ -946,71 +2038,324 @@ class Ground():
         self.metallic = metallic
 
         this_object = self.app.prototype.get_object("ground")
-        this_object.build(terrain_chunk)
-        self.vao = this_object.vao
+        self.prototype = this_object
+        self.lod = (0, (0, 0, 0, 0))
+        self.pending_lod = None  # Level of detail being built on the workers and its future
+        self.mesh = this_object.build(terrain_chunk)
+        self.triangles = self.mesh.triangles
+        self.vao = self.mesh.vao
+        self.shadow_vao = self.mesh.shadow_vao
+        # Bounds of the chunk (from the height pyramid) when given, else of the full resolution mesh
+        self.bounds = self.mesh.bounds if bounds is None else bounds
         self.shader_program = this_object.shader_program
+        self.shadow_program = this_object.shadow_program
 
         self.tex_id = app.texture.get_texture(path=f'../textures/{texture}.png')
 
+        # Render queue state keys
+        self.transparent = False
+        self.textures = (self.tex_id,)
+        self.material = (*self.albedo, self.roughness, self.metallic)
+
     def update(self):
-        self.shader_program['m_view'].write(self.app.camera.m_view)
+        pass
 
-    def render(self):
-        # Texture
+    def bind_textures(self):
         self.shader_program['u_tex_albedo'] = self.tex_id
         self.app.texture.textures[self.tex_id].use(location=self.tex_id)
 
-        # Position
-        self.shader_program['m_model'].write(self.m_model)
-
-        # Material
+    def bind_material(self):
         self.shader_program['material.a'].value = self.albedo
         self.shader_program['material.d'].value = self.roughness
         self.shader_program['material.s'].value = self.metallic
 
+    def draw(self):
+        # Position
+        self.shader_program['m_model'].write(self.m_model)
+
         self.vao.render(moderngl.TRIANGLES)
 
+    def render(self):
+        self.bind_textures()
+        self.bind_material()
+        self.draw()
+
     def render_shadow(self):
         self.shadow_program['m_model'].write(self.position)
         self.shadow_vao.render(moderngl.TRIANGLES)
 
+    def set_lod(self, level, edges, pool):
+        # Build the mesh on the pool when the level of this chunk or of a neighbour changed, the current
+        # mesh is drawn until swap_lod takes the new one
+        lod = (level, edges)
+        if self.pending_lod is not None:
+            if self.pending_lod[0] == lod:
+                return
+            self.pending_lod[1].cancel()
+            self.pending_lod = None
+        if lod != self.lod:
+            self.pending_lod = (lod, pool.submit(self.terrain_chunk.get_lod_data, level, edges))
+
+    def swap_lod(self, wait=False):
+        # Render thread, swaps in the mesh of the pending level once it is built; the bounds stay those
+        # of the full resolution mesh, which contain every level
+        if self.pending_lod is None or not (wait or self.pending_lod[1].done()):
+            return False
+        lod, future = self.pending_lod
+        self.pending_lod = None
+        self.lod = lod
+        self.mesh.release()
+        self.mesh = self.prototype.get_mesh(*future.result())
+        self.triangles = self.mesh.triangles
+        self.vao = self.mesh.vao
+        self.shadow_vao = self.mesh.shadow_vao
+        return True
+
+    def destroy(self):
+        if self.pending_lod is not None:
+            self.pending_lod[1].cancel()
+        self.mesh.release()
+
+
+class PrototypeHeightMapGround():
+    '''Ground drawn from height tiles: one flat grid per level of detail, shared by every chunk and
+    displaced in the vertex shader.
+
+    Only the loaded chunks are resident, each in a layer of one texture array with the samples of its
+    tile and the next sample around it (chunk_size + 3 per side).
+    '''
+    def __init__(self, app):
+        self.app = app
+        self.ctx = app.ctx
+        terrain = app.terrain
+        self.size = terrain.chunk_size
+        self.tile_size = self.size + 3
+        self.tile_dtype = terrain.height_map.dtype
+        self.shader_program = app.shader.get_shader('ground_height_map', fragment_name='ground')
+        self.layers = terrain.max_chunks
+        self.height_tex_id = app.texture.get_height_tiles(self.tile_size, self.layers, self.tile_dtype,
+                                                          name='height_tiles')
+        self.free_layers = list(range(self.layers - 1, -1, -1))
+        self.shader_program['u_centre'] = terrain.centre
+        self.shader_program['u_size'] = self.size
+        self.shader_program['u_max_height'] = terrain.max_height
+        self.shader_program['u_base_height'] = terrain.base_height
+        self.shader_program['u_scale'] = terrain.scale
+        self.grids = {}
+
+    def add_tile(self, tile):
+        # Layer of a new chunk, the array grows when more chunks are loaded than it holds
+        if not self.free_layers:
+            self.app.texture.get_height_tiles(self.tile_size, self.layers * 2, self.tile_dtype, name='height_tiles')
+            self.free_layers = list(range(self.layers * 2 - 1, self.layers - 1, -1))
+            self.layers *= 2
+        layer = self.free_layers.pop()
+        self.write_tile(layer, tile)
+        return layer
+
+    def write_tile(self, layer, tile):
+        tile = numpy.ascontiguousarray(tile, dtype=self.tile_dtype)
+        texture = self.app.texture.textures[self.height_tex_id]
+        texture.write(tile.tobytes(), viewport=(0, 0, layer, self.tile_size, self.tile_size, 1), alignment=1)
+
+    def remove_tile(self, layer):
+        self.free_layers.append(layer)
+
+    def get_grid(self, level):
+        # Grid vertices every 2 ** level samples, with the cells split like the terrain mesh
+        if level in self.grids:
+            return self.grids[level]
+        step = 2 ** level
+        count = self.size // step
+        samples = numpy.arange(count + 1) * step
+        x, z = numpy.meshgrid(samples, samples)
+        vertices = numpy.stack([x, z], axis=-1).reshape(-1, 2).astype('f4')
+        indices = get_grid_indices(count, count)
+        vbo = self.ctx.buffer(vertices)
+        ibo = self.ctx.buffer(indices)
+        vao = self.ctx.vertex_array(self.shader_program, [
+            (vbo, '2f', 'in_position'),
+        ], index_buffer=ibo, index_element_size=4)
+        self.grids[level] = (vbo, ibo, vao, indices.size // 3)
+        return self.grids[level]
+
+    def destroy(self):
+        for vbo, ibo, vao, _ in self.grids.values():
+            vao.release()
+            vbo.release()
+            ibo.release()
+        self.shader_program.release()
+
+
+class HeightMapGround():
+    '''Ground of a terrain chunk drawn by PrototypeHeightMapGround, it owns no buffers.'''
+    def __init__(self, app, position=(0, 0, 0), texture: str = 'dirt',
+                 terrain_chunk: Terrain = None, origin=(0, 0), bounds=None,
+                 albedo=(1.0, 1.0, 1.0), roughness=0.75, metallic=0.25):
+        self.app = app
+        self.ctx = app.ctx
+        self.origin = origin  # First height map sample of the chunk, the tile starts one sample before
+        self.m_model = glm.mat4(1)
+        self.can_update = False
+        self.can_render = True
+        self.can_render_shadow = True
+        self.has_shadow = False
+
+        self.albedo = glm.vec3(albedo)
+        self.roughness = roughness
+        self.metallic = metallic
+
+        self.prototype = self.app.prototype.get_object("height_map_ground")
+        self.shader_program = self.prototype.shader_program
+        self.lod = (0, (0, 0, 0, 0))
+        self.triangles = self.prototype.get_grid(0)[3]
+        # Same placement as the full resolution mesh of the chunk
+        self.bounds = get_bounds(terrain_chunk.vertices) if bounds is None else bounds
+
+        self.tex_id = app.texture.get_texture(path=f'../textures/{texture}.png')
+        self.height_tex_id = self.prototype.height_tex_id
+        self.layer = self.prototype.add_tile(terrain_chunk.height_map_border)
+
+        # Render queue state keys
+        self.transparent = False
+        self.textures = (self.tex_id, self.height_tex_id)
+        self.material = (*self.albedo, self.roughness, self.metallic)
+
+    def update(self):
+        pass
+
+    def bind_textures(self):
+        self.shader_program['u_tex_albedo'] = self.tex_id
+        self.shader_program['u_heights'] = self.height_tex_id
+        self.app.texture.textures[self.tex_id].use(location=self.tex_id)
+        self.app.texture.textures[self.height_tex_id].use(location=self.height_tex_id)
+
+    def bind_material(self):
+        self.shader_program['material.a'].value = self.albedo
+        self.shader_program['material.d'].value = self.roughness
+        self.shader_program['material.s'].value = self.metallic
+
+    def draw(self):
+        level, edges = self.lod
+        self.shader_program['u_origin'] = self.origin
+        self.shader_program['u_layer'] = self.layer
+        self.shader_program['u_edges'] = tuple(2 ** edge for edge in edges)
+        self.prototype.get_grid(level)[2].render(moderngl.TRIANGLES)
+
+    def render(self):
+        self.bind_textures()
+        self.bind_material()
+        self.draw()
+
+    def set_lod(self, level, edges, pool=None):
+        # The grids are shared, so a new level only changes which one is drawn
+        self.lod = (level, edges)
+        self.triangles = self.prototype.get_grid(level)[3]
+
+    def swap_lod(self, wait=False):
+        return False
+
+    def write_tile(self, tile):
+        # Heights of the chunk after an edit, the grids stay as they are
+        self.prototype.write_tile(self.layer, tile)
+
+    def destroy(self):
+        if self.layer is not None:
+            self.prototype.remove_tile(self.layer)
+            self.layer = None
+
 
 class PrototypeGrass:
+    lod_density = (1.0, 0.5, 0.25)  # Fraction of the blades kept in each of the get_lod_distances bands
+    cull_group_size = 64  # local_size_x in grass_cull.comp
+    # Indirect draws the cull pass counts into: an arrays command for the geometry shader path (points),
+    # then an elements command for the instanced path (18 blade indices)
+    commands = numpy.array([0, 1, 0, 0, 0, 18, 0, 0, 0, 0], dtype='u4')
+
     def __init__(self, app):
         self.app = app
         self.ctx = app.ctx
         self.shader_program = app.shader.get_shader('grass', geometry=True)
         self.shadow_program = app.shader.get_shader("shadow")
+        # Instanced blades with wind and level of detail in the vertex shader, instead of the geometry shader
+        self.instanced_program = app.shader.get_shader('grass_instanced', fragment_name='grass')
+        self.blade_vbo, self.blade_ibo = self.get_blade_buffers()
+        # Frustum, distance and density culling of the blades, compacted for indirect draws
+        self.cull_program = app.shader.get_compute_shader('grass_cull')
+        self.cull_program['u_lod_density'].value = self.lod_density
+        terrain = app.terrain
+        self.cull_program['u_lod_distances'].value = self.get_lod_distances(terrain.grass_distance,
+                                                                            terrain.chunk_size, terrain.scale)
+
+    @staticmethod
+    def get_lod_distances(grass_distance, chunk_size, scale):
+        # Grass is shown for chunks with any part within grass_distance, so the furthest blades are a
+        # chunk diagonal further; the density drops at half and all of grass_distance, and the blades
+        # past the furthest ones, with the dither of the distances (9.0), are culled
+        furthest = grass_distance + chunk_size * scale * math.sqrt(2.0)
+        return grass_distance * 0.5, grass_distance, furthest + 9.0
+
+    def get_blade_buffers(self):
+        # The three crossed quads grass.geom emits (0, 45 and -45 degrees), as corner offsets and texture coordinates
+        corners = [(-0.25, 0.0, 0.0, 0.0), (0.25, 0.0, 1.0, 0.0), (-0.25, 0.5, 0.0, 1.0), (0.25, 0.5, 1.0, 1.0)]
+        vertices = [(x, y, quad, u, v) for quad in range(3) for x, y, u, v in corners]
+        # Two triangles per quad, wound like the geometry shader's triangle strip
+        indices = [quad * 4 + i for quad in range(3) for i in (0, 1, 2, 2, 1, 3)]
+        return (self.ctx.buffer(numpy.array(vertices, dtype='f4')),
+                self.ctx.buffer(numpy.array(indices, dtype='u4')))
+
+    def get_variation_vbo(self, points):
+        # Per blade variation, computed once here instead of for every vertex
+        points = points.reshape(-1, 3)
+        variation = numpy.stack([shader_random(points[:, [0, 2]]), shader_random(points[:, [2, 0]]),
+                                 shader_fbm(points[:, [0, 2]])], axis=1)
+        return self.ctx.buffer(numpy.ascontiguousarray(variation, dtype='f4'))
+
+    def get_instanced_vao(self, points_vbo, variation_vbo):
+        vao = self.ctx.vertex_array(self.instanced_program, [
+            (self.blade_vbo, '3f 2f', 'in_corner', 'in_texcoord_0'),
+            (points_vbo, '3f/i', 'in_position'),
+            (variation_vbo, '3f/i', 'in_variation'),
+        ], index_buffer=self.blade_ibo, index_element_size=4)
+        return vao
 
-    def build(self, terrain_chunk: int = None):
-        self.terrain_chunk = terrain_chunk
-        self.vbo = self.get_vbo()
-        self.vao = self.get_vao()
-        self.shadow_vao = self.get_shadow_vao()
+    def cull(self, grass_objects):
+        # The planes and options are shared, then one dispatch per chunk
+        self.cull_program['u_planes'].write(self.app.camera.frustum_planes.astype('f4').tobytes())
+        self.cull_program['u_instanced'].value = self.app.instanced_grass
+        for obj in grass_objects:
+            obj.cull(self.cull_program)
+        # The draws read the compacted blades as vertex attributes and their counts as indirect commands
+        self.ctx.memory_barrier(moderngl.VERTEX_ATTRIB_ARRAY_BARRIER_BIT | moderngl.COMMAND_BARRIER_BIT)
+
+    def build(self, terrain_chunk: Terrain = None):
+        # Every chunk gets its own buffers, the programs are shared
+        vbo = self.ctx.buffer(terrain_chunk.vertices_mesh)
+        # Blades grow from these points, so pad the bounds by the largest blade the geometry shader emits
+        center, extents = get_bounds(terrain_chunk.vertices_mesh)
+        return TerrainMesh(vbo, self.get_vao(vbo), self.get_shadow_vao(vbo), (center, extents + 1.0))
 
     def destroy(self):
         self.shader_program.release()
-        self.vao.release()
-        self.shadow_vao.release()
-        self.vbo.release()
+        self.instanced_program.release()
+        self.cull_program.release()
+        self.blade_vbo.release()
+        self.blade_ibo.release()
 
-    def get_vao(self):
+    def get_vao(self, vbo):
         vao = self.ctx.vertex_array(self.shader_program, [
-            (self.vbo, '3f', 'in_position'),
+            (vbo, '3f', 'in_position'),
         ])
         return vao
 
-    def get_shadow_vao(self):
+    def get_shadow_vao(self, vbo):
         vao = self.ctx.vertex_array(self.shadow_program, [
-            (self.vbo, '3f', 'in_position'),
+            (vbo, '3f', 'in_position'),
         ], skip_errors=True)
         # Temporary fix for the issue with the shadow program because we are not using texture coordinates
         # So we set skip_errors=True to ignore the missing in_texcoord_0 attribute
         return vao
 
-    def get_vbo(self):
-        return self.ctx.buffer(self.terrain_chunk.vertices_mesh)
-
 
 class Grass:
     def __init__(self, app, position=(0, 0, 0), texture: str = 'grass_0',
@@ -1022,6 +2367,7 @@ class Grass:
         self.m_model = self.position
         self.can_update = True
         self.can_render = True
+        self.can_render_shadow = True
         self.has_shadow = False  # To correctly cast grass shadows from the billboards into the shadow map..
         # We need to create a new shadow shader just for billboards, which uses a geom shader.
         # I will add this soon.
@@ -1031,9 +2377,22 @@ class Grass:
         self.metallic = metallic
 
         this_object = self.app.prototype.get_object("grass")
-        this_object.build(terrain_chunk)
-        self.vao = this_object.vao
+        self.prototype = this_object
+        self.mesh = this_object.build(terrain_chunk)
+        self.vao = self.mesh.vao
+        self.bounds = self.mesh.bounds
         self.shader_program = this_object.shader_program
+        # Instanced path, built the first time it is drawn
+        self.points = terrain_chunk.vertices_mesh
+        self.count = self.points.size // 3
+        self.variation_vbo = None
+        self.instanced_vao = None
+        # Culled path, the blades in view are compacted into these by the cull pass and drawn indirectly
+        self.visible_vbo = None
+        self.commands = None
+        self.culled_vao = None
+        self.visible_variation_vbo = None
+        self.culled_instanced_vao = None
 
         self.tex_id = app.texture.get_alpha_texture(path=f'../textures/{texture}.png')
         self.tex_id_wind = app.texture.get_basic_texture(path=f'../textures/flow_map.png')
@@ -1044,33 +2403,147 @@ class Grass:
         self.app.texture.textures[self.tex_id].use(location=self.tex_id)
         self.app.texture.textures[self.tex_id_wind].use(location=self.tex_id_wind)
 
+        # Render queue state keys, the blades are alpha blended so they are drawn after the opaque objects
+        self.transparent = True
+        self.textures = (self.tex_id, self.tex_id_wind)
+        self.material = (*self.albedo, self.roughness, self.metallic)
+
     def update(self):
+        # Either path can be picked at runtime, the render queue sorts by the program in use
+        if self.app.instanced_grass:
+            self.shader_program = self.prototype.instanced_program
+        else:
+            self.shader_program = self.prototype.shader_program
         self.shader_program['u_time'].value = self.app.time
 
-    def render(self):
-        # Position
-        # self.shader_program['m_model'].write(self.m_model)
+    def bind_textures(self):
+        self.shader_program['u_tex_albedo'] = self.tex_id
+        self.shader_program['u_wind'] = self.tex_id_wind
+        self.app.texture.textures[self.tex_id].use(location=self.tex_id)
+        self.app.texture.textures[self.tex_id_wind].use(location=self.tex_id_wind)
 
-        # Material
+    def bind_material(self):
         self.shader_program['material.a'].value = self.albedo
         self.shader_program['material.d'].value = self.roughness
         self.shader_program['material.s'].value = self.metallic
 
-        # Texture
-        self.shader_program['u_tex_albedo'] = self.tex_id
-        self.shader_program['u_wind'] = self.tex_id_wind
-        self.app.texture.textures[self.tex_id].use(location=self.tex_id)
-        self.app.texture.textures[self.tex_id_wind].use(location=self.tex_id_wind)
+    def cull(self, cull_program):
+        if self.visible_vbo is None:
+            self.visible_vbo = self.ctx.buffer(reserve=self.mesh.vbo.size)
+            self.commands = self.ctx.buffer(reserve=self.prototype.commands.nbytes)
+            self.culled_vao = self.prototype.get_vao(self.visible_vbo)
+        if self.app.instanced_grass and self.culled_instanced_vao is None:
+            if self.variation_vbo is None:
+                self.variation_vbo = self.prototype.get_variation_vbo(self.points)
+            self.visible_variation_vbo = self.ctx.buffer(reserve=self.variation_vbo.size)
+            self.culled_instanced_vao = self.prototype.get_instanced_vao(self.visible_vbo, self.visible_variation_vbo)
+
+        # Counts start from zero, the cull pass adds the blades it keeps
+        self.commands.write(self.prototype.commands)
+        self.mesh.vbo.bind_to_storage_buffer(0)
+        self.visible_vbo.bind_to_storage_buffer(1)
+        self.commands.bind_to_storage_buffer(2)
+        if self.app.instanced_grass:
+            self.variation_vbo.bind_to_storage_buffer(3)
+            self.visible_variation_vbo.bind_to_storage_buffer(4)
+        cull_program['u_count'].value = self.count
+        group_size = self.prototype.cull_group_size
+        cull_program.run((self.count + group_size - 1) // group_size)
+
+    def draw(self):
+        # Position
+        # self.shader_program['m_model'].write(self.m_model)
+
+        if self.shader_program is self.prototype.instanced_program:
+            if self.app.grass_culling:
+                self.culled_instanced_vao.render_indirect(self.commands, moderngl.TRIANGLES, count=1, first=1)
+                return
+            if self.instanced_vao is None:
+                if self.variation_vbo is None:
+                    self.variation_vbo = self.prototype.get_variation_vbo(self.points)
+                self.instanced_vao = self.prototype.get_instanced_vao(self.mesh.vbo, self.variation_vbo)
+            self.instanced_vao.render(moderngl.TRIANGLES, instances=self.count)
+            return
+
+        if self.app.grass_culling:
+            self.culled_vao.render_indirect(self.commands, moderngl.POINTS, count=1, first=0)
+            return
 
         # self.ctx.enable(moderngl.ONE_MINUS_DST_ALPHA) // Testing
         self.vao.render(moderngl.POINTS)
         # self.ctx.disable(moderngl.ONE_MINUS_DST_ALPHA)
 
+    def render(self):
+        self.bind_material()
+        self.bind_textures()
+        self.draw()
+
+    def destroy(self):
+        self.mesh.release()
+        if self.instanced_vao is not None:
+            self.instanced_vao.release()
+        if self.variation_vbo is not None:
+            self.variation_vbo.release()
+        if self.visible_vbo is not None:
+            self.culled_vao.release()
+            self.visible_vbo.release()
+            self.commands.release()
+        if self.culled_instanced_vao is not None:
+            self.culled_instanced_vao.release()
+            self.visible_variation_vbo.release()
+
+
+class RenderQueue():
+    '''Visible draws of a frame, sorted so state is only bound when it differs from the previous draw.
+
+    Opaque draws are grouped by program, then sorted by texture set, then material, and front to back
+    within the same state. Transparent draws follow, back to front. ModernGL binds the program on every
+    render call, so only the texture and material binds are counted. They are per program state, so
+    they are compared together with the program.
+    '''
+    states = ['textures', 'material']
+
+    def __init__(self, app):
+        self.app = app
+        self.changes = {name: 0 for name in self.states}
+        self.avoided = {name: 0 for name in self.states}
+
+    def render(self, objects, centers):
+        # objects are the visible draws, centers their world space bounds centres
+        self.changes = {name: 0 for name in self.states}
+        self.avoided = {name: 0 for name in self.states}
+        distances = ((centers - numpy.array(self.app.camera.position, dtype='f4')) ** 2).sum(axis=1).tolist()
+        opaque = sorted((obj.shader_program.glo, obj.textures, obj.material, distance, i)
+                        for i, (obj, distance) in enumerate(zip(objects, distances)) if not obj.transparent)
+        transparent = sorted(((-distance, i) for i, (obj, distance) in enumerate(zip(objects, distances))
+                              if obj.transparent))
+
+        last_textures = last_material = None
+        for i in [key[-1] for key in opaque] + [key[-1] for key in transparent]:
+            obj = objects[i]
+            program = obj.shader_program.glo
+            textures = (program, obj.textures)
+            material = (program, obj.material)
+            if self.count('textures', textures != last_textures):
+                obj.bind_textures()
+            if self.count('material', material != last_material):
+                obj.bind_material()
+            obj.draw()
+            last_textures, last_material = textures, material
+
+    def count(self, name, changed):
+        if changed:
+            self.changes[name] += 1
+        else:
+            self.avoided[name] += 1
+        return changed
+
 
 class Scene():
     objects = []
     update_list = []
-    moved = True
+    camera_version = -1
+    draw_calls = 0
 
     def __init__(self, app):
         self.app = app
@@ -1120,10 +2593,8 @@ class Scene():
         self.objects.append(Cube(app, position=(_g*3, 0, 0), texture="metal_1",
                                  albedo=(1.00, 0.71, 0.29), roughness=0.35, metallic=0.95))
 
-        # Terrain, Ground, and Grass
-        terrain_chunk_0 = self.app.terrain.add_chunk(self.app, name=0)
-        self.objects.append(Grass(self.app, terrain_chunk=terrain_chunk_0))
-        self.objects.append(Ground(self.app, terrain_chunk=terrain_chunk_0))
+        # Terrain, Ground, and Grass chunks around the camera, streamed in as it moves
+        self.app.terrain.update(self, wait=True)
 
         # Debug lights
         self.light_source_global = LightSource(app, light_source=self.app.global_light)
@@ -1131,65 +2602,366 @@ class Scene():
         for light in self.app.lights:
             self.light_source_local.append(LightSource(app, light_source=light))
 
+        self.render_queue = RenderQueue(app)
+        self.build()
+
+    def add_object(self, obj):
+        self.objects.append(obj)
+        self.dirty = True
+
+    def remove_object(self, obj):
+        self.objects.remove(obj)
+        self.dirty = True
+
+    def build(self):
+        # Run again when objects are added or removed
+        self.dirty = False
+
         # Cache the update list
-        for obj in self.objects:
-            if obj.can_update:
-                self.update_list.append(obj)
+        self.update_list = [obj for obj in self.objects if obj.can_update]
+        self.grass_list = [obj for obj in self.objects if isinstance(obj, Grass)]
+
+        # World space bounds of every object, kept in arrays so they can be culled together
+        self.bounds_center = numpy.zeros((len(self.objects), 3), dtype='f4')
+        self.bounds_extents = numpy.zeros((len(self.objects), 3), dtype='f4')
+        for i, obj in enumerate(self.objects):
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+        self.all_indices = numpy.arange(len(self.objects))
+        self.update_indices = numpy.array([i for i, obj in enumerate(self.objects) if obj.can_update], dtype=int)
+        self.camera_version = -1
 
     def update(self):
-        if self.moved == False:
-            for obj in self.update_list:
-                obj.update()
-            return
-        camera_pos = self.app.camera.position
-        for obj in self.objects:
-            if obj.can_update:
-                obj.update()
-            angle_from_camera = glm.degrees(glm.acos(glm.dot(glm.normalize(obj.pos - camera_pos),
-                                                             self.app.camera.forward)))
-            if angle_from_camera <= 120.0:  # View frustum
-                obj.can_render = True
-                continue
-            distance = glm.distance(camera_pos, obj.pos)
-            if distance <= 10.0:
-                obj.can_render = True
-                continue
-            obj.can_render = False
-        self.moved = False
+        self.app.terrain.update(self)
+        if self.dirty:
+            self.build()
+
+        for i, obj in zip(self.update_indices, self.update_list):
+            obj.update()
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+
+        # Re-cull everything when the camera changed, otherwise only the objects that may have moved
+        if self.camera_version != self.app.camera.version:
+            self.camera_version = self.app.camera.version
+            indices = self.all_indices
+        else:
+            indices = self.update_indices
+        visible = frustum_cull(self.app.camera.frustum_planes,
+                               self.bounds_center[indices], self.bounds_extents[indices])
+        for i, can_render in zip(indices.tolist(), visible.tolist()):
+            self.objects[i].can_render = can_render
+
+        # Shadow casters are culled against each cascade, the global light rotates every frame
+        self.app.shadow.update()
+        casters = self.all_indices[[obj.has_shadow for obj in self.objects]]
+        can_render_shadow = numpy.zeros(len(self.objects), dtype=bool)
+        self.shadow_casters = []
+        for m_light_proj_view in self.app.shadow.m_light_proj_view:
+            visible = frustum_cull(get_frustum_planes(m_light_proj_view),
+                                   self.bounds_center[casters], self.bounds_extents[casters])
+            self.shadow_casters.append([self.objects[i] for i in casters[visible].tolist()])
+            can_render_shadow[casters[visible]] = True
+        for obj, can_render in zip(self.objects, can_render_shadow.tolist()):
+            obj.can_render_shadow = can_render
 
     def render(self):
+        self.draw_calls = 0
         self.app.prototype.common_render_update()
 
         # Clear buffers
-        self.app.shadow.depth_fbo.clear()
         self.app.ctx.clear(color=(0.08, 0.16, 0.18))
 
-        # Pass 1 - Render the depth map for the global light shadows
+        # Pass 0 - Compact the grass blades in view, so only those reach the vertex and geometry stages
+        if self.app.grass_culling:
+            with self.app.gpu_timer.query('cull'):
+                self.app.prototype.get_object("grass").cull([obj for obj in self.grass_list if obj.can_render])
+
+        # Pass 1 - Render the depth map of each cascade for the global light shadows
         if self.app.show_global_light:
-            # Enable front face culling in ctx to remove peter-panning flying shadows
-            self.ctx.cull_face = "front"
-            self.app.shadow.depth_fbo.use()
-            for obj in self.objects:
-                if obj.can_render and obj.has_shadow:
-                    obj.render_shadow()
-            self.ctx.cull_face = "back"
+            with self.app.gpu_timer.query('shadow'):
+                # Enable front face culling in ctx to remove peter-panning flying shadows
+                self.ctx.cull_face = "front"
+                self.draw_calls += self.app.shadow.render(self.shadow_casters)
+                self.ctx.cull_face = "back"
 
         # Pass 2 - Render the scene
-        self.app.ctx.screen.use()  # Switch back to the screen
-        for obj in self.objects:
-            if obj.can_render:
-                obj.render()
+        self.app.screen.use()  # Switch back to the screen
+        with self.app.gpu_timer.query('main'):
+            indices = [i for i, obj in enumerate(self.objects) if obj.can_render]
+            self.render_queue.render([self.objects[i] for i in indices], self.bounds_center[indices])
+            self.draw_calls += len(indices)
 
         # Render debug lights
         if self.app.show_light_sources:
-            if self.app.show_global_light:
-                self.light_source_global.render()
-            if self.app.local_light == 1.0:
-                for light_source in self.light_source_local:
-                    light_source.render()
+            with self.app.gpu_timer.query('lights'):
+                if self.app.show_global_light:
+                    self.light_source_global.render()
+                    self.draw_calls += 1
+                if self.app.local_light == 1.0:
+                    for light_source in self.light_source_local:
+                        light_source.render()
+                        self.draw_calls += 1
+
+        # Performance overlay
+        if self.app.show_hud:
+            self.app.hud.render()
+            self.draw_calls += 1
 
         # Swap buffers
-        pygame.display.flip()
+        if not self.app.headless:
+            pygame.display.flip()
 
     def destroy(self):
         pass
+
+
+class CpuTimer():
+    '''CPU time of named engine sections for the current frame, in milliseconds.'''
+
+    def __init__(self):
+        self.times = {}
+        self.frame_start = 0.0
+        self.section_start = 0.0
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.section_start = self.frame_start
+
+    def begin(self):
+        self.section_start = time.perf_counter()
+
+    def end(self, name):
+        now = time.perf_counter()
+        self.times[name] = (now - self.section_start) * 1000.0
+        self.section_start = now
+
+    def end_frame(self):
+        self.times['frame'] = (time.perf_counter() - self.frame_start) * 1000.0
+
+
+class Benchmark():
+    '''Replay a scripted camera path with a fixed delta time and save frame time percentiles to JSON.'''
+    sections = ['camera_update', 'scene_update', 'scene_render', 'frame']
+
+    def __init__(self, app, frames=600, warmup_frames=30, delta_time=16.0, path='benchmark.json',
+                 radius=4.0, height=1.0, pitch=15.0):
+        self.app = app
+        self.frames = frames
+        self.warmup_frames = warmup_frames
+        self.delta_time = delta_time
+        self.path = path
+        self.radius = radius
+        self.height = height
+        self.pitch = pitch
+        self.frame = 0
+        self.finished = False
+        self.samples = {name: [] for name in self.sections}
+        self.gpu_samples = {}
+        # The path is a closed loop that starts and ends at the initial camera placement
+        self.start_position = glm.vec3(app.camera.position)
+        self.start_yaw = app.camera.yaw
+        self.start_pitch = app.camera.pitch
+        # Let time run (with the fixed step) so animated objects are part of the measured work
+        self.app.paused = False
+
+    def set_camera(self):
+        angle = 2.0 * math.pi * self.frame / (self.warmup_frames + self.frames)
+        camera = self.app.camera
+        camera.position = self.start_position + glm.vec3(math.sin(angle) * self.radius,
+                                                         math.sin(angle * 2.0) * self.height,
+                                                         (math.cos(angle) - 1.0) * self.radius)
+        camera.yaw = self.start_yaw + math.degrees(angle)
+        camera.pitch = self.start_pitch + math.sin(angle * 2.0) * self.pitch
+
+    def record(self):
+        if self.frame >= self.warmup_frames:
+            for name in self.sections:
+                self.samples[name].append(self.app.cpu_timer.times[name])
+            for name, elapsed in self.app.gpu_timer.last.items():
+                self.gpu_samples.setdefault(name, []).append(elapsed)
+        self.frame += 1
+        if self.frame >= self.warmup_frames + self.frames:
+            self.finished = True
+
+    def summarize(self, samples):
+        samples = numpy.array(samples, dtype='f8')
+        return {
+            'p50': float(numpy.percentile(samples, 50)),
+            'p95': float(numpy.percentile(samples, 95)),
+            'p99': float(numpy.percentile(samples, 99)),
+            'max': float(samples.max()),
+            'mean': float(samples.mean()),
+        }
+
+    def save(self):
+        results = {
+            'frames': self.frames,
+            'warmup_frames': self.warmup_frames,
+            'delta_time': self.delta_time,
+            'win_size': list(self.app.win_size),
+            'headless': self.app.headless,
+            'renderer': self.app.ctx.info['GL_RENDERER'],
+            'cpu_ms': {name: self.summarize(samples) for name, samples in self.samples.items()},
+            'gpu_ms': {name: self.summarize(samples) for name, samples in self.gpu_samples.items()},
+        }
+        with open(self.path, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"saved benchmark: {self.path}")
+
+
+class GpuTimer():
+    '''GPU time of named render passes, in milliseconds, from time-elapsed queries.
+
+    Each pass owns a small ring of queries and a result is only read back `latency` frames
+    after it was issued, when the GPU has finished with it, so reading does not stall the frame.
+    '''
+
+    def __init__(self, app, latency=3, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.latency = latency
+        self.slots = latency + 1
+        self.slot = 0
+        self.history_size = history
+        self.queries = {}
+        self.issued = {}
+        self.history = {}
+        self.last = {}
+
+    def query(self, name):
+        '''Return the query for this pass and frame, use it as a context manager around the pass.'''
+        if name not in self.queries:
+            self.queries[name] = [self.ctx.query(time=True) for _ in range(self.slots)]
+            self.issued[name] = [False] * self.slots
+            self.history[name] = deque(maxlen=self.history_size)
+        self.issued[name][self.slot] = True
+        return self.queries[name][self.slot]
+
+    def end_frame(self):
+        # The next slot was issued `latency` frames ago, read it back before it is reused
+        self.slot = (self.slot + 1) % self.slots
+        self.last = {}
+        for name, queries in self.queries.items():
+            if self.issued[name][self.slot]:
+                elapsed = queries[self.slot].elapsed * 1e-6  # Nanoseconds to milliseconds
+                self.history[name].append(elapsed)
+                self.last[name] = elapsed
+                self.issued[name][self.slot] = False
+
+    def get_times(self):
+        '''Rolling mean GPU time per pass, in milliseconds.'''
+        return {name: sum(history) / len(history) for name, history in self.history.items() if len(history) > 0}
+
+
+class Hud():
+    '''Toggleable performance overlay, drawn as a textured quad over the finished frame.
+
+    Lines are refreshed one at a time, spread over the `refresh` interval, and only re-rendered
+    when their text changed; most frames the overlay is a single cached quad draw and at worst
+    one small font render and sub-texture write.
+    '''
+    lines = 13
+
+    def __init__(self, app, width=320, margin=10, refresh=250, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.margin = margin
+        self.refresh = refresh
+        self.elapsed = 0.0
+        self.line = 0
+        self.texts = [None] * self.lines
+        self.cost = 0.0
+        self.line_height = self.app.font.get_linesize()
+        self.size = (width, self.line_height * self.lines)
+        self.background = (0, 0, 0, 160)
+        self.text_color = (255, 255, 255)
+
+        # Rolling history of the frame, cpu section and overlay times
+        self.frame_times = deque(maxlen=history)
+        self.costs = deque(maxlen=history)
+        self.cpu_history = {}
+        self.history = history
+
+        # Texture the text is drawn into, cleared to the background colour
+        self.tex_id = self.app.texture.get_color_texture(size=self.size, name='hud')
+        self.texture = self.app.texture.textures[self.tex_id]
+        self.texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        surface = pygame.Surface(self.size, flags=pygame.SRCALPHA)
+        surface.fill(self.background)
+        self.texture.write(pygame.image.tostring(surface, 'RGBA', True))
+        self.line_surface = pygame.Surface((self.size[0], self.line_height), flags=pygame.SRCALPHA)
+
+        self.shader_program = self.app.shader.get_shader('hud')
+        self.shader_program['u_tex'] = self.tex_id
+        self.vbo = self.ctx.buffer(reserve=6 * 4 * 4)  # 6 vertices of 2f position and 2f texture coordinates
+        self.vao = self.ctx.vertex_array(self.shader_program, [
+            (self.vbo, '2f 2f', 'in_position', 'in_texcoord_0'),
+        ])
+        self.win_size = None
+
+    def set_quad(self):
+        # Pixel rectangle in the top left corner to normalized device coordinates
+        self.win_size = self.app.win_size
+        w, h = self.win_size
+        x0 = -1.0 + 2.0 * self.margin / w
+        x1 = x0 + 2.0 * self.size[0] / w
+        y1 = 1.0 - 2.0 * self.margin / h
+        y0 = y1 - 2.0 * self.size[1] / h
+        vertices = [(x0, y0, 0, 0), (x1, y0, 1, 0), (x1, y1, 1, 1), (x0, y1, 0, 1)]
+        indices = [(0, 1, 2), (2, 3, 0)]
+        self.vbo.write(generate_vertex_data(vertices, indices))
+
+    def get_lines(self):
+        lines = [f"frame {sum(self.frame_times) / len(self.frame_times):.2f} ms  fps {self.app.fps:.1f}",
+                 f"draw calls {self.app.scene.draw_calls}  grass {'instanced' if self.app.instanced_grass else 'geometry'}"
+                 f"{'  culled' if self.app.grass_culling else ''}"]
+        for name, history in self.cpu_history.items():
+            lines.append(f"cpu {name} {sum(history) / len(history):.3f} ms")
+        for name, elapsed in self.app.gpu_timer.get_times().items():
+            lines.append(f"gpu {name} {elapsed:.3f} ms")
+        queue = self.app.scene.render_queue
+        lines.append("binds " + "  ".join(f"{name} {queue.changes[name]}/{queue.changes[name] + queue.avoided[name]}"
+                                           for name in queue.states))
+        terrain = self.app.terrain
+        lines.append(f"chunks shown {len(terrain.shown)} cached {len(terrain.loaded) - len(terrain.shown)}"
+                     f" pending {len(terrain.pending)}  tris {terrain.triangles}")
+        lines.append(f"hud {sum(self.costs) / len(self.costs):.3f} ms")
+        return lines
+
+    def write_line(self, text):
+        self.line_surface.fill(self.background)
+        self.line_surface.blit(self.app.font.render(text, True, self.text_color), (4, 0))
+        y = self.size[1] - (self.line + 1) * self.line_height  # Texture rows start at the bottom
+        self.texture.write(pygame.image.tostring(self.line_surface, 'RGBA', True),
+                           viewport=(0, y, self.size[0], self.line_height))
+
+    def render(self):
+        start = time.perf_counter()
+        self.frame_times.append(self.app.raw_delta_time)
+        self.costs.append(self.cost)
+        for name, value in self.app.cpu_timer.times.items():
+            if name not in self.cpu_history:
+                self.cpu_history[name] = deque(maxlen=self.history)
+            self.cpu_history[name].append(value)
+
+        # Refresh the next line once its share of the refresh interval has passed
+        self.elapsed += self.app.raw_delta_time
+        if self.elapsed >= self.refresh / self.lines:
+            self.elapsed = 0.0
+            lines = self.get_lines()
+            text = lines[self.line] if self.line < len(lines) else ''
+            if text != self.texts[self.line]:
+                self.texts[self.line] = text
+                self.write_line(text)
+            self.line = (self.line + 1) % self.lines
+
+        if self.win_size != self.app.win_size:
+            self.set_quad()
+        self.texture.use(location=self.tex_id)
+        self.ctx.disable(moderngl.DEPTH_TEST)
+        self.vao.render()
+        self.ctx.enable(moderngl.DEPTH_TEST)
+        self.cost = (time.perf_counter() - start) * 1000.0
+
+    def destroy(self):
+        self.vao.release()
+        self.vbo.release()
@@ -7,18 +7,14 @@ layout (location = 2) in vec3 in_normal;
 out vec2 uv_0;
 out vec3 normal;
 out vec3 frag_pos;
-out vec4 shadow_coord;
 
-uniform mat4 m_proj;
-uniform mat4 m_view;
-uniform mat4 m_model;
-uniform mat4 m_view_global_light;
-
-// Bias offset to remove shadow acne
-const float tiny = -0.0005;
+layout (std140, binding = 0) uniform Camera {
+    mat4 m_proj;
+    mat4 m_proj_view;
+    vec3 cam_pos;
+};
 
-// Bias matrix to convert the coordinates from [-1, 1] to [0, 1] from clip space to texture space
-const mat4 m_shadow_bias = mat4(0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.5, 0.5, 0.5, 1.0);
+uniform mat4 m_model;
 
 void main() {
     const vec4 in_position4 = vec4(in_position, 1.0);
@@ -26,9 +22,5 @@ void main() {
     uv_0 = in_texcoord_0.xy;
     normal = mat3(transpose(inverse(m_model))) * in_normal;
     frag_pos = vec3(m_model * in_position4);
-    gl_Position = m_proj * m_view * m_model * in_position4;
-
-    const mat4 shadow_mvp = m_proj * m_view_global_light * m_model;
-    shadow_coord = m_shadow_bias * shadow_mvp * in_position4;
-    shadow_coord.z += tiny;
+    gl_Position = m_proj_view * m_model * in_position4;
 }
\ No newline at end of file
@@ -0,0 +1,115 @@
+#version 460 core
+
+// Blade mesh, three crossed quads of four corners
+layout (location = 0) in vec3 in_corner; // x, y of the corner and the quad it belongs to (0, 1, 2)
+layout (location = 1) in vec2 in_texcoord_0;
+// Per blade
+layout (location = 2) in vec3 in_position;
+layout (location = 3) in vec3 in_variation; // random(xz), random(zx) and fbm(xz), as grass.geom computes them
+
+out GS_OUT {
+	vec2 uv_0;
+	float color_variation;
+	vec3 normal;
+	vec3 frag_pos;
+} gs_out;
+
+layout (std140, binding = 0) uniform Camera {
+	mat4 m_proj;
+	mat4 m_proj_view;
+	vec3 cam_pos;
+};
+
+uniform sampler2D u_wind;
+uniform float u_time;
+
+const mat4 model_wind = mat4(1);
+const vec2 windDirection = vec2(1.0, 1.0);
+const float windStrength = 0.15;
+const float grass_scale = 2.0;
+const float grass_min = 0.5;
+
+const float LOD1 = 50.0;
+const float LOD2 = 100.0;
+const float LOD3 = 400.0;
+
+const float PI = 3.141592653589793;
+
+const float rot_45 = radians(45);
+const mat4 quad_models[3] = mat4[3](
+	mat4(1.0),
+	mat4(cos(rot_45), 0, sin(rot_45), 0, 0, 1.0, 0, 0, -sin(rot_45), 0, cos(rot_45), 0, 0, 0, 0, 1),
+	mat4(cos(-rot_45), 0, sin(-rot_45), 0, 0, 1.0, 0, 0, -sin(-rot_45), 0, cos(-rot_45), 0, 0, 0, 0, 1)
+);
+
+// Functions
+mat4 rotationX(in float angle);
+mat4 rotationY(in float angle);
+mat4 rotationZ(in float angle);
+
+void main() {
+	const int quad = int(in_corner.z);
+
+	// Same level of detail as grass.geom: 3 quads near, the two crossed ones further, then one, then none
+	float dist_length = length(in_position - cam_pos);
+	float t = 6.0;
+	if (dist_length > LOD1) {
+		t *= 1.5;
+	}
+	dist_length += (in_variation.x * t - t * 0.5);
+	float lod2_dist = 1.0;
+	float lod3_dist = 1.0;
+	int detail_level = 3;
+	if (dist_length > LOD1) {
+		detail_level = 2;
+		lod2_dist = 0.0;
+	}
+	if (dist_length > LOD2) {
+		detail_level = 1;
+		lod3_dist = 0.0;
+	}
+	const bool visible = dist_length <= LOD3 && (detail_level == 3 || (detail_level == 2 && quad != 0)
+	                                             || (detail_level == 1 && quad == 0));
+	if (!visible) {
+		gl_Position = vec4(2.0, 2.0, 2.0, 1.0); // Outside the clip volume, the blade's triangles are dropped
+		return;
+	}
+
+	// Diminish the wind based on LOD levels
+	const float wind_scale = 0.6 + (lod2_dist * 0.25) + (lod3_dist * 0.15);
+
+	// Wind calculation using the flow map texture and time
+	const float wind_pos_scale = 0.1;
+	vec2 uv = in_position.xz * wind_pos_scale + windDirection * windStrength * u_time * wind_scale;
+	uv.x = mod(uv.x, 1.0);
+	uv.y = mod(uv.y, 1.0);
+	const vec4 wind = texture(u_wind, uv);
+	const mat4 wind_mat = rotationX(wind.x * PI * 0.75 - PI * 0.25) * rotationZ(wind.y * PI * 0.75 - PI * 0.25);
+
+	// The back of the quad will be invisible to the camera, so we rotate the quad with a random amount
+	const mat4 rand_y = rotationY(in_variation.y * PI);
+	const mat4 x_model = quad_models[quad];
+	const float grass_size = in_variation.x * grass_scale * (1.0 - grass_min) + grass_min;
+
+	// The top corners bend with the wind
+	const mat4 bend = in_corner.y > 0.0 ? wind_mat : model_wind;
+	const vec4 position = vec4(in_position, 1.0) + bend * rand_y * x_model * vec4(in_corner.xy, 0.0, 0.0) * grass_size;
+
+	gl_Position = m_proj_view * position;
+	gs_out.uv_0 = in_texcoord_0;
+	gs_out.frag_pos = vec3(position);
+	gs_out.normal = normalize(vec3(model_wind * rand_y * x_model * vec4(0.0, 1.0, 0.0, 0.0)));
+	gs_out.color_variation = in_variation.z;
+}
+
+mat4 rotationX(in float angle) {
+	return mat4(1.0, 0, 0, 0, 0, cos(angle), -sin(angle), 0, 0, sin(angle), cos(angle), 0, 0, 0, 0, 1);
+}
+
+mat4 rotationY(in float angle) {
+	return mat4(cos(angle), 0, sin(angle), 0, 0, 1.0, 0, 0, -sin(angle), 0, cos(angle), 0, 0, 0, 0, 1);
+}
+
+mat4 rotationZ(in float angle) {
+	return mat4(cos(angle), -sin(angle), 0, 0, sin(angle), cos(angle), 0, 0, 0, 0, 1, 0, 0, 0, 0, 1);
+}
\ No newline at end of file
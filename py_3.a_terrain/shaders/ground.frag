@@ -5,7 +5,6 @@ layout (location = 0) out vec4 frag_color;
 in vec2 uv_0;
 in vec3 normal;
 in vec3 frag_pos;
-in vec4 shadow_coord;
 in float color_variation;
 
 struct Light {
@@ -37,17 +36,33 @@ struct Material {
 };
 
 const int max_lights = 99;
+const int max_cascades = 4;
 
 // uniform vec2 u_resolution;
-uniform vec3 cam_pos;
-uniform PointLight lights[max_lights];
-uniform float num_lights;
+layout (std140, binding = 0) uniform Camera {
+  mat4 m_proj;
+  mat4 m_proj_view;
+  vec3 cam_pos;
+};
+
+layout (std140, binding = 1) uniform Lights {
+  Light global_light;
+  SpotLight flash_light;
+  float num_lights;
+  PointLight lights[max_lights];
+};
 
-uniform Light global_light;
-uniform SpotLight flash_light;
+layout (std140, binding = 2) uniform Debug {
+  float texture_blend;
+  float local_light_blend;
+};
+
+layout (std140, binding = 3) uniform Shadows {
+  mat4 m_shadow[max_cascades]; // World to shadow map coordinates of each cascade, each in its column of the map
+  vec4 cascade_splits; // View depth where each cascade ends
+  vec4 shadow_forward; // Camera forward (xyz) and number of cascades (w)
+};
 
-uniform float texture_blend;
-uniform float local_light_blend;
 uniform Material material;
 uniform sampler2D u_tex_albedo;
 uniform sampler2DShadow shadow_map_tex;
@@ -56,6 +71,26 @@ const float PI = 3.14159265359;
 const vec3 gamma = vec3(2.2);
 const vec3 i_gamma = vec3(1 / 2.2);
 
+// Bias offset to remove shadow acne
+const float tiny = -0.0005;
+
+float get_shadow(vec3 position) {
+  // The nearest cascade that covers the view depth of the fragment
+  const float depth = dot(position - cam_pos, shadow_forward.xyz);
+  const int cascades = int(shadow_forward.w);
+  int cascade = 0;
+  while (cascade < cascades - 1 && depth > cascade_splits[cascade]) {
+    cascade++;
+  }
+  vec4 shadow_coord = m_shadow[cascade] * vec4(position, 1.0);
+  shadow_coord.z += tiny;
+  // Force shadow off past the last cascade, or if z is outside the far plane of the light projection
+  if (depth > cascade_splits[cascade] || shadow_coord.z > 1.0) {
+    return 1.0;
+  }
+  return texture(shadow_map_tex, shadow_coord.xyz);
+}
+
 // const vec3 fog_albedo = vec3(0.333);
 // const float flog_Scale = 0.15 / 10; // Higher is stronger rescale [0.0 to 1.0] to [0.0 to 0.1] i.e 0.015;
 
@@ -109,14 +144,8 @@ vec3 directional_light(vec3 N, vec3 V, Light light, vec3 F0) {
   const vec3 D = normalize(light.position - light.direction);
   const vec3 H = normalize(V + D);
 
-  // Shadow
-  // Force shadow off if z is outside the far plane of the frustum
-  const float shadow = mix(textureProj(shadow_map_tex, shadow_coord), 1.0, 1.0 - step(1.0, shadow_coord.z));
-  // ... equivalent of: 
-  // float shadow = textureProj(shadow_map_tex, shadow_coord);
-  // if (shadow_coord.z < 0.0) {
-  //   shadow = 1.0;
-  // }
+  // Shadow from the cascade of the fragment
+  const float shadow = get_shadow(frag_pos);
 
   // Radiance for directional lights is the color of the light times its strength
   const vec3 radiance = light.color * light.strength;
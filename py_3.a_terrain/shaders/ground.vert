@@ -8,33 +8,25 @@ out vec2 uv_0;
 out vec3 normal;
 out vec3 frag_pos;
 out float color_variation;
-out vec4 shadow_coord;
 
-uniform mat4 m_proj;
-uniform mat4 m_view;
+layout (std140, binding = 0) uniform Camera {
+    mat4 m_proj;
+    mat4 m_proj_view;
+    vec3 cam_pos;
+};
+
 uniform mat4 m_model;
-uniform mat4 m_view_global_light;
 
 float random(vec2 st);
 float noise(in vec2 st);
 float fbm(in vec2 _st);
 
-// Bias offset to remove shadow acne
-const float tiny = -0.0005;
-
-// Bias matrix to convert the coordinates from [-1, 1] to [0, 1] from clip space to texture space
-const mat4 m_shadow_bias = mat4(0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.5, 0.5, 0.5, 1.0);
-
 void main() {
     uv_0 = in_texcoord_0.xy;
     normal = normalize(mat3(m_model) * in_normal);
     frag_pos = vec3(m_model * vec4(in_position, 1.0));
     color_variation = fbm(in_position.xz);
-    gl_Position = m_proj * m_view * m_model * vec4(in_position, 1.0);
-
-    const mat4 shadow_mvp = m_proj * m_view_global_light * m_model;
-    shadow_coord = m_shadow_bias * shadow_mvp * vec4(in_position, 1.0);
-    shadow_coord.z += tiny;
+    gl_Position = m_proj_view * m_model * vec4(in_position, 1.0);
 }
 
 float random(vec2 st) {
@@ -0,0 +1,115 @@
+#version 460 core
+
+layout (location = 0) in vec2 in_position; // Sample of the chunk grid, 0 to u_size
+
+out vec2 uv_0;
+out vec3 normal;
+out vec3 frag_pos;
+out float color_variation;
+
+layout (std140, binding = 0) uniform Camera {
+    mat4 m_proj;
+    mat4 m_proj_view;
+    vec3 cam_pos;
+};
+
+uniform sampler2DArray u_heights; // Tiles of the loaded chunks, samples normalized from 0 to 1
+uniform ivec2 u_centre; // Sample at the world origin
+uniform int u_size; // Cells per chunk side
+uniform float u_max_height;
+uniform float u_base_height;
+uniform float u_scale;
+// Per chunk
+uniform ivec2 u_origin; // First sample of the chunk
+uniform int u_layer; // Tile of the chunk, from one sample before u_origin to two after its last one
+uniform ivec4 u_edges; // Steps of the (-x, +x, -z, +z) sides, larger next to a coarser chunk
+
+float random(vec2 st);
+float noise(in vec2 st);
+float fbm(in vec2 _st);
+
+float get_height(ivec2 height_sample) {
+    const ivec2 tile_sample = clamp(height_sample - u_origin + 1, ivec2(0), textureSize(u_heights, 0).xy - 1);
+    return texelFetch(u_heights, ivec3(tile_sample, u_layer), 0).r * u_max_height - u_base_height;
+}
+
+float get_stitched_height(ivec2 local) {
+    // Sides next to a coarser chunk follow its straight lines, so there are no cracks at the seams
+    int edge = 1;
+    int along = 0;
+    ivec2 direction = ivec2(0, 1);
+    if (local.x == 0) {
+        edge = u_edges.x;
+        along = local.y;
+    } else if (local.x == u_size) {
+        edge = u_edges.y;
+        along = local.y;
+    } else if (local.y == 0) {
+        edge = u_edges.z;
+        along = local.x;
+        direction = ivec2(1, 0);
+    } else if (local.y == u_size) {
+        edge = u_edges.w;
+        along = local.x;
+        direction = ivec2(1, 0);
+    }
+    const ivec2 height_sample = u_origin + local;
+    const int offset = along % edge;
+    if (offset == 0) {
+        return get_height(height_sample);
+    }
+    const ivec2 start = height_sample - direction * offset;
+    return mix(get_height(start), get_height(start + direction * edge), float(offset) / float(edge));
+}
+
+void main() {
+    const ivec2 local = ivec2(in_position);
+    const ivec2 height_sample = u_origin + local;
+    const vec3 position = vec3((vec2(height_sample - u_centre) + 0.5) * u_scale, get_stitched_height(local)).xzy;
+
+    // Normal from the height gradient of the full resolution samples, like the ground meshes, so the
+    // shading does not change with the level of detail
+    const ivec2 dx = ivec2(1, 0);
+    const ivec2 dz = ivec2(0, 1);
+    const float slope_x = get_height(height_sample - dx) - get_height(height_sample + dx);
+    const float slope_z = get_height(height_sample - dz) - get_height(height_sample + dz);
+    normal = normalize(vec3(slope_x, 2.0 * u_scale, slope_z));
+
+    uv_0 = vec2(height_sample);
+    frag_pos = position;
+    color_variation = fbm(position.xz);
+    gl_Position = m_proj_view * vec4(position, 1.0);
+}
+
+float random(vec2 st) {
+    return fract(sin(dot(st.xy, vec2(12.9898, 78.233))) * 43758.5453123);
+}
+
+float noise(in vec2 st) {
+    const vec2 i = floor(st);
+    const vec2 f = fract(st);
+	// Four corners in 2D of a tile
+    const float a = random(i);
+    const float b = random(i + vec2(1.0, 0.0));
+    const float c = random(i + vec2(0.0, 1.0));
+    const float d = random(i + vec2(1.0, 1.0));
+	// Smooth Interpolation
+    const vec2 u = smoothstep(0.0, 1.0, f);
+	// Mix 4 percentages
+    return mix(a, b, u.x) + (c - a) * u.y * (1.0 - u.x) + (d - b) * u.x * u.y;
+}
+
+const vec2 fbm_shift = vec2(100.0);
+const mat2 fbm_rot = mat2(cos(0.5), sin(0.5), -sin(0.5), cos(0.50));
+const int num_octaves = 4;
+float fbm(in vec2 _st) {
+	// Craete variation with Fractal Brownian Motion (between 0 and 1)
+    float v = 0.0;
+    float a = 0.5;
+    for (int i = 0; i < num_octaves; ++i) {
+        v += a * noise(_st);
+        _st = fbm_rot * _st * 2.0 + fbm_shift;
+        a *= 0.5;
+    }
+    return v;
+}
\ No newline at end of file
@@ -2,10 +2,15 @@
 
 layout (location = 1) in vec3 in_position;
 
-uniform mat4 m_proj;
-uniform mat4 m_view_light;
+layout (std140, binding = 0) uniform Camera {
+    mat4 m_proj;
+    mat4 m_proj_view;
+    vec3 cam_pos;
+};
+
+uniform mat4 m_light_proj_view; // Orthographic projection and view of the cascade being rendered
 uniform mat4 m_model;
 
 void main() {
-    gl_Position = m_proj * m_view_light * m_model * vec4(in_position, 1.0);
+    gl_Position = m_light_proj_view * m_model * vec4(in_position, 1.0);
 }
\ No newline at end of file
@@ -0,0 +1,66 @@
+import importlib.util
+import os
+
+import numpy
+import pytest
+
+# Every example has its own core module, so load this one by path
+base_path = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('terrain_core', os.path.join(base_path, 'core.py'))
+core = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(core)
+
+
+def run_grass_cull(points, lod_distances):
+    # Blades kept by grass_cull.comp for a camera at the origin, with no frustum planes in the way
+    moderngl = core.moderngl
+    try:
+        ctx = moderngl.create_standalone_context(require=430, backend='egl')
+    except Exception as error:
+        pytest.skip(f'no OpenGL 4.3 context: {error}')
+    with open(os.path.join(base_path, 'shaders', 'grass_cull.comp')) as f:
+        program = ctx.compute_shader(f.read())
+    points = numpy.ascontiguousarray(points, dtype='f4')
+    count = len(points)
+    buffers = [ctx.buffer(points), ctx.buffer(reserve=points.nbytes), ctx.buffer(core.PrototypeGrass.commands),
+               ctx.buffer(reserve=points.nbytes), ctx.buffer(reserve=points.nbytes)]
+    for binding, buffer in enumerate(buffers):
+        buffer.bind_to_storage_buffer(binding)
+    camera = ctx.buffer(numpy.zeros(36, dtype='f4'))  # m_proj, m_proj_view and cam_pos at the origin
+    camera.bind_to_uniform_block(0)
+    program['u_count'].value = count
+    program['u_planes'].write(numpy.tile(numpy.array([0, 0, 0, 1], dtype='f4'), 6).tobytes())
+    program['u_lod_density'].value = core.PrototypeGrass.lod_density
+    program['u_lod_distances'].value = lod_distances
+    program['u_instanced'].value = False
+    program.run((count + core.PrototypeGrass.cull_group_size - 1) // core.PrototypeGrass.cull_group_size)
+    ctx.memory_barrier()
+    kept = numpy.frombuffer(buffers[2].read(), dtype='u4')[0]
+    visible = numpy.frombuffer(buffers[1].read(), dtype='f4').reshape(-1, 3)[:kept].copy()
+    ctx.release()
+    return visible
+
+
+def test_grass_density_drops_with_distance():
+    # Blades spread over the chunks shown with grass in the default setup
+    terrain = core.TerrainChunk
+    lod_distances = core.PrototypeGrass.get_lod_distances(terrain.grass_distance, terrain.chunk_size,
+                                                          terrain.scale)
+    furthest = terrain.grass_distance + terrain.chunk_size * terrain.scale * numpy.sqrt(2.0)
+    assert lod_distances[1] < furthest <= lod_distances[2]
+    rng = numpy.random.default_rng(0)
+    distance = rng.uniform(0.0, furthest, 200000)
+    angle = rng.uniform(0.0, 2.0 * numpy.pi, distance.size)
+    points = numpy.stack([numpy.cos(angle) * distance, numpy.zeros_like(distance), numpy.sin(angle) * distance], axis=1)
+
+    visible = run_grass_cull(points, lod_distances)
+    # Away from the dithered band edges, each band keeps its fraction of the blades
+    kept = numpy.linalg.norm(visible, axis=1)
+    bands = [(0.0, lod_distances[0] - 3.0), (lod_distances[0] + 5.0, lod_distances[1] - 5.0),
+             (lod_distances[1] + 5.0, furthest - 5.0)]
+    fractions = []
+    for (near, far), density in zip(bands, core.PrototypeGrass.lod_density):
+        fraction = ((kept >= near) & (kept < far)).sum() / ((distance >= near) & (distance < far)).sum()
+        assert fraction == pytest.approx(density, abs=0.03)
+        fractions.append(fraction)
+    assert fractions[0] > fractions[1] > fractions[2]
@@ -4,8 +4,9 @@ os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"  # noqa: E402
 import pygame
 import moderngl
 import sys
+import argparse
 
-from core import AA, Camera, Prototype, Shadow, Texture, Shader, Scene
+from core import AA, Benchmark, Camera, CpuTimer, GpuTimer, Hud, Prototype, Shadow, Texture, Shader, Scene
 
 
 class Engine:
@@ -16,11 +17,14 @@ class Engine:
     target_display = 0
     base_path = '.'
     shader_path = 'shaders'
+    headless = False  # Render offscreen with a standalone context, no window
+    headless_frames = 600  # Frames to render before exiting in headless mode
     # Variables
     fps = 0
     time = 0
     delta_time = 0
     second_count = 0
+    frame_count = 0
     # State
     paused = True
     full_polygon = True
@@ -28,6 +32,7 @@ class Engine:
     show_flash_light = False
     show_global_light = True
     show_light_sources = True
+    show_hud = False
 
     texture_blend = 1.0
     local_light = 1.0
@@ -36,8 +41,15 @@ class Engine:
     flash_light_value = 5.0
     local_light_value = 5.0
 
-    def __init__(self, windowed_win_size=(1600, 900), full_screen_win_size=(1920, 1080)):
+    def __init__(self, windowed_win_size=(1600, 900), full_screen_win_size=(1920, 1080),
+                 headless=headless, headless_frames=headless_frames, benchmark_path=None):
+        self.headless = headless
+        self.headless_frames = headless_frames
         # Initialize pygame modules
+        if self.headless:
+            # No display or audio device on render and CI machines
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
         pygame.mixer.pre_init(44100, 16, 2, 4096)
         pygame.init()
         # Window size
@@ -47,24 +59,36 @@ class Engine:
             self.win_size = self.full_screen_win_size
         else:
             self.win_size = self.windowed_win_size
-        # Set OpenGL attributes
-        pygame.display.gl_set_attribute(pygame.GL_CONTEXT_MAJOR_VERSION, 4)
-        pygame.display.gl_set_attribute(pygame.GL_CONTEXT_MINOR_VERSION, 6)
-        pygame.display.gl_set_attribute(pygame.GL_CONTEXT_PROFILE_MASK, pygame.GL_CONTEXT_PROFILE_CORE)
-        pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, self.vertical_sync)
-        # Create OpenGL context for 3D rendering
-        self.game_screen = pygame.display.set_mode(self.win_size, flags=pygame.OPENGL | pygame.DOUBLEBUF,
-                                                   display=self.target_display, vsync=self.vertical_sync)
-        # Mouse settings
-        pygame.event.set_grab(True)
-        pygame.mouse.set_visible(False)
-        # Detect and use existing OpenGL context
-        self.ctx = moderngl.create_context()
+        if self.headless:
+            # Software display surface only, so images can still be converted on load
+            self.game_screen = pygame.display.set_mode(self.win_size)
+            # Standalone OpenGL context (EGL, e.g. llvmpipe) with an offscreen framebuffer as the screen
+            self.ctx = moderngl.create_standalone_context(backend='egl')
+            self.screen = self.ctx.framebuffer(color_attachments=[self.ctx.renderbuffer(self.win_size)],
+                                               depth_attachment=self.ctx.depth_renderbuffer(self.win_size))
+            self.screen.use()
+        else:
+            # Set OpenGL attributes
+            pygame.display.gl_set_attribute(pygame.GL_CONTEXT_MAJOR_VERSION, 4)
+            pygame.display.gl_set_attribute(pygame.GL_CONTEXT_MINOR_VERSION, 6)
+            pygame.display.gl_set_attribute(pygame.GL_CONTEXT_PROFILE_MASK, pygame.GL_CONTEXT_PROFILE_CORE)
+            pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, self.vertical_sync)
+            # Create OpenGL context for 3D rendering
+            self.game_screen = pygame.display.set_mode(self.win_size, flags=pygame.OPENGL | pygame.DOUBLEBUF,
+                                                       display=self.target_display, vsync=self.vertical_sync)
+            # Mouse settings
+            pygame.event.set_grab(True)
+            pygame.mouse.set_visible(False)
+            # Detect and use existing OpenGL context
+            self.ctx = moderngl.create_context()
+            self.screen = self.ctx.screen
         self.ctx.enable(flags=moderngl.DEPTH_TEST | moderngl.CULL_FACE | moderngl.BLEND)
         self.ctx.cull_face = "back"
         self.ctx.gc_mode = 'auto'
         # Create an object to help track time
         self.clock = pygame.time.Clock()
+        self.cpu_timer = CpuTimer()
+        self.gpu_timer = GpuTimer(self)
         # Set fps max
         pygame.time.set_timer(pygame.USEREVENT, 1000 // self.target_fps)
         # Camera
@@ -77,19 +101,30 @@ class Engine:
         self.aa = AA(self)
         # Scene of objects (after lights)
         self.scene = Scene(self)
-        # Font
-        self.font = pygame.font.SysFont('arial', 64)
+        # Font and performance overlay
+        self.font = pygame.font.SysFont('arial', 18)
+        self.hud = Hud(self)
+        # Scripted camera path benchmark (after the scene)
+        self.benchmark = None
+        if benchmark_path is not None:
+            self.benchmark = Benchmark(self, frames=headless_frames, path=benchmark_path)
+
+    def destroy(self):
+        self.scene.destroy()
+        self.prototype.destroy()
+        self.shader.destroy()
+        self.shadow.destroy()
+        self.hud.destroy()
+        self.texture.destroy()
+        if self.headless:
+            self.screen.release()
+        pygame.quit()
+        sys.exit()
 
     def check_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
-                self.scene.destroy()
-                self.prototype.destroy()
-                self.shader.destroy()
-                self.shadow.destroy()
-                self.texture.destroy()
-                pygame.quit()
-                sys.exit()
+                self.destroy()
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_F1:
                 self.paused = not self.paused
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_F2:
@@ -113,6 +148,8 @@ class Engine:
                     self.texture_blend = 0.0
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_F6:
                 self.show_light_sources = not self.show_light_sources
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F7:
+                self.show_hud = not self.show_hud
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_F11:
                 self.full_screen = not self.full_screen
                 self.toggle_full_screen()
@@ -148,18 +185,32 @@ class Engine:
             self.ctx.wireframe = True
 
     def update(self):
-        self.camera.update()
+        if self.benchmark:
+            self.benchmark.set_camera()
+        self.cpu_timer.begin()
+        # The benchmark replays a scripted path, so keys and mouse do not move the camera
+        self.camera.update(user_input=not self.benchmark)
+        self.cpu_timer.end('camera_update')
         self.global_light.rotate(0.00027 * self.delta_time)
         self.flash_light.update()
+        self.cpu_timer.begin()
         self.scene.update()
+        self.cpu_timer.end('scene_update')
 
     def render(self):
+        self.cpu_timer.begin()
         self.scene.render()
+        self.cpu_timer.end('scene_render')
 
     def run(self):
         while True:
             self.delta_time = self.clock.tick(self.target_fps)
             self.raw_delta_time = self.delta_time
+            if self.benchmark:
+                # Fixed step so every benchmark run replays the same frames
+                self.delta_time = self.benchmark.delta_time
+                self.raw_delta_time = self.benchmark.delta_time
+            self.cpu_timer.begin_frame()
             if not self.paused:
                 self.time = self.time + (self.delta_time * 0.001)
             else:
@@ -167,7 +218,17 @@ class Engine:
             self.check_events()
             self.update()
             self.render()
+            self.cpu_timer.end_frame()
+            self.gpu_timer.end_frame()
             self.fps = self.clock.get_fps()
+            self.frame_count += 1
+            if self.benchmark:
+                self.benchmark.record()
+                if self.benchmark.finished:
+                    self.benchmark.save()
+                    self.destroy()
+            elif self.headless and self.frame_count >= self.headless_frames:
+                self.destroy()
             self.second_count = self.second_count + self.raw_delta_time
             if self.second_count >= 1000:
                 print(f'dt: {self.raw_delta_time:.2f}, fps: {self.fps:.2f}')
@@ -175,5 +236,12 @@ class Engine:
 
 
 if __name__ == '__main__':
-    app = Engine()
+    parser = argparse.ArgumentParser(description="Run the demo in a window, or offscreen for a fixed number of frames.")
+    parser.add_argument("--headless", action="store_true", help="Render offscreen with a standalone (EGL) context.")
+    parser.add_argument("--frames", type=int, default=Engine.headless_frames,
+                        help="Number of frames to render in headless or benchmark mode.")
+    parser.add_argument("--benchmark", nargs="?", const="benchmark.json", default=None,
+                        help="Replay the scripted camera path and save CPU and GPU frame times to this JSON file.")
+    args = parser.parse_args()
+    app = Engine(headless=args.headless, headless_frames=args.frames, benchmark_path=args.benchmark)
     app.run()
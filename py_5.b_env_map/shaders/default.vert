@@ -10,7 +10,7 @@ out vec4 frag_world_pos;
 out vec4 shadow_coord;
 
 uniform mat4 m_proj;
-uniform mat4 m_view;
+uniform mat4 m_proj_view;
 uniform mat4 m_model;
 uniform mat4 m_view_global_light;
 
@@ -26,7 +26,7 @@ void main() {
     uv_0 = in_texcoord_0.xy;
     normal = normalize(mat3(m_model) * in_normal);
     frag_world_pos = m_model * in_position4;
-    gl_Position = m_proj * m_view * m_model * in_position4;
+    gl_Position = m_proj_view * m_model * in_position4;
 
     const mat4 shadow_mvp = m_proj * m_view_global_light * m_model;
     shadow_coord = m_shadow_bias * shadow_mvp * in_position4;
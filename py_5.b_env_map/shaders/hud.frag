@@ -0,0 +1,11 @@
+#version 460 core
+
+layout (location = 0) out vec4 frag_color;
+
+in vec2 uv_0;
+
+uniform sampler2D u_tex;
+
+void main() {
+    frag_color = texture(u_tex, uv_0);
+}
\ No newline at end of file
@@ -2,6 +2,11 @@ import numpy
 import moderngl
 import glm
 import pygame
+import json
+import time
+import math
+import struct
+from collections import deque
 import pywavefront
 
 mat_4 = glm.mat4(1)
@@ -12,6 +17,60 @@ def generate_vertex_data(vertices, indices):
     return numpy.array(data, dtype='f4')
 
 
+def generate_indexed_vertex_data(vertex_data):
+    # Weld identical interleaved vertices, returns the unique vertices in first use order and the indices
+    vertex_data = numpy.asarray(vertex_data, dtype='f4')
+    _, first, inverse = numpy.unique(vertex_data.reshape(len(vertex_data), -1), axis=0,
+                                     return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    remap = numpy.empty(len(order), dtype='u4')
+    remap[order] = numpy.arange(len(order), dtype='u4')
+    return vertex_data[first[order]], remap[inverse.reshape(-1)]
+
+
+def add_defines(source, defines):
+    # Preprocessor defines go right after the #version line
+    version, _, body = source.partition('\n')
+    return version + '\n' + ''.join(f'#define {define}\n' for define in defines) + body
+
+
+def get_bounds(positions):
+    # Axis aligned bounding box as (centre, half extents)
+    positions = numpy.asarray(positions, dtype='f4').reshape(-1, 3)
+    b_min, b_max = positions.min(axis=0), positions.max(axis=0)
+    return (b_min + b_max) * 0.5, (b_max - b_min) * 0.5
+
+
+def transform_bounds(m_model, bounds):
+    # Box enclosing the transformed box, the extents are projected onto the world axes
+    m = numpy.array(m_model, dtype='f4')
+    center, extents = bounds
+    return m[:3, :3] @ center + m[:3, 3], numpy.abs(m[:3, :3]) @ extents
+
+
+def transform_vertex_data(m_model, texcoords, positions, normals):
+    # Vertices moved to world space as texture coordinates, position and normal
+    m = numpy.array(m_model, dtype='f4')
+    positions = positions @ m[:3, :3].T + m[:3, 3]
+    # Normals by the inverse transpose, like the shaders, so they stay perpendicular under non-uniform scale
+    normals = normals @ numpy.linalg.inv(m[:3, :3])
+    normals /= numpy.linalg.norm(normals, axis=1)[:, None]
+    return numpy.hstack([texcoords, positions, normals]).astype('f4')
+
+
+def get_frustum_planes(m_proj_view):
+    # Left, right, bottom, top, near and far planes (a, b, c, d) taken from the rows of the matrix
+    m = numpy.array(m_proj_view, dtype='f4')
+    planes = numpy.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes / numpy.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def frustum_cull(planes, centers, extents):
+    # A box is visible unless it lies entirely behind one of the planes
+    distances = centers @ planes[:, :3].T + planes[:, 3] + extents @ numpy.abs(planes[:, :3]).T
+    return (distances >= 0.0).all(axis=1)
+
+
 class Camera:
     yaw = -90
     pitch = 0
@@ -36,9 +95,11 @@ class Camera:
         self.near = near
         self.far = far
         self.sensitivity = sensitivity
-        # View matrix
-        self.m_view = self.get_view_matrix()
-        # Aspect ratio and Projection matrix
+        # Matrices are only rebuilt when their inputs change, version counts the rebuilds
+        self.view_state = None
+        self.proj_state = None
+        self.version = 0
+        # Aspect ratio, View and Projection matrices
         self.set_aspect_and_projection()
         # Key bindings
         self.key_bindings = {
@@ -52,16 +113,13 @@ class Camera:
 
     def set_aspect_and_projection(self):
         self.aspect_ratio = self.app.win_size[0] / self.app.win_size[1]
-        self.m_proj = self.get_projection_matrix()
+        self.update_matrices()
 
     def rotate(self):
-        old_yaw, old_pitch = self.yaw, self.pitch
         rel_x, rel_y = pygame.mouse.get_rel()
         self.yaw += rel_x * self.sensitivity
         self.pitch -= rel_y * self.sensitivity
         self.pitch = max(-89, min(89, self.pitch))
-        if old_yaw != self.yaw or old_pitch != self.pitch:
-            self.app.scene.moved = True
 
     def update_camera_vectors(self):
         yaw, pitch = glm.radians(self.yaw), glm.radians(self.pitch)
@@ -72,14 +130,32 @@ class Camera:
         self.right = glm.normalize(glm.cross(self.forward, glm.vec3(0, 1, 0)))
         self.up = glm.normalize(glm.cross(self.right, self.forward))
 
-    def update(self):
-        self.move()
-        self.rotate()
-        self.update_camera_vectors()
-        self.m_view = self.get_view_matrix()
+    def update(self, user_input=True):
+        if user_input:
+            self.move()
+            self.rotate()
+        else:
+            # Drop the mouse motion, so it does not turn the camera once input is used again
+            pygame.mouse.get_rel()
+        self.update_matrices()
+
+    def update_matrices(self):
+        view_state = (self.position.x, self.position.y, self.position.z, self.yaw, self.pitch)
+        proj_state = (self.fov, self.aspect_ratio, self.near, self.far)
+        if view_state == self.view_state and proj_state == self.proj_state:
+            return
+        if view_state != self.view_state:
+            self.view_state = view_state
+            self.update_camera_vectors()
+            self.m_view = self.get_view_matrix()
+        if proj_state != self.proj_state:
+            self.proj_state = proj_state
+            self.m_proj = self.get_projection_matrix()
+        self.m_proj_view = self.m_proj * self.m_view
+        self.frustum_planes = get_frustum_planes(self.m_proj_view)
+        self.version += 1
 
     def move(self):
-        old_x, old_y, old_z = self.position.xyz
         self.velocity = self.speed * self.app.raw_delta_time
         keys = pygame.key.get_pressed()
         if keys[self.key_bindings["forward"]]:
@@ -94,8 +170,6 @@ class Camera:
             self.position += self.up * self.velocity
         if keys[self.key_bindings["down"]]:
             self.position -= self.up * self.velocity
-        if self.position.x != old_x or self.position.y != old_y or self.position.z != old_z:
-            self.app.scene.moved = True
 
     def get_view_matrix(self):
         return glm.lookAt(self.position, self.position + self.forward, self.up)
@@ -165,27 +239,84 @@ class CameraSpotLight:
         self.direction = self.camera.forward
 
 
+class ShaderUniforms():
+    # Uniform handles of one program, resolved once when the program is compiled
+    # The setters write straight from glm/numpy memory instead of converting through .value
+    # The last uploaded bytes are kept per uniform (a program keeps its uniform values),
+    # so writing an unchanged value is a hit and skips the GL call
+    pack_int = struct.Struct('i').pack
+    pack_float = struct.Struct('f').pack
+
+    def __init__(self, program):
+        self.handles = {}
+        for name in program:
+            member = program[name]
+            if isinstance(member, moderngl.Uniform):
+                self.handles[name] = member
+        self.arrays = {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def write(self, name, data):
+        if self.values.get(name) == data:
+            self.hits += 1
+            return
+        self.misses += 1
+        self.values[name] = data
+        self.handles[name].write(data)
+
+    def get_array(self, name, field):
+        # Names of a struct array member, e.g. lights[i].position, built once
+        key = (name, field)
+        if key not in self.arrays:
+            names = []
+            while f'{name}[{len(names)}].{field}' in self.handles:
+                names.append(f'{name}[{len(names)}].{field}')
+            self.arrays[key] = names
+        return self.arrays[key]
+
+    def set_int(self, name, value):
+        self.write(name, self.pack_int(value))
+
+    def set_float(self, name, value):
+        self.write(name, self.pack_float(value))
+
+    def set_vec3(self, name, value):
+        self.write(name, value.to_bytes())
+
+    def set_mat4(self, name, value):
+        self.write(name, value.to_bytes())
+
+
 class Shader():
     def __init__(self, app):
         self.app = app
         self.ctx = app.ctx
         self.programs = []
+        self.uniforms = []
         self.programs_count = -1
         self.programs_map = {}
 
-    def get_shader(self, shader_name, geometry=False):
-        if shader_name in self.programs_map:
-            # print(f"Reuse shader: {shader_name} at index: {self.programs_map[shader_name]}")
-            return self.programs[self.programs_map[shader_name]]
+    def get_shader(self, shader_name, geometry=False, defines=()):
+        # Variants of a shader compiled with defines, e.g. INSTANCED, are kept as separate programs
+        key = ':'.join([shader_name, *defines])
+        if key in self.programs_map:
+            # print(f"Reuse shader: {key} at index: {self.programs_map[key]}")
+            return self.programs[self.programs_map[key]]
 
         with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.vert', 'r') as f:
             vertex_shader_source = f.read()
         with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.frag', 'r') as f:
             fragment_shader_source = f.read()
 
+        if defines:
+            vertex_shader_source = add_defines(vertex_shader_source, defines)
+            fragment_shader_source = add_defines(fragment_shader_source, defines)
+
         if geometry is True:
             with open(f'{self.app.base_path}/{self.app.shader_path}/{shader_name}.geom', 'r') as f:
-                geometry_shader_source = f.read()
+                geometry_shader_source = add_defines(f.read(), defines)
             shader_program = self.ctx.program(
                 vertex_shader=vertex_shader_source,
                 fragment_shader=fragment_shader_source,
@@ -197,11 +328,21 @@ class Shader():
                 fragment_shader=fragment_shader_source,
             )
         self.programs_count += 1
-        self.programs_map[shader_name] = self.programs_count
+        self.programs_map[key] = self.programs_count
         self.programs.append(shader_program)
-        print(f"loaded shader: {shader_name} at index: {self.programs_count}")
+        self.uniforms.append(ShaderUniforms(shader_program))
+        print(f"loaded shader: {key} at index: {self.programs_count}")
         return shader_program
 
+    def get_uniforms(self, shader_name, geometry=False, defines=()):
+        self.get_shader(shader_name, geometry, defines)
+        return self.uniforms[self.programs_map[':'.join([shader_name, *defines])]]
+
+    def get_uniform_counts(self):
+        # Skipped (unchanged) and uploaded uniform writes over all programs
+        return (sum(uniforms.hits for uniforms in self.uniforms),
+                sum(uniforms.misses for uniforms in self.uniforms))
+
     def destroy(self):
         for program in self.programs:
             program.release()
@@ -271,6 +412,7 @@ class Texture:
         self.texture_map[name] = self.texture_count
         self.textures.append(color_texture)
         print(f"loaded color texture: {name} at index: {self.texture_count}")
+        return self.texture_count
 
     def destroy(self):
         for texture in self.textures:
@@ -295,9 +437,10 @@ class Shadow():
         self.depth_fbo = self.ctx.framebuffer(depth_attachment=self.depth_texture)
         # self.depth_fbo = self.ctx.framebuffer(depth_attachment=self.depth_buffer)
 
-        # Shadow depth map
-        self.shader_program = app.shader.get_shader("default")
-        self.shader_program['shadow_map_tex'] = self.depth_tex_id
+        # Shadow depth map, for the plain and the instanced lit program
+        for defines in ((), ('INSTANCED',)):
+            shader_program = app.shader.get_shader("default", defines=defines)
+            shader_program['shadow_map_tex'] = self.depth_tex_id
         self.app.texture.textures[self.depth_tex_id].use(location=self.depth_tex_id)
 
     def destroy(self):
@@ -312,6 +455,17 @@ class Prototype:
         self.objects = []
         self.object_count = -1
         self.object_map = {}
+        self.camera_version = -1
+        # The plain and the instanced variants share the per-frame uniforms
+        self.lit_uniforms = [app.shader.get_uniforms('default'),
+                             app.shader.get_uniforms('default', defines=('INSTANCED',))]
+        self.shadow_uniforms = [app.shader.get_uniforms('shadow'),
+                                app.shader.get_uniforms('shadow', defines=('INSTANCED',))]
+        self.light_uniforms = app.shader.get_uniforms('light')
+        uniforms = self.lit_uniforms[0]
+        self.light_names = list(zip(uniforms.get_array('lights', 'position'),
+                                    uniforms.get_array('lights', 'color'),
+                                    uniforms.get_array('lights', 'strength')))
 
     def get_object(self, name):
         if name in self.object_map:
@@ -341,50 +495,58 @@ class Prototype:
         return base_object
 
     def common_render_update(self):
-        shader_program = self.app.shader.get_shader('default')
-        # Resolution
-        # shader_program['u_resolution'].write(glm.vec2(self.app.win_size))
-
-        # Position
-        shader_program['num_lights'].value = len(self.app.lights)
-        shader_program['cam_pos'].write(self.app.camera.position)
-        shader_program['m_proj'].write(self.app.camera.m_proj)
-        shader_program['m_view'].write(self.app.camera.m_view)
-
-        # Send lights into uniform array of Light struct
-        for i, light in enumerate(self.app.lights):
-            shader_program[f'lights[{i}].position'].value = light.position
-            shader_program[f'lights[{i}].color'].value = light.color
-            shader_program[f'lights[{i}].strength'].value = light.strength
-
-        # Send global_light from self.global_light
-        shader_program['m_view_global_light'].write(self.app.global_light.m_view_light)
-        shader_program['global_light.position'].value = self.app.global_light.position
-        shader_program['global_light.direction'].value = self.app.global_light.direction
-        shader_program['global_light.color'].value = self.app.global_light.color
-        shader_program['global_light.strength'].value = self.app.global_light.strength
-
-        # Send flash_light from self.flash_light
-        shader_program['flash_light.position'].value = self.app.flash_light.position
-        shader_program['flash_light.color'].value = self.app.flash_light.color
-        shader_program['flash_light.strength'].value = self.app.flash_light.strength
-        shader_program['flash_light.cutoff'].value = self.app.flash_light.cutoff
-        shader_program['flash_light.direction'].value = self.app.flash_light.direction
-        shader_program['flash_light.softness'].value = self.app.flash_light.softness
+        # Camera uniforms are only sent when the camera has rebuilt its matrices
+        camera_changed = self.camera_version != self.app.camera.version
+        self.camera_version = self.app.camera.version
+
+        camera = self.app.camera
+        global_light = self.app.global_light
+        flash_light = self.app.flash_light
+        for uniforms in self.lit_uniforms:
+            # Resolution
+            # uniforms.handles['u_resolution'].write(glm.vec2(self.app.win_size))
+
+            # Position
+            uniforms.set_float('num_lights', len(self.app.lights))
+            if camera_changed:
+                uniforms.set_vec3('cam_pos', camera.position)
+                uniforms.set_mat4('m_proj', camera.m_proj)
+                uniforms.set_mat4('m_proj_view', camera.m_proj_view)
+
+            # Send lights into uniform array of Light struct
+            for (position, color, strength), light in zip(self.light_names, self.app.lights):
+                uniforms.set_vec3(position, light.position)
+                uniforms.set_vec3(color, light.color)
+                uniforms.set_float(strength, light.strength)
+
+            # Send global_light from self.global_light
+            uniforms.set_mat4('m_view_global_light', global_light.m_view_light)
+            uniforms.set_vec3('global_light.position', global_light.position)
+            uniforms.set_vec3('global_light.direction', global_light.direction)
+            uniforms.set_vec3('global_light.color', global_light.color)
+            uniforms.set_float('global_light.strength', global_light.strength)
+
+            # Send flash_light from self.flash_light
+            uniforms.set_vec3('flash_light.position', flash_light.position)
+            uniforms.set_vec3('flash_light.color', flash_light.color)
+            uniforms.set_float('flash_light.strength', flash_light.strength)
+            uniforms.set_float('flash_light.cutoff', flash_light.cutoff)
+            uniforms.set_vec3('flash_light.direction', flash_light.direction)
+            uniforms.set_float('flash_light.softness', flash_light.softness)
+
+            # Debug
+            uniforms.set_float('texture_blend', self.app.texture_blend)
+            uniforms.set_float('local_light_blend', self.app.local_light)
 
         # Shadow
-        shadow_program = self.app.shader.get_shader('shadow')
-        shadow_program['m_proj'].write(self.app.camera.m_proj)
-        shadow_program['m_view_light'].write(self.app.global_light.m_view_light)
-
-        # Debug
-        shader_program["texture_blend"].value = self.app.texture_blend
-        shader_program["local_light_blend"].value = self.app.local_light
+        for uniforms in self.shadow_uniforms:
+            if camera_changed:
+                uniforms.set_mat4('m_proj', camera.m_proj)
+            uniforms.set_mat4('m_view_light', global_light.m_view_light)
 
         # Debug Light
-        light_program = self.app.shader.get_shader('light')
-        light_program['m_proj'].write(self.app.camera.m_proj)
-        light_program['m_view'].write(self.app.camera.m_view)
+        if camera_changed:
+            self.light_uniforms.set_mat4('m_proj_view', camera.m_proj_view)
 
     def destroy(self):
         for obj in self.objects:
@@ -399,25 +561,55 @@ class PrototypeCube:
         self.ctx = app.ctx
         self.vbo = self.get_vbo()
         self.shader_program = self.app.shader.get_shader(shader_name)
+        self.uniforms = self.app.shader.get_uniforms(shader_name)
         self.vao = self.get_vao(self.vbo, self.shader_program)
         self.shadow_program = self.app.shader.get_shader(shadow_name)
+        self.shadow_uniforms = self.app.shader.get_uniforms(shadow_name)
         self.shadow_vao = self.get_shadow_vao(self.vbo, self.shadow_program)
+        # Instanced variants, the model matrix and material come from an instance buffer
+        self.instanced_program = self.app.shader.get_shader(shader_name, defines=('INSTANCED',))
+        self.instanced_uniforms = self.app.shader.get_uniforms(shader_name, defines=('INSTANCED',))
+        self.instanced_shadow_program = self.app.shader.get_shader(shadow_name, defines=('INSTANCED',))
+        self.batches = {}
 
     def destroy(self):
+        for batch in self.batches.values():
+            batch.destroy()
         self.vao.release()
         self.shadow_vao.release()
         self.vbo.release()
+        self.ibo.release()
+
+    def get_batch(self, tex_id):
+        # One instance batch per texture, objects sharing it are drawn together
+        if tex_id not in self.batches:
+            self.batches[tex_id] = InstanceBatch(self.app, self, tex_id)
+        return self.batches[tex_id]
+
+    def get_instanced_vao(self, instance_vbo):
+        vao = self.ctx.vertex_array(self.instanced_program, [
+            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+            (instance_vbo, '16f 3f 2f /i', 'in_model', 'in_albedo', 'in_material'),
+        ], index_buffer=self.ibo, index_element_size=4)
+        return vao
+
+    def get_instanced_shadow_vao(self, instance_vbo):
+        vao = self.ctx.vertex_array(self.instanced_shadow_program, [
+            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+            (instance_vbo, '16f 5x4 /i', 'in_model'),
+        ], index_buffer=self.ibo, index_element_size=4, skip_errors=True)
+        return vao
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_shadow_vao(self, vbo, shadow_program):
         vao = self.ctx.vertex_array(shadow_program, [
             (vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
-        ], skip_errors=True)
+        ], index_buffer=self.ibo, index_element_size=4, skip_errors=True)
         # Temporary fix for the issue with the shadow program because we are not using texture coordinates
         # So we set skip_errors=True to ignore the missing in_texcoord_0 attribute
         return vao
@@ -470,7 +662,13 @@ class PrototypeCube:
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        # Identical vertices are welded, the faces share them through the index buffer
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.vertex_data = vertex_data
+        self.indices = indices
+        self.bounds = get_bounds(vertex_data[:, 2:5])
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 class PrototypeObj:
@@ -480,7 +678,9 @@ class PrototypeObj:
         self.app = app
         self.ctx = app.ctx
         self.shader_program = self.app.shader.get_shader(shader_name)
+        self.uniforms = self.app.shader.get_uniforms(shader_name)
         self.shadow_program = self.app.shader.get_shader(shadow_name)
+        self.shadow_uniforms = self.app.shader.get_uniforms(shadow_name)
 
     def build(self, name: str = "cat/20430_Cat_v1_NEW"):
         self.name = name
@@ -508,7 +708,10 @@ class PrototypeObj:
         return vao
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        vertex_data = self.get_vertex_data()
+        self.vertex_data = vertex_data.reshape(-1, 8)
+        self.bounds = get_bounds(self.vertex_data[:, 5:8])
+        return self.ctx.buffer(vertex_data)
 
     def get_vertex_data(self):
         file_path = f"../assets/{self.name}.obj"
@@ -526,16 +729,18 @@ class PrototypeLightSource():
         self.ctx = app.ctx
         self.vbo = self.get_vbo()
         self.light_program = self.app.shader.get_shader(light_name)
+        self.light_uniforms = self.app.shader.get_uniforms(light_name)
         self.vao = self.get_vao(self.vbo, self.light_program)
 
     def destroy(self):
         self.vao.release()
         self.vbo.release()
+        self.ibo.release()
 
     def get_vao(self, vbo, shader_program):
         vao = self.ctx.vertex_array(shader_program, [
             (vbo, '3f', 'in_position'),
-        ])
+        ], index_buffer=self.ibo, index_element_size=4)
         return vao
 
     def get_vertex_data(self):
@@ -561,7 +766,9 @@ class PrototypeLightSource():
         return numpy.array(vertex_data, dtype='f4')
 
     def get_vbo(self):
-        return self.ctx.buffer(self.get_vertex_data())
+        vertex_data, indices = generate_indexed_vertex_data(self.get_vertex_data())
+        self.ibo = self.ctx.buffer(indices)
+        return self.ctx.buffer(vertex_data)
 
 
 def generate_vertex_data(vertices, indices):
@@ -581,16 +788,19 @@ class Cube:
         self.position = glm.scale(self.position, glm.vec3(scale))
         self.can_update = can_update
         self.can_render = True
+        self.can_render_shadow = True
 
         self.albedo = glm.vec3(albedo)
         self.roughness = roughness
         self.metallic = metallic
 
         this_object = self.app.prototype.get_object(name)
+        self.prototype = this_object
         self.vao = this_object.vao
+        self.bounds = this_object.bounds
         self.shadow_vao = this_object.shadow_vao
-        self.shader_program = this_object.shader_program
-        self.shadow_program = this_object.shadow_program
+        self.uniforms = this_object.uniforms
+        self.shadow_uniforms = this_object.shadow_uniforms
 
         self.tex_id = app.texture.get_texture(path=f'../textures/{texture}.png')
         self.m_model = self.position
@@ -598,21 +808,25 @@ class Cube:
     def update(self):
         self.m_model = glm.rotate(self.position, self.app.time, glm.vec3(0, 1, 0))
 
+    def get_world_vertex_data(self):
+        data = self.prototype.vertex_data[self.prototype.indices]
+        return transform_vertex_data(self.m_model, data[:, 0:2], data[:, 2:5], data[:, 5:8])
+
     def render(self):
         # Texture
-        self.shader_program['u_tex_albedo'] = self.tex_id
+        self.uniforms.set_int('u_tex_albedo', self.tex_id)
         self.app.texture.textures[self.tex_id].use(location=self.tex_id)
         # Position
-        self.shader_program['m_model'].write(self.m_model)
+        self.uniforms.set_mat4('m_model', self.m_model)
         # Material
-        self.shader_program['material.a'].value = self.albedo
-        self.shader_program['material.d'].value = self.roughness
-        self.shader_program['material.s'].value = self.metallic
+        self.uniforms.set_vec3('material.a', self.albedo)
+        self.uniforms.set_float('material.d', self.roughness)
+        self.uniforms.set_float('material.s', self.metallic)
         # Render
         self.vao.render()
 
     def render_shadow(self):
-        self.shadow_program['m_model'].write(self.m_model)
+        self.shadow_uniforms.set_mat4('m_model', self.m_model)
         self.shadow_vao.render()
 
 
@@ -627,6 +841,143 @@ class Floor(Cube):
         self.m_model = self.position
 
 
+class InstanceBatch:
+    # Cubes sharing a prototype and texture, drawn with one instanced call per pass
+    # Each instance is its model matrix (16f), albedo (3f), roughness and metallic (2f)
+    instance_size = 21
+
+    def __init__(self, app, prototype, tex_id):
+        self.app = app
+        self.ctx = app.ctx
+        self.prototype = prototype
+        self.uniforms = prototype.instanced_uniforms
+        self.tex_id = tex_id
+        self.objects = []
+        self.indices = []
+        self.count = 0
+        self.shadow_count = 0
+        self.vao = None
+
+    def add(self, obj, index):
+        # index is the position of the object in the scene, used to read its culling result
+        self.objects.append(obj)
+        self.indices.append(index)
+
+    def build(self):
+        self.indices = numpy.array(self.indices, dtype=int)
+        self.data = numpy.zeros((len(self.objects), self.instance_size), dtype='f4')
+        for row, obj in zip(self.data, self.objects):
+            row[0:16] = numpy.frombuffer(obj.m_model.to_bytes(), dtype='f4')
+            row[16:19] = obj.albedo
+            row[19:21] = obj.roughness, obj.metallic
+        self.update_rows = [(row, obj) for row, obj in enumerate(self.objects) if obj.can_update]
+        # The colour and shadow passes see different objects, so each has its own buffer
+        self.vbo = self.ctx.buffer(reserve=max(self.data.nbytes, 4))
+        self.shadow_vbo = self.ctx.buffer(reserve=max(self.data.nbytes, 4))
+        self.vao = self.prototype.get_instanced_vao(self.vbo)
+        self.shadow_vao = self.prototype.get_instanced_shadow_vao(self.shadow_vbo)
+        self.mask = None
+        self.shadow_mask = None
+
+    def update(self, render_mask, shadow_mask):
+        # Copy the instances that survived culling, only when the set or a model matrix changed
+        for row, obj in self.update_rows:
+            self.data[row, 0:16] = numpy.frombuffer(obj.m_model.to_bytes(), dtype='f4')
+        changed = len(self.update_rows) > 0
+        mask = render_mask[self.indices]
+        if changed or self.mask is None or not numpy.array_equal(mask, self.mask):
+            self.mask = mask
+            visible = self.data[mask]
+            self.count = len(visible)
+            self.vbo.write(visible)
+        mask = shadow_mask[self.indices]
+        if changed or self.shadow_mask is None or not numpy.array_equal(mask, self.shadow_mask):
+            self.shadow_mask = mask
+            visible = self.data[mask]
+            self.shadow_count = len(visible)
+            self.shadow_vbo.write(visible)
+
+    def render(self):
+        self.uniforms.set_int('u_tex_albedo', self.tex_id)
+        self.app.texture.textures[self.tex_id].use(location=self.tex_id)
+        self.vao.render(instances=self.count)
+
+    def render_shadow(self):
+        self.shadow_vao.render(instances=self.shadow_count)
+
+    def destroy(self):
+        if self.vao is not None:
+            self.vao.release()
+            self.shadow_vao.release()
+            self.vbo.release()
+            self.shadow_vbo.release()
+        self.vao = None
+
+    def clear(self):
+        # Drop the members and buffers so the scene can regroup its objects
+        self.destroy()
+        self.objects = []
+        self.indices = []
+
+
+class StaticBatch:
+    # Objects that never update, sharing a texture and material, merged into one
+    # vertex buffer in world space and drawn like a single object
+    can_update = False
+
+    def __init__(self, app, tex_id, albedo, roughness, metallic):
+        self.app = app
+        self.ctx = app.ctx
+        self.tex_id = tex_id
+        self.albedo = glm.vec3(albedo)
+        self.roughness = roughness
+        self.metallic = metallic
+        self.m_model = glm.mat4(mat_4)
+        self.can_render = True
+        self.can_render_shadow = True
+        self.objects = []
+        prototype = app.prototype
+        self.uniforms = prototype.lit_uniforms[0]
+        self.shadow_uniforms = prototype.shadow_uniforms[0]
+
+    def build(self):
+        vertex_data, indices = generate_indexed_vertex_data(
+            numpy.concatenate([obj.get_world_vertex_data() for obj in self.objects]))
+        self.bounds = get_bounds(vertex_data[:, 2:5])
+        self.vbo = self.ctx.buffer(vertex_data)
+        self.ibo = self.ctx.buffer(indices)
+        self.vao = self.ctx.vertex_array(self.app.shader.get_shader('default'), [
+            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+        ], index_buffer=self.ibo, index_element_size=4)
+        self.shadow_vao = self.ctx.vertex_array(self.app.shader.get_shader('shadow'), [
+            (self.vbo, '2f 3f 3f', 'in_texcoord_0', 'in_position', 'in_normal'),
+        ], index_buffer=self.ibo, index_element_size=4, skip_errors=True)
+        print(f"static batch: {len(self.objects)} objects, {len(vertex_data)} vertices")
+
+    def render(self):
+        # Texture
+        self.uniforms.set_int('u_tex_albedo', self.tex_id)
+        self.app.texture.textures[self.tex_id].use(location=self.tex_id)
+        # Position, already in world space
+        self.uniforms.set_mat4('m_model', self.m_model)
+        # Material
+        self.uniforms.set_vec3('material.a', self.albedo)
+        self.uniforms.set_float('material.d', self.roughness)
+        self.uniforms.set_float('material.s', self.metallic)
+        # Render
+        self.vao.render()
+
+    def render_shadow(self):
+        self.shadow_uniforms.set_mat4('m_model', self.m_model)
+        self.shadow_vao.render()
+
+    def destroy(self):
+        self.vao.release()
+        self.shadow_vao.release()
+        self.vbo.release()
+        self.ibo.release()
+
+
 class Obj:
     def __init__(self, app, albedo=(1.0, 1.0, 1.0), roughness=0.75, metallic=0.25,
                  position=(0, 0, 0),
@@ -646,6 +997,7 @@ class Obj:
         self.position = glm.rotate(self.position, self.rotation.x, glm.vec3(1, 0, 0))
         self.can_update = can_update
         self.can_render = True
+        self.can_render_shadow = True
 
         self.albedo = glm.vec3(albedo)
         self.roughness = roughness
@@ -653,10 +1005,12 @@ class Obj:
 
         this_object = self.app.prototype.get_object(name=name)
         this_object.build(name=model)
+        self.vertex_data = this_object.vertex_data
         self.vao = this_object.vao
+        self.bounds = this_object.bounds
         self.shadow_vao = this_object.shadow_vao
-        self.shader_program = this_object.shader_program
-        self.shadow_program = this_object.shadow_program
+        self.uniforms = this_object.uniforms
+        self.shadow_uniforms = this_object.shadow_uniforms
 
         self.tex_id = app.texture.get_texture(path=f'../textures/{texture}.png')
         self.m_model = self.position
@@ -664,21 +1018,25 @@ class Obj:
     def update(self):
         self.m_model = glm.rotate(self.position, self.app.time, glm.vec3(0, 0, 1))
 
+    def get_world_vertex_data(self):
+        data = self.vertex_data
+        return transform_vertex_data(self.m_model, data[:, 0:2], data[:, 5:8], data[:, 2:5])
+
     def render(self):
         # Texture
-        self.shader_program['u_tex_albedo'] = self.tex_id
+        self.uniforms.set_int('u_tex_albedo', self.tex_id)
         self.app.texture.textures[self.tex_id].use(location=self.tex_id)
         # Position
-        self.shader_program['m_model'].write(self.m_model)
+        self.uniforms.set_mat4('m_model', self.m_model)
         # Material
-        self.shader_program['material.a'].value = self.albedo
-        self.shader_program['material.d'].value = self.roughness
-        self.shader_program['material.s'].value = self.metallic
+        self.uniforms.set_vec3('material.a', self.albedo)
+        self.uniforms.set_float('material.d', self.roughness)
+        self.uniforms.set_float('material.s', self.metallic)
         # Render
         self.vao.render()
 
     def render_shadow(self):
-        self.shadow_program['m_model'].write(self.m_model)
+        self.shadow_uniforms.set_mat4('m_model', self.m_model)
         self.shadow_vao.render()
 
 
@@ -692,14 +1050,14 @@ class LightSource:
 
         this_object = self.app.prototype.get_object(name)
         self.vao = this_object.vao
-        self.light_program = this_object.light_program
+        self.light_uniforms = this_object.light_uniforms
 
     def render(self):
         self.m_model = glm.mat4(glm.translate(mat_4, self.light_source.position))
         self.m_model = glm.scale(self.m_model, glm.vec3(self.scale))
         # Position
-        self.light_program['m_model'].write(self.m_model)
-        self.light_program['light.color'].value = self.light_source.color
+        self.light_uniforms.set_mat4('m_model', self.m_model)
+        self.light_uniforms.set_vec3('light.color', self.light_source.color)
         # Render
         self.vao.render()
 
@@ -707,7 +1065,12 @@ class LightSource:
 class Scene():
     objects = []
     update_list = []
-    moved = True
+    camera_version = -1
+    draw_calls = 0
+    # Draw cubes that share a prototype and texture with one instanced call
+    instancing = True
+    # Merge objects that never update into one world space vertex buffer per texture and material
+    static_batching = True
 
     def __init__(self, app):
         self.app = app
@@ -771,32 +1134,109 @@ class Scene():
         for light in self.app.lights:
             self.light_source_local.append(LightSource(app, light_source=light))
 
+        self.static_objects = []
+        self.static_batches = []
+        self.instance_batches = []
+        self.build()
+
+    def add_object(self, obj):
+        self.objects.append(obj)
+        self.dirty = True
+
+    def remove_object(self, obj):
+        self.objects.remove(obj)
+        self.dirty = True
+
+    def build_static_batches(self, static_objects):
+        for batch in self.static_batches:
+            batch.destroy()
+        batches = {}
+        for obj in static_objects:
+            key = (obj.tex_id, tuple(obj.albedo), obj.roughness, obj.metallic)
+            if key not in batches:
+                batches[key] = StaticBatch(self.app, *key)
+            batches[key].objects.append(obj)
+        self.static_batches = list(batches.values())
+        for batch in self.static_batches:
+            batch.build()
+        self.static_objects = static_objects
+
+    def build(self):
+        # Group the objects into what is actually drawn, run again when objects are added or removed
+        self.dirty = False
+        static_objects = []
+        if self.static_batching:
+            static_objects = [obj for obj in self.objects
+                              if not obj.can_update and hasattr(obj, 'get_world_vertex_data')]
+        # The merged vertex buffers are only rebuilt when the set of static objects changed
+        if static_objects != self.static_objects or (static_objects and not self.static_batches):
+            self.build_static_batches(static_objects)
+        static = set(map(id, static_objects))
+        self.drawables = self.static_batches + [obj for obj in self.objects if id(obj) not in static]
+
         # Cache the update list
-        for obj in self.objects:
-            if obj.can_update:
-                self.update_list.append(obj)
+        self.update_list = [obj for obj in self.drawables if obj.can_update]
+
+        # World space bounds of everything drawn, kept in arrays so they can be culled together
+        count = len(self.drawables)
+        self.bounds_center = numpy.zeros((count, 3), dtype='f4')
+        self.bounds_extents = numpy.zeros((count, 3), dtype='f4')
+        for i, obj in enumerate(self.drawables):
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+        self.all_indices = numpy.arange(count)
+        self.update_indices = numpy.array([i for i, obj in enumerate(self.drawables) if obj.can_update], dtype=int)
+        self.render_mask = numpy.ones(count, dtype=bool)
+        self.shadow_mask = numpy.ones(count, dtype=bool)
+        self.camera_version = -1
+
+        # Group the remaining cubes into instance batches, everything else is drawn one by one
+        for batch in self.instance_batches:
+            batch.clear()
+        self.instance_batches = []
+        self.render_list = []
+        for i, obj in enumerate(self.drawables):
+            if self.instancing and isinstance(obj, Cube):
+                batch = obj.prototype.get_batch(obj.tex_id)
+                if batch not in self.instance_batches:
+                    self.instance_batches.append(batch)
+                batch.add(obj, i)
+            else:
+                self.render_list.append(obj)
+        for batch in self.instance_batches:
+            batch.build()
 
     def update(self):
-        if self.moved == False:
-            for obj in self.update_list:
-                obj.update()
-            return
-        camera_pos = self.app.camera.position
-        for obj in self.objects:
-            if obj.can_update:
-                obj.update()
-            angle_from_camera = glm.degrees(glm.acos(glm.dot(glm.normalize(obj.pos - camera_pos), self.app.camera.forward)))
-            if angle_from_camera <= 120.0:  # View frustum
-                obj.can_render = True
-                continue
-            distance = glm.distance(camera_pos, obj.pos)
-            if distance <= 10.0:
-                obj.can_render = True
-                continue
-            obj.can_render = False
-        self.moved = False
+        if self.dirty:
+            self.build()
+
+        for i, obj in zip(self.update_indices, self.update_list):
+            obj.update()
+            self.bounds_center[i], self.bounds_extents[i] = transform_bounds(obj.m_model, obj.bounds)
+
+        # Re-cull everything when the camera changed, otherwise only the objects that may have moved
+        if self.camera_version != self.app.camera.version:
+            self.camera_version = self.app.camera.version
+            indices = self.all_indices
+        else:
+            indices = self.update_indices
+        visible = frustum_cull(self.app.camera.frustum_planes,
+                               self.bounds_center[indices], self.bounds_extents[indices])
+        self.render_mask[indices] = visible
+        for i, can_render in zip(indices.tolist(), visible.tolist()):
+            self.drawables[i].can_render = can_render
+
+        # Shadow casters are culled against the global light, which rotates every frame
+        shadow_planes = get_frustum_planes(self.app.camera.m_proj * self.app.global_light.m_view_light)
+        visible = frustum_cull(shadow_planes, self.bounds_center, self.bounds_extents)
+        self.shadow_mask[:] = visible
+        for obj, can_render_shadow in zip(self.drawables, visible.tolist()):
+            obj.can_render_shadow = can_render_shadow
+
+        for batch in self.instance_batches:
+            batch.update(self.render_mask, self.shadow_mask)
 
     def render(self):
+        self.draw_calls = 0
         self.app.prototype.common_render_update()
 
         # Clear buffers
@@ -805,30 +1245,312 @@ class Scene():
 
         # Pass 1 - Render the depth map for the global light shadows
         if self.app.show_global_light:
-            # Enable front face culling in ctx to remove peter-panning flying shadows
-            self.ctx.cull_face = "front"
-            self.app.shadow.depth_fbo.use()
-            for obj in self.objects:
-                if obj.can_render:
-                    obj.render_shadow()
-            self.ctx.cull_face = "back"
+            with self.app.gpu_timer.query('shadow'):
+                # Enable front face culling in ctx to remove peter-panning flying shadows
+                self.ctx.cull_face = "front"
+                self.app.shadow.depth_fbo.use()
+                for batch in self.instance_batches:
+                    if batch.shadow_count:
+                        batch.render_shadow()
+                        self.draw_calls += 1
+                for obj in self.render_list:
+                    if obj.can_render_shadow:
+                        obj.render_shadow()
+                        self.draw_calls += 1
+                self.ctx.cull_face = "back"
 
         # Pass 2 - Render the scene
-        self.app.ctx.screen.use()  # Switch back to the screen
-        for obj in self.objects:
-            if obj.can_render:
-                obj.render()
+        self.app.screen.use()  # Switch back to the screen
+        with self.app.gpu_timer.query('main'):
+            for batch in self.instance_batches:
+                if batch.count:
+                    batch.render()
+                    self.draw_calls += 1
+            for obj in self.render_list:
+                if obj.can_render:
+                    obj.render()
+                    self.draw_calls += 1
 
         # Render debug lights
         if self.app.show_light_sources:
-            if self.app.show_global_light:
-                self.light_source_global.render()
-            if self.app.local_light == 1.0:
-                for light_source in self.light_source_local:
-                    light_source.render()
+            with self.app.gpu_timer.query('lights'):
+                if self.app.show_global_light:
+                    self.light_source_global.render()
+                    self.draw_calls += 1
+                if self.app.local_light == 1.0:
+                    for light_source in self.light_source_local:
+                        light_source.render()
+                        self.draw_calls += 1
+
+        # Performance overlay
+        if self.app.show_hud:
+            self.app.hud.render()
+            self.draw_calls += 1
 
         # Swap buffers
-        pygame.display.flip()
+        if not self.app.headless:
+            pygame.display.flip()
 
     def destroy(self):
-        pass
+        for batch in self.static_batches:
+            batch.destroy()
+
+
+class CpuTimer():
+    '''CPU time of named engine sections for the current frame, in milliseconds.'''
+
+    def __init__(self):
+        self.times = {}
+        self.frame_start = 0.0
+        self.section_start = 0.0
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        self.section_start = self.frame_start
+
+    def begin(self):
+        self.section_start = time.perf_counter()
+
+    def end(self, name):
+        now = time.perf_counter()
+        self.times[name] = (now - self.section_start) * 1000.0
+        self.section_start = now
+
+    def end_frame(self):
+        self.times['frame'] = (time.perf_counter() - self.frame_start) * 1000.0
+
+
+class Benchmark():
+    '''Replay a scripted camera path with a fixed delta time and save frame time percentiles to JSON.'''
+    sections = ['camera_update', 'scene_update', 'scene_render', 'frame']
+
+    def __init__(self, app, frames=600, warmup_frames=30, delta_time=16.0, path='benchmark.json',
+                 radius=4.0, height=1.0, pitch=15.0):
+        self.app = app
+        self.frames = frames
+        self.warmup_frames = warmup_frames
+        self.delta_time = delta_time
+        self.path = path
+        self.radius = radius
+        self.height = height
+        self.pitch = pitch
+        self.frame = 0
+        self.finished = False
+        self.samples = {name: [] for name in self.sections}
+        self.gpu_samples = {}
+        self.uniform_counts = (0, 0)
+        # The path is a closed loop that starts and ends at the initial camera placement
+        self.start_position = glm.vec3(app.camera.position)
+        self.start_yaw = app.camera.yaw
+        self.start_pitch = app.camera.pitch
+        # Let time run (with the fixed step) so animated objects are part of the measured work
+        self.app.paused = False
+
+    def set_camera(self):
+        angle = 2.0 * math.pi * self.frame / (self.warmup_frames + self.frames)
+        camera = self.app.camera
+        camera.position = self.start_position + glm.vec3(math.sin(angle) * self.radius,
+                                                         math.sin(angle * 2.0) * self.height,
+                                                         (math.cos(angle) - 1.0) * self.radius)
+        camera.yaw = self.start_yaw + math.degrees(angle)
+        camera.pitch = self.start_pitch + math.sin(angle * 2.0) * self.pitch
+
+    def record(self):
+        if self.frame == self.warmup_frames - 1:
+            self.uniform_counts = self.app.shader.get_uniform_counts()
+        if self.frame >= self.warmup_frames:
+            for name in self.sections:
+                self.samples[name].append(self.app.cpu_timer.times[name])
+            for name, elapsed in self.app.gpu_timer.last.items():
+                self.gpu_samples.setdefault(name, []).append(elapsed)
+        self.frame += 1
+        if self.frame >= self.warmup_frames + self.frames:
+            self.finished = True
+
+    def summarize(self, samples):
+        samples = numpy.array(samples, dtype='f8')
+        return {
+            'p50': float(numpy.percentile(samples, 50)),
+            'p95': float(numpy.percentile(samples, 95)),
+            'p99': float(numpy.percentile(samples, 99)),
+            'max': float(samples.max()),
+            'mean': float(samples.mean()),
+        }
+
+    def get_uniform_writes(self):
+        # Skipped and uploaded uniform writes per measured frame
+        hits, misses = self.app.shader.get_uniform_counts()
+        return {
+            'skipped': (hits - self.uniform_counts[0]) / self.frames,
+            'uploaded': (misses - self.uniform_counts[1]) / self.frames,
+        }
+
+    def save(self):
+        results = {
+            'frames': self.frames,
+            'warmup_frames': self.warmup_frames,
+            'delta_time': self.delta_time,
+            'win_size': list(self.app.win_size),
+            'headless': self.app.headless,
+            'renderer': self.app.ctx.info['GL_RENDERER'],
+            'cpu_ms': {name: self.summarize(samples) for name, samples in self.samples.items()},
+            'gpu_ms': {name: self.summarize(samples) for name, samples in self.gpu_samples.items()},
+            'uniform_writes': self.get_uniform_writes(),
+        }
+        with open(self.path, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"saved benchmark: {self.path}")
+
+
+class GpuTimer():
+    '''GPU time of named render passes, in milliseconds, from time-elapsed queries.
+
+    Each pass owns a small ring of queries and a result is only read back `latency` frames
+    after it was issued, when the GPU has finished with it, so reading does not stall the frame.
+    '''
+
+    def __init__(self, app, latency=3, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.latency = latency
+        self.slots = latency + 1
+        self.slot = 0
+        self.history_size = history
+        self.queries = {}
+        self.issued = {}
+        self.history = {}
+        self.last = {}
+
+    def query(self, name):
+        '''Return the query for this pass and frame, use it as a context manager around the pass.'''
+        if name not in self.queries:
+            self.queries[name] = [self.ctx.query(time=True) for _ in range(self.slots)]
+            self.issued[name] = [False] * self.slots
+            self.history[name] = deque(maxlen=self.history_size)
+        self.issued[name][self.slot] = True
+        return self.queries[name][self.slot]
+
+    def end_frame(self):
+        # The next slot was issued `latency` frames ago, read it back before it is reused
+        self.slot = (self.slot + 1) % self.slots
+        self.last = {}
+        for name, queries in self.queries.items():
+            if self.issued[name][self.slot]:
+                elapsed = queries[self.slot].elapsed * 1e-6  # Nanoseconds to milliseconds
+                self.history[name].append(elapsed)
+                self.last[name] = elapsed
+                self.issued[name][self.slot] = False
+
+    def get_times(self):
+        '''Rolling mean GPU time per pass, in milliseconds.'''
+        return {name: sum(history) / len(history) for name, history in self.history.items() if len(history) > 0}
+
+
+class Hud():
+    '''Toggleable performance overlay, drawn as a textured quad over the finished frame.
+
+    Lines are refreshed one at a time, spread over the `refresh` interval, and only re-rendered
+    when their text changed; most frames the overlay is a single cached quad draw and at worst
+    one small font render and sub-texture write.
+    '''
+    lines = 12
+
+    def __init__(self, app, width=320, margin=10, refresh=250, history=60):
+        self.app = app
+        self.ctx = app.ctx
+        self.margin = margin
+        self.refresh = refresh
+        self.elapsed = 0.0
+        self.line = 0
+        self.texts = [None] * self.lines
+        self.cost = 0.0
+        self.line_height = self.app.font.get_linesize()
+        self.size = (width, self.line_height * self.lines)
+        self.background = (0, 0, 0, 160)
+        self.text_color = (255, 255, 255)
+
+        # Rolling history of the frame, cpu section and overlay times
+        self.frame_times = deque(maxlen=history)
+        self.costs = deque(maxlen=history)
+        self.cpu_history = {}
+        self.history = history
+
+        # Texture the text is drawn into, cleared to the background colour
+        self.tex_id = self.app.texture.get_color_texture(size=self.size, name='hud')
+        self.texture = self.app.texture.textures[self.tex_id]
+        self.texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        surface = pygame.Surface(self.size, flags=pygame.SRCALPHA)
+        surface.fill(self.background)
+        self.texture.write(pygame.image.tostring(surface, 'RGBA', True))
+        self.line_surface = pygame.Surface((self.size[0], self.line_height), flags=pygame.SRCALPHA)
+
+        self.shader_program = self.app.shader.get_shader('hud')
+        self.shader_program['u_tex'] = self.tex_id
+        self.vbo = self.ctx.buffer(reserve=6 * 4 * 4)  # 6 vertices of 2f position and 2f texture coordinates
+        self.vao = self.ctx.vertex_array(self.shader_program, [
+            (self.vbo, '2f 2f', 'in_position', 'in_texcoord_0'),
+        ])
+        self.win_size = None
+
+    def set_quad(self):
+        # Pixel rectangle in the top left corner to normalized device coordinates
+        self.win_size = self.app.win_size
+        w, h = self.win_size
+        x0 = -1.0 + 2.0 * self.margin / w
+        x1 = x0 + 2.0 * self.size[0] / w
+        y1 = 1.0 - 2.0 * self.margin / h
+        y0 = y1 - 2.0 * self.size[1] / h
+        vertices = [(x0, y0, 0, 0), (x1, y0, 1, 0), (x1, y1, 1, 1), (x0, y1, 0, 1)]
+        indices = [(0, 1, 2), (2, 3, 0)]
+        self.vbo.write(generate_vertex_data(vertices, indices))
+
+    def get_lines(self):
+        lines = [f"frame {sum(self.frame_times) / len(self.frame_times):.2f} ms  fps {self.app.fps:.1f}",
+                 f"draw calls {self.app.scene.draw_calls}"]
+        for name, history in self.cpu_history.items():
+            lines.append(f"cpu {name} {sum(history) / len(history):.3f} ms")
+        for name, elapsed in self.app.gpu_timer.get_times().items():
+            lines.append(f"gpu {name} {elapsed:.3f} ms")
+        hits, misses = self.app.shader.get_uniform_counts()
+        lines.append(f"uniforms skipped {hits} uploaded {misses} ({100.0 * hits / max(hits + misses, 1):.0f}%)")
+        lines.append(f"hud {sum(self.costs) / len(self.costs):.3f} ms")
+        return lines
+
+    def write_line(self, text):
+        self.line_surface.fill(self.background)
+        self.line_surface.blit(self.app.font.render(text, True, self.text_color), (4, 0))
+        y = self.size[1] - (self.line + 1) * self.line_height  # Texture rows start at the bottom
+        self.texture.write(pygame.image.tostring(self.line_surface, 'RGBA', True),
+                           viewport=(0, y, self.size[0], self.line_height))
+
+    def render(self):
+        start = time.perf_counter()
+        self.frame_times.append(self.app.raw_delta_time)
+        self.costs.append(self.cost)
+        for name, value in self.app.cpu_timer.times.items():
+            if name not in self.cpu_history:
+                self.cpu_history[name] = deque(maxlen=self.history)
+            self.cpu_history[name].append(value)
+
+        # Refresh the next line once its share of the refresh interval has passed
+        self.elapsed += self.app.raw_delta_time
+        if self.elapsed >= self.refresh / self.lines:
+            self.elapsed = 0.0
+            lines = self.get_lines()
+            text = lines[self.line] if self.line < len(lines) else ''
+            if text != self.texts[self.line]:
+                self.texts[self.line] = text
+                self.write_line(text)
+            self.line = (self.line + 1) % self.lines
+
+        if self.win_size != self.app.win_size:
+            self.set_quad()
+        self.texture.use(location=self.tex_id)
+        self.ctx.disable(moderngl.DEPTH_TEST)
+        self.vao.render()
+        self.ctx.enable(moderngl.DEPTH_TEST)
+        self.cost = (time.perf_counter() - start) * 1000.0
+
+    def destroy(self):
+        self.vao.release()
+        self.vbo.release()
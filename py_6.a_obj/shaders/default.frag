@@ -47,7 +47,11 @@ uniform SpotLight flash_light;
 
 uniform float texture_blend;
 uniform float local_light_blend;
+#ifdef INSTANCED
+flat in Material material;
+#else
 uniform Material material;
+#endif
 uniform sampler2D u_tex_albedo;
 uniform sampler2DShadow shadow_map_tex;
 
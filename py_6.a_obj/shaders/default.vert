@@ -4,14 +4,31 @@ layout (location = 0) in vec3 in_texcoord_0;
 layout (location = 1) in vec3 in_position;
 layout (location = 2) in vec3 in_normal;
 
+#ifdef INSTANCED
+// Per instance model matrix and material, from the instance buffer
+layout (location = 3) in mat4 in_model;
+layout (location = 7) in vec3 in_albedo;
+layout (location = 8) in vec2 in_material;
+
+struct Material {
+  vec3 a;
+  float d;
+  float s;
+};
+
+flat out Material material;
+#endif
+
 out vec2 uv_0;
 out vec3 normal;
 out vec3 frag_pos;
 out vec4 shadow_coord;
 
 uniform mat4 m_proj;
-uniform mat4 m_view;
+uniform mat4 m_proj_view;
+#ifndef INSTANCED
 uniform mat4 m_model;
+#endif
 uniform mat4 m_view_global_light;
 
 // Bias offset to remove shadow acne
@@ -21,12 +38,16 @@ const float tiny = -0.0005;
 const mat4 m_shadow_bias = mat4(0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.0, 0.0, 0.0, 0.5, 0.0, 0.5, 0.5, 0.5, 1.0);
 
 void main() {
+#ifdef INSTANCED
+    const mat4 m_model = in_model;
+    material = Material(in_albedo, in_material.x, in_material.y);
+#endif
     const vec4 in_position4 = vec4(in_position, 1.0);
 
     uv_0 = in_texcoord_0.xy;
-    normal = normalize(mat3(m_model) * in_normal);
+    normal = normalize(mat3(transpose(inverse(m_model))) * in_normal);
     frag_pos = vec3(m_model * in_position4);
-    gl_Position = m_proj * m_view * m_model * in_position4;
+    gl_Position = m_proj_view * m_model * in_position4;
 
     const mat4 shadow_mvp = m_proj * m_view_global_light * m_model;
     shadow_coord = m_shadow_bias * shadow_mvp * in_position4;
@@ -2,10 +2,19 @@
 
 layout (location = 1) in vec3 in_position;
 
+#ifdef INSTANCED
+layout (location = 3) in mat4 in_model;
+#endif
+
 uniform mat4 m_proj;
 uniform mat4 m_view_light;
+#ifndef INSTANCED
 uniform mat4 m_model;
+#endif
 
 void main() {
+#ifdef INSTANCED
+    const mat4 m_model = in_model;
+#endif
     gl_Position = m_proj * m_view_light * m_model * vec4(in_position, 1.0);
 }
\ No newline at end of file
@@ -0,0 +1,22 @@
+import importlib.util
+import os
+
+import glm
+import numpy
+
+# Every example has its own core module, so load this one by path
+spec = importlib.util.spec_from_file_location(
+    'obj_core', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'core.py'))
+core = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(core)
+
+
+def test_static_batch_normals_match_shader():
+    # Rotated with a non-uniform scale, where the model matrix alone bends the normals
+    m_model = glm.translate(glm.vec3(1, 2, 3)) * glm.scale(glm.vec3(4, 1, 1)) * glm.rotate(0.7, glm.vec3(0, 0, 1))
+    normal = glm.normalize(glm.vec3(0.3, 1.0, -0.2))
+    batched = core.transform_vertex_data(m_model, numpy.zeros((1, 2), dtype='f4'),
+                                         numpy.zeros((1, 3), dtype='f4'), numpy.array([normal], dtype='f4'))
+    # normal = normalize(mat3(transpose(inverse(m_model))) * in_normal) in default.vert
+    expected = glm.normalize(glm.mat3(glm.transpose(glm.inverse(m_model))) * normal)
+    numpy.testing.assert_allclose(batched[0, 5:8], expected, atol=1e-5)
@@ -0,0 +1,94 @@
+from PIL import Image
+import numpy as np
+import argparse
+import os
+
+# Simple command line app to convert a height map image to a raw file the terrain demo memory-maps
+# .r16 is little-endian 16-bit, .r32 is little-endian float from 0 to 1; rows top to bottom like the image
+
+modes = {
+    1: "1-bit pixels, black and white, stored with one pixel per byte",
+    "L": "8-bit pixels, grayscale",
+    "P": "8-bit pixels, mapped to any other mode using a color palette",
+    "RGB": "3x8-bit pixels, true color",
+    "RGBA": "4x8-bit pixels, true color with transparency mask",
+    "CMYK": "4x8-bit pixels, color separation",
+    "YCbCr": "3x8-bit pixels, color video format",
+    "LAB": "3x8-bit pixels, the L*a*b color space",
+    "HSV": "3x8-bit pixels, Hue, Saturation, Value color space",
+    "I": "32-bit signed integer pixels",
+    "I;16": "16-bit unsigned integer pixels",
+    "F": "32-bit floating point pixels"
+}
+
+
+def convert_height_map_to_raw(input_path, output_path):
+    try:
+        in_image = Image.open(input_path)
+
+        print(f"image        : {in_image.filename}")
+        print(f"mode         : {in_image.mode}")
+        print(f"as           : {modes[in_image.mode]}")
+        print(f"format       : {in_image.format}")
+        print(f"size         : {in_image.size}")
+        print(f"width        : {in_image.width}")
+        print(f"height       : {in_image.height}")
+        print(f"bands        : {in_image.getbands()}")
+
+        if output_path == None:
+            print("no output file, done")
+            return
+
+        if in_image.mode not in ('RGB', 'RGBA', 'L', 'I;16', 'I'):
+            raise ValueError(f"input image must be in RGB, RGBA, L, I;16 or I format, is: {in_image.mode}")
+        if in_image.width != in_image.height:
+            raise ValueError(f"input image must be square, is: {in_image.size}")
+        if os.path.splitext(output_path)[1] not in ('.r16', '.r32'):
+            raise ValueError(f"output file must end in .r16 or .r32, is: {output_path}")
+    except Exception as e:
+        print(f"error loading image: {e}")
+        return
+
+    # Heights from 0 to 1, the terrain only reads the first channel of colour images
+    if in_image.mode in ('RGB', 'RGBA'):
+        heights = np.array(in_image, dtype=np.uint8)[:, :, 0] / 255
+    elif in_image.mode == 'L':
+        heights = np.array(in_image, dtype=np.uint8) / 255
+    else:
+        # 16-bit PNG files open as I;16 or I
+        heights = np.array(in_image).astype(np.uint16) / 65535
+
+    # Save the raw samples
+    try:
+        if output_path.endswith('.r16'):
+            np.round(heights * 65535).astype('<u2').tofile(output_path)
+        else:
+            heights.astype('<f4').tofile(output_path)
+        print(f"converted to {output_path}")
+    except Exception as e:
+        print(f"error saving file: {e}")
+
+
+def main():
+    # Set up command-line argument parser
+    parser = argparse.ArgumentParser(description="Convert a height map image to a raw R16 or R32F file.")
+    parser.add_argument("--input", help="Path to the input image.")
+    parser.add_argument("--output", help="Path to save the output file, ending in .r16 or .r32.")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Default
+    input_path = "../textures/height_map.png"
+    output_path = None
+    if args.input:
+        input_path = args.input
+    if args.output:
+        output_path = args.output
+
+    # Call conversion function with provided arguments
+    convert_height_map_to_raw(input_path, output_path)
+
+
+if __name__ == "__main__":
+    main()